@@ -0,0 +1,446 @@
+"""
+Local stand-ins for an Ushahidi map and the TtT file server, for benchmarks.
+
+FakeUshahidi accepts report submissions and edits at /api, and csv imports
+of reports at admin/reports/upload once signed in, with configurable
+latency, random errors, and periodic bursts of 429 responses, and lists the
+reports it has accepted.  FakeTtTServer serves csv files from a directory
+with ETag, If-None-Match and Range support, as a web server would.  FakeTweetStream sends Twitter statuses as JSON lines to
+each client of a TCP port, at a steady rate, as a relay of the Twitter
+streaming API would.
+
+Both run on threads in the calling process, on a free local port.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cStringIO
+import cgi
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import urlparse
+
+import make_ttt_csv
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, each keep-alive
+    # response waits out the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        for (key, value) in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(object):
+
+    def __init__(self, handler_class):
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.owner = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _UshahidiHandler(_QuietHandler):
+
+    ID_RE = re.compile(r"TweakTheTweet ID is (\d+)")
+    OK_BODY = ('{"payload":{"domain":"http://127.0.0.1/","success":"true"},'
+               '"error":{"code":"0","message":"No Error"}}')
+
+    # Session cookie set by signing in, which csv imports need.
+    COOKIE = "session=benchmark"
+    LOGIN_BODY = ('<form action="/login" method="post">'
+                  '<input name="username"><input name="password"></form>')
+    IMPORT_BODY = "<p>Reports imported.</p>"
+
+    def do_POST(self):
+        fake = self.server.owner
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        path = urlparse.urlparse(self.path).path
+        if path.endswith("/login"):
+            self.do_login(urlparse.parse_qs(body))
+            return
+        if path.endswith("/admin/reports/upload"):
+            self.do_import(body)
+            return
+        form = urlparse.parse_qs(body)
+        if fake.latency:
+            time.sleep(fake.latency)
+        status = fake.choose_status()
+        if status != 200:
+            fake.count_refused()
+            self.send_body(status, "", [("Retry-After", "1")])
+            return
+        description = form.get("incident_description", [""])[0]
+        if form.get("action") == ["edit"]:
+            if not fake.edit(int(form.get("incident_id", ["0"])[0]),
+                             description):
+                self.send_body(404, "")
+                return
+        else:
+            match = self.ID_RE.search(description)
+            fake.count_accepted(int(match.group(1)) if match else None,
+                                description)
+        self.send_body(200, self.OK_BODY, [("Content-Type", "application/json")])
+
+    def do_login(self, form):
+        if not form.get("username"):
+            self.send_body(200, self.LOGIN_BODY, [("Content-Type", "text/html")])
+            return
+        self.send_body(200, "<p>Signed in.</p>",
+                       [("Content-Type", "text/html"),
+                        ("Set-Cookie", self.COOKIE + "; Path=/")])
+
+    def do_import(self, body):
+        # Ushahidi sends signed out requests to the login form.
+        if self.COOKIE not in self.headers.get("Cookie", ""):
+            self.send_body(302, "", [("Location", "/login")])
+            return
+        fake = self.server.owner
+        if fake.latency:
+            time.sleep(fake.latency)
+        status = fake.choose_status()
+        if status != 200:
+            fake.count_refused()
+            self.send_body(status, "", [("Retry-After", "1")])
+            return
+        form = cgi.FieldStorage(
+            fp=cStringIO.StringIO(body),
+            environ={"REQUEST_METHOD": "POST",
+                     "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+                     "CONTENT_LENGTH": str(len(body))})
+        rows = list(csv.DictReader(cStringIO.StringIO(form["csvfile"].value)))
+        fake.count_import()
+        for row in rows:
+            description = row.get("DESCRIPTION", "")
+            match = self.ID_RE.search(description)
+            fake.count_accepted(int(match.group(1)) if match else None,
+                                description)
+        self.send_body(200, self.IMPORT_BODY, [("Content-Type", "text/html")])
+
+    def do_GET(self):
+        fake = self.server.owner
+        parsed = urlparse.urlparse(self.path)
+        if parsed.path.endswith("/login"):
+            self.send_body(200, self.LOGIN_BODY, [("Content-Type", "text/html")])
+            return
+        query = urlparse.parse_qs(parsed.query)
+        if query.get("task") == ["categories"]:
+            body = json.dumps({"payload": {"categories": [
+                {"category": {"id": category_id, "title": title}}
+                for (category_id, title) in sorted(fake.CATEGORIES.items())]},
+                "error": {"code": "0", "message": "No Error"}})
+            self.send_body(200, body, [("Content-Type", "application/json")])
+            return
+        # Otherwise task=incidents&by=sinceid, as used to find reports to edit.
+        since = int(query.get("id", ["0"])[0])
+        limit = int(query.get("limit", ["20"])[0])
+        incidents = fake.incidents_since(since, limit)
+        if not incidents:
+            body = json.dumps({"error": {"code": "007",
+                                         "message": "No Information."}})
+        else:
+            body = json.dumps({"payload": {"incidents": [
+                {"incident": {"incidentid": str(incident_id),
+                              "incidentdescription": description}}
+                for (incident_id, description) in incidents]},
+                "error": {"code": "0", "message": "No Error"}})
+        self.send_body(200, body, [("Content-Type", "application/json")])
+
+
+class FakeUshahidi(_Server):
+    """
+    Accepts Ushahidi API report submissions and counts them.
+
+    @ivar accepted: number of reports accepted
+    @ivar duplicates: number of accepted reports whose TtT id was seen before
+    @ivar edits: number of edits of accepted reports
+    @ivar refused: number of requests answered with an error
+    @ivar imports: number of csv imports accepted
+    """
+
+    # Category titles by id, for csv imports, which name categories by title.
+    CATEGORIES = {"67": "Tweak the Tweet", "68": "Tweak the Tweet, no lat lon"}
+
+    def __init__(self, latency=0.0, error_rate=0.0, burst_every=0,
+                 burst_length=0):
+        """
+        @param latency: seconds to wait before answering each request
+        @param error_rate: fraction of requests answered with 503
+        @param burst_every: seconds between bursts of 429 responses, 0 for none
+        @param burst_length: length of each burst in seconds
+        """
+        _Server.__init__(self, _UshahidiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.lock = threading.Lock()
+        self.rand = random.Random(1)
+        self.reset()
+
+    def reset(self):
+        """ Clear the counters and restart the burst schedule. """
+        with self.lock:
+            self.started = time.time()
+            self.accepted = 0
+            self.duplicates = 0
+            self.refused = 0
+            self.edits = 0
+            self.imports = 0
+            self.ids = set()
+            # Description of each report, by incident id from 1.
+            self.descriptions = []
+            self.last_request = None
+
+    def choose_status(self):
+        with self.lock:
+            now = time.time()
+            self.last_request = now
+            if self.burst_every:
+                if (now - self.started) % self.burst_every < self.burst_length:
+                    return 429
+            if self.error_rate and self.rand.random() < self.error_rate:
+                return 503
+            return 200
+
+    def count_accepted(self, ttt_id, description=""):
+        with self.lock:
+            self.accepted += 1
+            self.descriptions.append(description)
+            if ttt_id is not None:
+                if ttt_id in self.ids:
+                    self.duplicates += 1
+                self.ids.add(ttt_id)
+
+    def edit(self, incident_id, description):
+        """ Replace a report's description; False if there's no such report. """
+        with self.lock:
+            if not 0 < incident_id <= len(self.descriptions):
+                return False
+            self.descriptions[incident_id - 1] = description
+            self.edits += 1
+            return True
+
+    def incidents_since(self, since, limit):
+        """ Return up to limit (incident id, description) after since. """
+        with self.lock:
+            return [(incident_id, self.descriptions[incident_id - 1])
+                    for incident_id in xrange(
+                        since + 1,
+                        min(len(self.descriptions), since + limit) + 1)]
+
+    def count_refused(self):
+        with self.lock:
+            self.refused += 1
+
+    def count_import(self):
+        with self.lock:
+            self.imports += 1
+
+
+class _TtTHandler(_QuietHandler):
+
+    def do_GET(self):
+        fake = self.server.owner
+        name = os.path.basename(urlparse.urlparse(self.path).path)
+        path = os.path.join(fake.directory, name)
+        if not name or not os.path.isfile(path):
+            self.send_body(404, "")
+            return
+        etag = fake.etag(path)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_body(304, "", [("ETag", etag)])
+            return
+        size = os.path.getsize(path)
+        start = 0
+        status = 200
+        headers = [("ETag", etag), ("Content-Type", "text/csv"),
+                   ("Accept-Ranges", "bytes")]
+        range_header = self.headers.get("Range")
+        if (range_header and range_header.startswith("bytes=") and
+                self.headers.get("If-Range", etag) == etag):
+            start = int(range_header[6:].split("-")[0])
+            if start >= size:
+                self.send_body(416, "", [("Content-Range", "bytes */%d" % size)])
+                return
+            status = 206
+            headers.append(("Content-Range",
+                            "bytes %d-%d/%d" % (start, size - 1, size)))
+        self.send_response(status)
+        for (key, value) in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        fin = open(path, "rb")
+        try:
+            fin.seek(start)
+            while True:
+                chunk = fin.read(64 * 1024)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+        finally:
+            fin.close()
+
+
+class FakeTtTServer(_Server):
+    """ Serves the csv files in a directory, as the TtT server does. """
+
+    def __init__(self, directory):
+        _Server.__init__(self, _TtTHandler)
+        self.directory = directory
+        self.etags = {}
+
+    def etag(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        if key not in self.etags:
+            self.etags[key] = '"%s"' % hashlib.md5(repr(key)).hexdigest()
+        return self.etags[key]
+
+
+class _TweetStreamHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        owner = self.server.owner
+        interval = 1.0 / owner.rate if owner.rate else 0
+        next_time = time.time()
+        try:
+            for status in owner.statuses():
+                if owner.stopping.is_set():
+                    break
+                self.request.sendall(json.dumps(status) + "\r\n")
+                owner.sent += 1
+                if interval:
+                    next_time += interval
+                    delay = next_time - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        except socket.error:
+            # The client went away.
+            pass
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn,
+                          SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeTweetStream(object):
+    """
+    Sends Twitter statuses, one JSON object per line, to each client.
+
+    The statuses are made from the rows of make_ttt_csv, with the event as
+    a hashtag and, where the row has one, the location as a #loc tag.
+    Every so often a delete notice is sent, as Twitter does.
+    """
+
+    def __init__(self, rows, rate=100.0, start_id=1):
+        """
+        @param rows: number of statuses to send each client before closing
+        @param rate: statuses per second; 0 for as fast as possible
+        @param start_id: id of the first status
+        """
+        self.rows = rows
+        self.rate = rate
+        self.start_id = start_id
+        self.sent = 0
+        self.stopping = threading.Event()
+        self.server = _ThreadingTCPServer(("127.0.0.1", 0),
+                                          _TweetStreamHandler)
+        self.server.owner = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "tcp://127.0.0.1:%d" % self.server.server_address[1]
+
+    def statuses(self):
+        for row in make_ttt_csv.generate_rows(self.rows, self.start_id):
+            row = dict(zip(make_ttt_csv.TTT_HEADERS, row))
+            tweet_id = int(row["ID"])
+            text = row["Text"]
+            if row["Location"] != "NA" and "#loc" not in text:
+                text += " #loc %s" % row["Location"]
+            status = {
+                "id": tweet_id,
+                "id_str": str(tweet_id),
+                "created_at": time.strftime("%a %b %d %H:%M:%S +0000 %Y",
+                                            time.gmtime()),
+                "text": text,
+                "user": {"screen_name": row["Author"]},
+                "entities": {},
+            }
+            if row["GPS_Lat"] != "NA":
+                status["coordinates"] = {
+                    "type": "Point",
+                    "coordinates": [float(row["GPS_Long"]),
+                                    float(row["GPS_Lat"])]}
+            yield status
+            if tweet_id % 97 == 0:
+                yield {"delete": {"status": {"id": tweet_id - 1}}}
+
+    def expected(self, events):
+        """
+        Number of statuses whose first hashtag among events is one of them.
+
+        This differs from the count of rows for the events, because a
+        retweet can carry another event's hashtag.
+        """
+        count = 0
+        for status in self.statuses():
+            for tag in re.findall(r"#(\w+)", status.get("text", "")):
+                if tag.lower() in events:
+                    count += 1
+                    break
+        return count
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic Tweak the Tweet csv file for benchmarking.
+
+The file has the 17 TtT columns, with a mix of events, retweets, missing
+("NA") fields, both time formats, and quoted fields containing commas.
+
+Example use:
+python make_ttt_csv.py --rows 100000 --output ttt_100k.csv
+"""
+
+import csv
+import random
+
+TTT_HEADERS = ["EVENT", "Report Type", "Report" , "Time - EDT", "Location",
+               "Text", "Contact", "Details", "Date_Time", "Source",
+               "COMPLETE", "GPS_Lat", "GPS_Long", "Photo", "Video",
+               "Author", "ID"]
+
+# Events and how often they occur.  Most rows in a multi-event export are for
+# events that a given map doesn't want.
+EVENTS = [("#sandy", 30), ("#NJwx", 10), ("#nywx", 10), ("#frankenstorm", 5),
+          ("#isaac", 25), ("#coflood", 20)]
+
+# The events the benchmark uploads.
+BENCHMARK_EVENTS = ["sandy", "njwx", "nywx"]
+
+REPORT_TYPES = ["need", "offer", "damage", "power", "shelter", "closed"]
+PLACES = ["Hoboken", "Jersey City", "Staten Island", "Red Hook", "Atlantic City",
+          "Lower Manhattan", "Long Beach", "Seaside Heights", "NA"]
+WORDS = ("power out water rising need help road closed tree down flooding "
+         "shelter open generator gas line boat rescue basement car stuck "
+         "bridge evacuate supplies food").split()
+
+
+def weighted_choice(rand, choices):
+    total = sum(weight for (value, weight) in choices)
+    pick = rand.uniform(0, total)
+    for (value, weight) in choices:
+        pick -= weight
+        if pick <= 0:
+            return value
+    return choices[-1][0]
+
+
+def generate_rows(rows, start_id=1, seed=1):
+    """ Yield synthetic TtT rows (lists of 17 strings). """
+
+    rand = random.Random(seed)
+    recent = []
+    for ttt_id in xrange(start_id, start_id + rows):
+        event = weighted_choice(rand, EVENTS)
+        place = rand.choice(PLACES)
+        if recent and rand.random() < 0.4:
+            # A retweet of a recent tweet.
+            (author, body) = rand.choice(recent)
+            text = "RT @%s: %s" % (author, body)
+        else:
+            author = "user%d" % rand.randint(1, 5000)
+            body = "%s %s, %s" % (
+                event, " ".join(rand.sample(WORDS, rand.randint(4, 10))),
+                place)
+            text = body
+            recent.append((author, body))
+            if len(recent) > 200:
+                recent.pop(0)
+        minute = ttt_id // 30
+        time_in = "10/%d/2012 %d:%02d" % (29 + (minute // 1440) % 3,
+                                          (minute // 60) % 24, minute % 60)
+        if rand.random() < 0.5:
+            time_in += ":%02d" % rand.randint(0, 59)
+        if rand.random() < 0.6:
+            lat = "%.5f" % rand.uniform(39.5, 41.0)
+            lon = "%.5f" % rand.uniform(-74.5, -73.5)
+        else:
+            lat = lon = "NA"
+        yield [event,
+               rand.choice(REPORT_TYPES),
+               rand.choice(["Power out", "Flooding", "Need help", "NA"]),
+               time_in,
+               place,
+               text,
+               rand.choice(["NA", "555-0100", "@" + author]),
+               rand.choice(["NA", "since 3pm", "2 adults, 1 child"]),
+               time_in,
+               "http://twitter.com/%s/status/%d" % (author, 260000000 + ttt_id),
+               rand.choice(["NA", "Y"]),
+               lat,
+               lon,
+               rand.choice(["NA"] * 9 + ["http://twitpic.com/abc%d" % ttt_id]),
+               "NA",
+               author,
+               str(ttt_id)]
+
+
+def write_csv(path, rows, start_id=1, seed=1):
+    """ Write a synthetic TtT csv file.
+        @return: number of rows for BENCHMARK_EVENTS
+    """
+
+    wanted = 0
+    fout = open(path, "wb")
+    try:
+        writer = csv.writer(fout)
+        writer.writerow(TTT_HEADERS)
+        for row in generate_rows(rows, start_id, seed):
+            if row[0].lstrip("#").lower() in BENCHMARK_EVENTS:
+                wanted += 1
+            writer.writerow(row)
+    finally:
+        fout.close()
+    return wanted
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Tweak the Tweet csv file.")
+    parser.add_argument(
+        "--rows", dest="rows", type=int, default=10000, help="Number of rows.")
+    parser.add_argument(
+        "--start_id", dest="start_id", type=int, default=1, help="First TtT id.")
+    parser.add_argument(
+        "--seed", dest="seed", type=int, default=1, help="Random seed.")
+    parser.add_argument(
+        "--output", dest="output", default="ttt_synthetic.csv",
+        help="Path of the csv file to write.")
+    args = parser.parse_args()
+    wanted = write_csv(args.output, args.rows, args.start_id, args.seed)
+    print "Wrote %d rows, %d for events %s" % (
+        args.rows, wanted, ",".join(BENCHMARK_EVENTS))
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+Measure importttt.py throughput against local stand-in servers.
+
+For each ingestion mode, a synthetic TtT export is uploaded to a fake
+Ushahidi map, and the run's rows per second, p50 and p99 map request
+latency, and peak memory are recorded.  Results are written as JSON, tagged
+with the git revision, so runs of different versions can be compared.
+If any mode's map is missing reports or has duplicates, the exit status
+is 1.
+
+Modes:
+local              --input_file
+remote             --input_url, one file
+stream             --input_url --stream
+sequential         --input_url --sequential_files
+sequential_stream  --input_url --sequential_files --stream
+gevent             --input_file, run under gevent (needs gevent)
+batch              --input_file --batch_size, through the map's csv import
+tweet_stream       --input_stream, from a local stream of Twitter statuses
+                   sent at --tweet_rate per second
+
+Example use:
+python run_benchmark.py --rows 100000 --latency 0.01 --concurrency 16
+python run_benchmark.py --rows 10000 --error_rate 0.05 --burst_every 10 \\
+    --burst_length 1 --modes local,sequential --output results.json
+"""
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_servers import FakeUshahidi, FakeTtTServer, FakeTweetStream
+import make_ttt_csv
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TIMED_IMPORTTT = os.path.join(HERE, "timed_importttt.py")
+
+MODES = ["local", "remote", "stream", "sequential", "sequential_stream",
+         "gevent", "batch", "tweet_stream"]
+
+# Reports per csv import in batch mode, and the account it signs in with.
+BATCH_SIZE = 100
+BATCH_ACCOUNT = ["--map_user", "benchmark", "--map_password", "benchmark"]
+
+# Sequential files are named as on the TtT server.
+SEQUENTIAL_PREFIX = "TtT_records-"
+
+# Seconds without new reports after which a sequential or tweet stream run,
+# which never exits by itself, is taken to be finished.
+IDLE_SECONDS = 3.0
+
+UNENDING_MODES = frozenset(["sequential", "sequential_stream", "tweet_stream"])
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=HERE,
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def split_csv(path, directory, rows_per_file):
+    """ Split a csv file into sequential files, each with the header. """
+
+    fin = open(path, "rb")
+    header = fin.readline()
+    file_num = 0
+    fout = None
+    count = rows_per_file
+    # Rows from make_ttt_csv never contain newlines, so lines are rows.
+    for line in fin:
+        if count >= rows_per_file:
+            if fout:
+                fout.close()
+            file_num += 1
+            fout = open(os.path.join(
+                directory, "%s%d.csv" % (SEQUENTIAL_PREFIX, file_num)), "wb")
+            fout.write(header)
+            count = 0
+        fout.write(line)
+        count += 1
+    if fout:
+        fout.close()
+    fin.close()
+    return file_num
+
+
+def mode_args(mode, csv_path, ttt_url, tweet_url):
+    if mode == "tweet_stream":
+        return ["--input_stream", tweet_url]
+    if mode in ("local", "gevent"):
+        return ["--input_file", csv_path]
+    if mode == "batch":
+        return ["--input_file", csv_path,
+                "--batch_size", str(BATCH_SIZE)] + BATCH_ACCOUNT
+    if mode == "remote":
+        return ["--input_url", ttt_url + os.path.basename(csv_path)]
+    if mode == "stream":
+        return ["--input_url", ttt_url + os.path.basename(csv_path), "--stream"]
+    if mode == "sequential":
+        return ["--input_url", ttt_url + SEQUENTIAL_PREFIX, "--sequential_files"]
+    if mode == "sequential_stream":
+        return ["--input_url", ttt_url + SEQUENTIAL_PREFIX, "--sequential_files",
+                "--stream"]
+    raise ValueError("Unknown mode %s" % mode)
+
+
+def run_mode(mode, options, csv_path, rows, expected, map_server, ttt_server,
+             tweet_server):
+    """ Run the importer once; return a dict of measurements. """
+
+    work = tempfile.mkdtemp(prefix="ttt_bench_")
+    try:
+        latency_path = os.path.join(work, "latencies.json")
+        env = dict(os.environ)
+        env["BENCH_LATENCY_FILE"] = latency_path
+        if mode == "gevent":
+            env["BENCH_GEVENT"] = "1"
+        command = [sys.executable, TIMED_IMPORTTT] + mode_args(
+            mode, csv_path, ttt_server.url, tweet_server.url) + [
+            "--map_url", map_server.url,
+            "--ttt_events", ",".join(make_ttt_csv.BENCHMARK_EVENTS),
+            "--report_title", "Benchmark",
+            "--concurrency", str(options.concurrency),
+            "--fetch_interval", "1",
+            "--cache_file", os.path.join(work, "cache"),
+            "--uploaded", os.path.join(work, "uploaded.csv"),
+            "--rejected", os.path.join(work, "rejected.csv"),
+            "--dead_letter", os.path.join(work, "dead_letter.csv"),
+            "--uploaded_ids", ""] + options.extra_args
+
+        map_server.reset()
+        start = time.time()
+        process = subprocess.Popen(command, cwd=work, env=env)
+        status = None
+        rusage = None
+        while True:
+            (pid, wait_status, rusage) = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                status = wait_status
+                break
+            now = time.time()
+            idle = (map_server.last_request is None or
+                    now - map_server.last_request > IDLE_SECONDS)
+            done = (mode in UNENDING_MODES and
+                    map_server.accepted >= expected and idle)
+            if done or now - start > options.timeout:
+                process.send_signal(signal.SIGTERM)
+                deadline = time.time() + 10
+                while time.time() < deadline:
+                    (pid, wait_status, rusage) = os.wait4(process.pid,
+                                                          os.WNOHANG)
+                    if pid:
+                        break
+                    time.sleep(0.1)
+                else:
+                    process.kill()
+                    (pid, wait_status, rusage) = os.wait4(process.pid, 0)
+                status = wait_status
+                break
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        if mode in UNENDING_MODES and map_server.last_request:
+            # Don't count the idle wait at the end.
+            elapsed = min(elapsed, map_server.last_request - start)
+
+        try:
+            latencies = json.load(open(latency_path))
+        except (IOError, ValueError):
+            latencies = []
+        # ru_maxrss is in kilobytes on Linux, bytes on Mac OS X.
+        peak_rss_kb = rusage.ru_maxrss
+        if sys.platform == "darwin":
+            peak_rss_kb //= 1024
+        return {
+            "seconds": round(elapsed, 3),
+            "rows": rows,
+            "rows_per_sec": round(rows / elapsed, 1) if elapsed else None,
+            "expected_reports": expected,
+            "reports": map_server.accepted,
+            "duplicate_reports": map_server.duplicates,
+            "refused_requests": map_server.refused,
+            "csv_imports": map_server.imports,
+            "map_requests": len(latencies),
+            "upload_latency_p50_ms": round(1000 * percentile(latencies, 0.5), 2)
+                                     if latencies else None,
+            "upload_latency_p99_ms": round(1000 * percentile(latencies, 0.99), 2)
+                                     if latencies else None,
+            "peak_rss_kb": peak_rss_kb,
+            "exit_status": status,
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def check_result(mode, result):
+    """ Return a list of what's wrong with a mode's result, if anything. """
+
+    problems = []
+    if result["duplicate_reports"]:
+        problems.append("%d duplicate reports" % result["duplicate_reports"])
+    if result["reports"] != result["expected_reports"]:
+        problems.append("%d reports, expected %d" % (
+            result["reports"], result["expected_reports"]))
+    if mode == "batch" and not result["csv_imports"]:
+        problems.append("no csv imports")
+    return problems
+
+
+def main(options):
+    data_dir = options.data_dir or tempfile.mkdtemp(prefix="ttt_bench_data_")
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    csv_name = "ttt_%d.csv" % options.rows
+    csv_path = os.path.join(data_dir, csv_name)
+    print >> sys.stderr, "Generating %d rows in %s" % (options.rows, csv_path)
+    expected = make_ttt_csv.write_csv(csv_path, options.rows)
+    files = split_csv(csv_path, data_dir, options.rows_per_file)
+
+    map_server = FakeUshahidi(options.latency, options.error_rate,
+                              options.burst_every, options.burst_length).start()
+    ttt_server = FakeTtTServer(data_dir).start()
+    tweet_server = FakeTweetStream(options.rows, options.tweet_rate).start()
+    results = {}
+    failed = False
+    try:
+        for mode in options.modes:
+            print >> sys.stderr, "Running %s" % mode
+            if mode == "tweet_stream":
+                mode_expected = tweet_server.expected(
+                    make_ttt_csv.BENCHMARK_EVENTS)
+            else:
+                mode_expected = expected
+            results[mode] = run_mode(mode, options, csv_path, options.rows,
+                                     mode_expected, map_server, ttt_server,
+                                     tweet_server)
+            print >> sys.stderr, json.dumps(results[mode], sort_keys=True)
+            problems = check_result(mode, results[mode])
+            if problems:
+                print >> sys.stderr, "%s failed: %s" % (mode, ", ".join(problems))
+                failed = True
+    finally:
+        map_server.stop()
+        ttt_server.stop()
+        tweet_server.stop()
+        if not options.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "settings": {
+            "rows": options.rows,
+            "rows_per_file": options.rows_per_file,
+            "sequential_files": files,
+            "concurrency": options.concurrency,
+            "latency": options.latency,
+            "error_rate": options.error_rate,
+            "burst_every": options.burst_every,
+            "burst_length": options.burst_length,
+            "tweet_rate": options.tweet_rate,
+            "extra_args": options.extra_args,
+        },
+        "results": results,
+    }
+    fout = open(options.output, "w")
+    json.dump(report, fout, indent=2, sort_keys=True)
+    fout.close()
+    print >> sys.stderr, "Results written to %s" % options.output
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark importttt.py against local stand-in servers.")
+    parser.add_argument(
+        "--rows", dest="rows", type=int, default=10000,
+        help="Number of rows in the synthetic TtT export.")
+    parser.add_argument(
+        "--rows_per_file", dest="rows_per_file", type=int, default=2000,
+        help="Rows per file in the sequential modes.")
+    parser.add_argument(
+        "--modes", dest="modes", default="local,remote,stream,sequential",
+        help="Modes to run, separated by commas, from: %s." % ", ".join(MODES))
+    parser.add_argument(
+        "--concurrency", dest="concurrency", type=int, default=8,
+        help="Value for importttt.py --concurrency.")
+    parser.add_argument(
+        "--latency", dest="latency", type=float, default=0.01,
+        help="Seconds the fake map takes to answer each report.")
+    parser.add_argument(
+        "--error_rate", dest="error_rate", type=float, default=0.0,
+        help="Fraction of reports the fake map answers with 503.")
+    parser.add_argument(
+        "--burst_every", dest="burst_every", type=float, default=0,
+        help="Seconds between bursts of 429 responses from the fake map; 0 for none.")
+    parser.add_argument(
+        "--burst_length", dest="burst_length", type=float, default=0,
+        help="Length in seconds of each burst of 429 responses.")
+    parser.add_argument(
+        "--tweet_rate", dest="tweet_rate", type=float, default=0,
+        help="Statuses per second sent by the fake tweet stream; 0 for as fast as possible.")
+    parser.add_argument(
+        "--timeout", dest="timeout", type=float, default=3600,
+        help="Seconds after which a run is stopped.")
+    parser.add_argument(
+        "--data_dir", dest="data_dir",
+        help="Directory to keep the generated csv files in. By default a temporary directory is used and removed.")
+    parser.add_argument(
+        "--output", dest="output", default="benchmark_results.json",
+        help="Path of the JSON results file.")
+    parser.add_argument(
+        "extra_args", nargs="*",
+        help="Further importttt.py options, after --, e.g. -- --cluster_retweets")
+    options = parser.parse_args()
+    options.modes = [mode.strip() for mode in options.modes.split(",")
+                     if mode.strip()]
+    for mode in options.modes:
+        if mode not in MODES:
+            parser.error("Unknown mode %s" % mode)
+    sys.exit(main(options))
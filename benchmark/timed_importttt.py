@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Run importttt.py, timing each request it makes to the map server.
+
+Used by run_benchmark.py.  Takes the same options as importttt.py.  The
+time of each map request, in seconds, is written as a JSON list to the file
+named by the BENCH_LATENCY_FILE environment variable when the script exits,
+including when it is stopped with SIGTERM.  If BENCH_GEVENT is set, the
+script runs under gevent, as importttt_gevent.py does.
+"""
+
+import os
+import sys
+
+if os.environ.get("BENCH_GEVENT"):
+    from gevent import monkey
+    monkey.patch_all()
+
+import atexit
+import json
+import runpy
+import signal
+import time
+
+import requests
+
+IMPORTTT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "importttt.py")
+
+latencies = []
+_post = requests.Session.post
+
+
+def timed_post(self, *args, **kwargs):
+    start = time.time()
+    try:
+        return _post(self, *args, **kwargs)
+    finally:
+        latencies.append(time.time() - start)
+
+
+def write_latencies():
+    path = os.environ.get("BENCH_LATENCY_FILE")
+    if path:
+        fout = open(path, "w")
+        json.dump(latencies, fout)
+        fout.close()
+
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    requests.Session.post = timed_post
+    atexit.register(write_latencies)
+    signal.signal(signal.SIGTERM, terminate)
+    sys.path.insert(0, os.path.dirname(IMPORTTT))
+    sys.argv[0] = IMPORTTT
+    runpy.run_path(IMPORTTT, run_name="__main__")
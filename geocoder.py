@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Provide lat lon for TtT rows that have a place name but no GPS fix.
+
+Most tweets have no GPS_Lat and GPS_Long, but many name a place in the
+Location column, and the same few places ("Hoboken", "Red Hook") come up
+again and again during an event.  Place names are looked up in a local
+gazetteer file, so no geocoding service is needed, and the results are kept
+in a cache: in memory for the places of the current file, and in a sqlite
+file so each place is resolved once per event, not once per row.
+
+Lookups are made for a batch of rows at a time.  The place names in the
+batch are normalized and deduplicated, the cache is read with one query,
+and only the names not in it are looked up in the gazetteer.
+"""
+
+__all__ = ["normalize_place", "Gazetteer", "GeocodeCache", "Geocoder"]
+
+import collections
+import csv
+import re
+import sqlite3
+import time
+import unicodedata
+
+_NOT_WORD_RE = re.compile(r"[^\w]+", re.UNICODE)
+
+
+def normalize_place(name):
+    """
+    Reduce a place name to a lookup key: lowercase, without accents,
+    hashtag marks or punctuation, with single spaces between words.  Parts
+    separated by commas are kept separate, e.g. "Red Hook, Brooklyn" gives
+    "red hook,brooklyn".
+
+    @param name: place name, as str (utf-8) or unicode
+    @return: the key, as a utf-8 str, or "" if nothing is left
+    """
+
+    if isinstance(name, str):
+        name = name.decode("utf-8", "replace")
+    name = unicodedata.normalize("NFKD", name)
+    name = u"".join(char for char in name if not unicodedata.combining(char))
+    parts = []
+    for part in name.lower().split(","):
+        part = u" ".join(_NOT_WORD_RE.sub(u" ", part).split())
+        if part:
+            parts.append(part)
+    return u",".join(parts).encode("utf-8")
+
+
+class Gazetteer(object):
+    """
+    Place names and their lat lon, read from a local file.
+
+    Two formats are read:
+    - a GeoNames dump (e.g. cities1000.txt or US.txt from
+      http://download.geonames.org/export/dump/): tab separated, with the
+      name, ascii name, alternate names, lat and lon in columns 2 to 6 and
+      the population in column 15
+    - a csv file with a header row naming the columns name, lat and lon, and
+      optionally alternate_names (separated by commas or semicolons) and
+      population
+
+    Where a name is shared by several places, the most populous is used, so
+    it's best to cut the file down to the region of the event.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: path of the gazetteer file
+        @raise IOError: if the file can't be read
+        @raise ValueError: if it's in neither format
+        """
+
+        self.path = path
+        # name key -> (population, lat, lon)
+        self.places = {}
+        fin = open(path, "rb")
+        try:
+            first = fin.readline()
+            fin.seek(0)
+            if first.count("\t") >= 14:
+                self._read_geonames(fin)
+            else:
+                self._read_csv(fin)
+        finally:
+            fin.close()
+
+    def _add(self, names, lat, lon, population):
+        lat = float(lat)
+        lon = float(lon)
+        try:
+            population = int(population or 0)
+        except ValueError:
+            population = 0
+        for name in names:
+            key = normalize_place(name)
+            if key:
+                known = self.places.get(key)
+                if known is None or known[0] < population:
+                    self.places[key] = (population, lat, lon)
+
+    def _read_geonames(self, fin):
+        for line in fin:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 15:
+                continue
+            names = [fields[1], fields[2]]
+            if fields[3]:
+                names.extend(fields[3].split(","))
+            try:
+                self._add(names, fields[4], fields[5], fields[14])
+            except ValueError:
+                continue
+
+    def _read_csv(self, fin):
+        reader = csv.reader(fin)
+        try:
+            header = [name.strip().lower() for name in reader.next()]
+        except StopIteration:
+            raise ValueError("Empty gazetteer file %s" % self.path)
+        try:
+            name_col = header.index("name")
+            lat_col = header.index("lat")
+            lon_col = header.index("lon")
+        except ValueError:
+            raise ValueError("Gazetteer file %s needs name, lat and lon "
+                             "columns" % self.path)
+        alt_col = (header.index("alternate_names")
+                   if "alternate_names" in header else None)
+        pop_col = header.index("population") if "population" in header else None
+        for row in reader:
+            try:
+                names = [row[name_col]]
+                if alt_col is not None and row[alt_col]:
+                    names.extend(re.split(r"[,;]", row[alt_col]))
+                population = row[pop_col] if pop_col is not None else 0
+                self._add(names, row[lat_col], row[lon_col], population)
+            except (IndexError, ValueError):
+                continue
+
+    def __len__(self):
+        return len(self.places)
+
+    def locate(self, key):
+        """
+        Find a place by its normalized name.
+
+        If the whole name isn't known, its comma separated parts are tried
+        in turn, so "Red Hook, Brooklyn" can be found under "red hook" or
+        "brooklyn".
+
+        @param key: name key from normalize_place
+        @return: (lat, lon), or None if the place isn't known
+        """
+
+        place = self.places.get(key)
+        if place is None and "," in key:
+            for part in key.split(","):
+                place = self.places.get(part)
+                if place is not None:
+                    break
+        if place is None:
+            return None
+        return place[1:]
+
+
+class GeocodeCache(object):
+    """
+    Lat lon of place name keys, kept in a sqlite file with the most
+    recently used in memory.
+
+    Places that weren't found are remembered only in memory, so they are
+    looked up again in the next run, e.g. after the gazetteer is extended.
+    Not thread safe.
+    """
+
+    # Places to keep in memory.
+    MEMORY_SIZE = 10000
+    # Places to keep on disk; the least recently used are dropped beyond
+    # this.
+    DISK_SIZE = 1000000
+
+    def __init__(self, path=None, memory_size=None, disk_size=None):
+        """
+        @param path: path of the sqlite file, or None to cache in memory only
+        """
+
+        self.memory_size = memory_size or self.MEMORY_SIZE
+        self.disk_size = disk_size or self.DISK_SIZE
+        # key -> (lat, lon) or None, least recently used first.
+        self.memory = collections.OrderedDict()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS places (key TEXT PRIMARY KEY, "
+                "lat REAL, lon REAL, used INTEGER)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS places_used ON places (used)")
+            self.db.commit()
+
+    def _remember(self, key, location):
+        memory = self.memory
+        if key in memory:
+            del memory[key]
+        memory[key] = location
+        if len(memory) > self.memory_size:
+            memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Look up several keys at once.
+
+        @return: dict of the keys that are cached, to (lat, lon) or to None
+        for places known not to be found
+        """
+
+        found = {}
+        wanted = []
+        for key in keys:
+            if key in self.memory:
+                found[key] = self.memory[key]
+                self._remember(key, found[key])
+            else:
+                wanted.append(key)
+        if wanted and self.db is not None:
+            # Stay under sqlite's limit on query parameters.
+            for start in xrange(0, len(wanted), 500):
+                chunk = wanted[start:start + 500]
+                cursor = self.db.execute(
+                    "SELECT key, lat, lon FROM places WHERE key IN (%s)" %
+                    ",".join("?" * len(chunk)),
+                    [key.decode("utf-8") for key in chunk])
+                for (key, lat, lon) in cursor:
+                    key = key.encode("utf-8")
+                    found[key] = (lat, lon)
+                    self._remember(key, found[key])
+            if found:
+                with self.db:
+                    self.db.executemany(
+                        "UPDATE places SET used = ? WHERE key = ?",
+                        ((int(time.time()), key.decode("utf-8"))
+                         for (key, location) in found.iteritems()
+                         if location is not None))
+        return found
+
+    def put_many(self, locations):
+        """
+        Add places in one transaction.
+
+        @param locations: dict of key to (lat, lon), or to None for a place
+        that wasn't found
+        """
+
+        for (key, location) in locations.iteritems():
+            self._remember(key, location)
+        if self.db is None:
+            return
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO places (key, lat, lon, used) "
+                "VALUES (?, ?, ?, ?)",
+                ((key.decode("utf-8"), location[0], location[1], now)
+                 for (key, location) in locations.iteritems()
+                 if location is not None))
+            (count,) = self.db.execute(
+                "SELECT COUNT(*) FROM places").fetchone()
+            if count > self.disk_size:
+                self.db.execute(
+                    "DELETE FROM places WHERE key IN (SELECT key FROM places "
+                    "ORDER BY used LIMIT ?)", (count - self.disk_size,))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class Geocoder(object):
+    """
+    Find the lat lon of place names, through a GeocodeCache in front of a
+    Gazetteer.
+    """
+
+    def __init__(self, gazetteer, cache=None):
+        """
+        @param gazetteer: Gazetteer to look up places not in the cache
+        @param cache: GeocodeCache, or None for one in memory only
+        """
+
+        self.gazetteer = gazetteer
+        self.cache = cache if cache is not None else GeocodeCache()
+        # Lookups by where the answer came from: "cache", "gazetteer" or
+        # "missing".
+        self.counts = {"cache": 0, "gazetteer": 0, "missing": 0}
+
+    def locate_many(self, names):
+        """
+        Find the lat lon of several place names.
+
+        Each distinct name is looked up once.
+
+        @param names: iterable of place names
+        @return: dict of name to (lat, lon), for the names that were found
+        """
+
+        keys = {}
+        for name in names:
+            if name not in keys:
+                keys[name] = normalize_place(name)
+        distinct = set(key for key in keys.itervalues() if key)
+        cached = self.cache.get_many(distinct)
+        self.counts["cache"] += len(cached)
+        new = {}
+        for key in distinct:
+            if key not in cached:
+                new[key] = self.gazetteer.locate(key)
+                if new[key] is None:
+                    self.counts["missing"] += 1
+                else:
+                    self.counts["gazetteer"] += 1
+        if new:
+            self.cache.put_many(new)
+        located = {}
+        for (name, key) in keys.iteritems():
+            location = cached.get(key) or new.get(key)
+            if location is not None:
+                located[name] = location
+        return located
+
+    def close(self):
+        self.cache.close()
@@ -7,25 +7,427 @@ Download the TweakTheTweet spreadsheet as a csv file and name it: tttin.csv
 cd to the directory the csv file is in.
 python importttt.py
 
+To keep thousands of uploads in flight without a thread for each, run it
+through importttt_gevent.py, which takes the same options, and can also
+poll several TtT feeds in one process.
+
+To upload files from cron without starting up for each one, run it once
+with --daemon and send it the files with importttt_client.py.
+
 Sara-Jayne Farmer, Pat Tressel
 2012
 """
 
-import requests
 import time
+import errno
 import re
 import csv
 import sys
+import threading
+import Queue
+import codecs
+import json
+import os
+import random
+import heapq
+import itertools
+import ConfigParser
+import urlparse
+import cStringIO
+import traceback
+import collections
+import signal
+import socket
+
+
+
+class _LazyModule(object):
+    """
+    Stand-in for a module that is imported when first used.
+
+    Importing requests takes most of the time this script needs to start,
+    which matters for short runs from cron, and for importttt_client.py runs
+    that fall back to this script.  Names like requests.RequestException
+    in except clauses are only looked up if an exception is raised.
+    """
 
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-# The next TtT id key to accept, and the number of the next sequential file
-# to fetch are saved to disk, in case the script exits.  When the script is
-# restarted, the greater of the cached values or the command args are used.
-NEXT_TTT_ID_KEY = "next_ttt_id"
-NEXT_FILE_NUM_KEY = "next_file_num"
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = __import__(self._name)
+        return getattr(self._module, attr)
+
+
+requests = _LazyModule("requests")
+
+from uploaded_ids import UploadedIdIndex
+from geocoder import Gazetteer, GeocodeCache, Geocoder
+from report_states import ReportStateTable
+from tweet_tokenizer import (TokenizedTweet, NearDuplicateIndex,
+                             TweakTheTweetCSVReader,
+                             MappedTweakTheTweetCSVReader,
+                             JSONLinesTweetReader)
+from upload_journal import UploadJournal
+from upload_metrics import (UploadMetrics, MetricsServer, MetricsLogger,
+                            SamplingProfiler)
+
+
+# The next TtT id key to accept, the number of the next sequential file to
+# fetch, and the outcome of each row of the file being uploaded are
+# journaled to disk, in case the script exits.  When the script is
+# restarted, the greater of the saved values or the command args are used,
+# and rows of an unfinished file that already have an outcome are skipped.
+# Opened on CACHE_FILE.
+JOURNAL = None
+
+# For a local file, the offset before which every row has an outcome is
+# saved once this many bytes have been read since it was last saved, or
+# this many seconds have passed, whichever comes first.
+CHECKPOINT_BYTES = 1024 * 1024
+CHECKPOINT_SECONDS = 5.0
 
 # @ToDo: Add constants here for defaults to make them easier to change.
-# @ToDo: Add constants for TtT column indices.
+
+# TtT column indices.
+(COL_EVENT, COL_TYPE, COL_REPORT, COL_TIME, COL_LOCATION, COL_TEXT,
+ COL_CONTACT, COL_DETAILS, COL_DATE_TIME, COL_SOURCE, COL_COMPLETE,
+ COL_LAT, COL_LONG, COL_PHOTO, COL_VIDEO, COL_AUTHOR, COL_ID) = range(17)
+
+# Values TtT uses for an empty field.
+MISSING_VALUES = frozenset(["", "NA"])
+
+# How a report's description names its TtT record.
+TTT_ID_RE = re.compile(r"TweakTheTweet ID is (\d+)")
+
+# TtT times are "m/d/y h:m:s" or "m/d/y h:m", on a 24 hour clock.
+TIME_RE = re.compile(r"\s*(\d+)/(\d+)/(\d+)\s+(\d+):(\d+)(?::\d+)?\s*$")
+
+# Number of reports to upload at once.  Each worker thread sends through the
+# same keep-alive session, so the connection pool is sized to match.
+CONCURRENCY = 1
+
+# If set, remote csv files are read a chunk at a time as they download, rather
+# than being held in memory whole.  Set from --stream.
+STREAM_FETCH = False
+
+# Number of bytes to read from the network at a time when streaming.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# If set, TtT files are taken to list rows in order of increasing id, so the
+# parts of a file below START_TTT_ID are passed over without being parsed.
+# Set from --ids_ascending.
+IDS_ASCENDING = False
+
+# Index of TtT ids already accepted by the map server, or None to upload
+# every row that passes the event and id filters.  Opened from --uploaded_ids.
+UPLOADED_IDS = None
+
+# Table of the version of each TtT record on the map, or None to upload each
+# record once.  If set, records are held for a window to merge later
+# versions, and versions that come after are sent as edits.  Opened from
+# --report_states and --update_window.
+REPORT_STATES_FILE = ""
+REPORT_STATES = None
+
+# Seconds to hold a record for later versions.  Set from --update_window.
+UPDATE_WINDOW = 60
+
+# Maps to upload to, as MapRoutes.  Set from --routes, or from the map given
+# on the command line.
+ROUTES = []
+
+# Clusters of near-duplicate tweets, or None to upload retweets separately.
+# If set, only the first row of each cluster is uploaded.  Set from
+# --cluster_retweets.
+TWEET_CLUSTERS = None
+
+# Geocoder for rows that name a place but have no lat lon, or None to put
+# them at DEFAULT_LAT and DEFAULT_LON.  Set from --gazetteer and
+# --geocode_cache.
+GEOCODER = None
+
+# Number of rows whose place names are looked up together.
+GEOCODE_BATCH_SIZE = 500
+
+# Number of processes that read and transform the rows of a local file.  If
+# more than one, the file is split into parts of BACKFILL_CHUNK_SIZE bytes,
+# which are read in parallel, and their rows are uploaded in order from the
+# main process.  Set from --processes.
+PROCESSES = 1
+BACKFILL_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Seconds to wait for the TtT server to connect or send more data.
+FETCH_TIMEOUT = 60
+
+# Number of times to resume an interrupted download right away before
+# waiting FETCH_INTERVAL minutes.
+FETCH_RETRIES = 3
+
+# Number of sequential files to download ahead of the one being uploaded.
+PREFETCH_DEPTH = 1
+
+# Suffixes for files kept next to CACHE_FILE: the validators (ETag and
+# Last-Modified) of recently fetched remote files, and a file being
+# downloaded.  Downloaded files are named CACHE_FILE.<n>.csv until uploaded.
+FETCH_STATE_SUFFIX = ".fetch"
+PARTIAL_FILE_SUFFIX = ".part"
+
+# Number of remote files whose state is remembered.
+FETCH_STATE_SIZE = 10
+
+# Start of the byte range in a 206 response, e.g. "bytes 1000-1999/2000".
+CONTENT_RANGE_RE = re.compile(r"\s*bytes\s+(\d+)-", re.I)
+
+# Fetch state is updated by both the prefetch thread and the main thread.
+_fetch_state_lock = threading.Lock()
+
+# Statuses from the map server that may succeed if the report is sent again.
+# None stands for a request that failed without a response.
+TRANSIENT_STATUSES = frozenset([None, 408, 429, 500, 502, 503, 504])
+
+# Statuses that mean the map server is overloaded and we should slow down.
+CONGESTION_STATUSES = frozenset([None, 429, 503])
+
+# Number of times to resend a report after a transient failure.  Set from
+# --retries.  Reports that still fail go to OUTFILE_DEAD_LETTER.
+MAX_RETRIES = 5
+
+# Bounds in seconds for the randomized exponential backoff between retries.
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Reports per second to start sending at, and the most and least the rate
+# adapts to.  MAX_SEND_RATE of None means no limit.  Set from --max_rate.
+INITIAL_SEND_RATE = 100.0
+MAX_SEND_RATE = None
+MIN_SEND_RATE = 0.2
+
+# Requests per second by which the send rate grows each second, once the map
+# server has shown overload.
+ADDITIVE_INCREASE = 5.0
+
+# The send rate is cut while more than this fraction of recent requests show
+# overload, but at most once per DECREASE_INTERVAL seconds.
+CONGESTION_ERROR_RATE = 0.2
+DECREASE_INTERVAL = 1.0
+
+# A response slower than this many times the fastest seen counts as a sign
+# of overload, as long as it takes more than SLOW_RESPONSE_MIN seconds.
+SLOW_RESPONSE_FACTOR = 4.0
+SLOW_RESPONSE_MIN = 1.0
+
+# Number of reports to send per csv import, or 0 to send each report through
+# the API.  Set from --batch_size.
+BATCH_SIZE = 0
+
+# Number of servers a session keeps connections open to, e.g. several maps.
+MAX_HOSTS = 10
+
+# Counters and histograms for each stage of the upload: rows read and filtered,
+# reports uploaded, rejected and retried, and the time spent fetching files,
+# reading csv rows, parsing times, transforming rows and posting reports.
+# Served from --metrics_port and summarized every --metrics_interval seconds.
+METRICS = UploadMetrics()
+METRICS.describe("rows_read_total", "TtT rows read from csv files.")
+METRICS.describe("rows_filtered_total",
+                 "Rows not wanted by any map, by reason: start_id, event, "
+                 "bad_id or bad_line.")
+METRICS.describe("bytes_skipped_total",
+                 "Bytes of files passed over as below start_ttt_id.")
+METRICS.describe("rows_skipped_total",
+                 "Rows a map already had, by reason: uploaded_ids, journal, "
+                 "duplicate, start_id or unchanged.")
+METRICS.describe("rows_held_total",
+                 "Versions of rows held to merge with later versions.")
+METRICS.describe("report_edits_total",
+                 "Changed rows sent as edits of reports already on a map.")
+METRICS.describe("reports_total", "Rows handled, by map and outcome.")
+METRICS.describe("retries_total", "Reports sent again, by map and status.")
+METRICS.describe("stage_seconds_total",
+                 "Seconds spent in each stage.  post is summed over the "
+                 "upload workers, and transform includes parse_time.")
+METRICS.describe("upload_seconds", "Time for the map server to answer.")
+METRICS.describe("batch_upload_seconds",
+                 "Time for the map server to import a batch of reports.")
+METRICS.describe("fetches_total",
+                 "Requests for TtT files, by status; 304 is unchanged.")
+METRICS.describe("fetch_bytes_total", "Bytes of TtT files downloaded.")
+METRICS.describe("fetch_seconds", "Time to download a TtT file.")
+METRICS.describe("geocode_total",
+                 "Distinct place names looked up, by source: cache, "
+                 "gazetteer or missing.")
+METRICS.describe("rows_geocoded_total",
+                 "Rows without lat lon given one from their location.")
+
+# Shared HTTP sessions for the map server and the TtT server, and the rate
+# limiter for the map server, created on first use.
+_map_session = None
+_ttt_session = None
+_rate_limiter = None
+
+
+def _new_session(pool_size):
+    """ Make a session that keeps up to pool_size connections alive. """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=MAX_HOSTS, pool_maxsize=max(pool_size, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_map_session():
+    """
+    Return the shared session used for requests to the map server.
+
+    Reusing one session keeps connections (and their TLS handshakes) alive
+    between reports, rather than opening a new connection per report.
+    """
+
+    global _map_session
+    if _map_session is None:
+        _map_session = _new_session(CONCURRENCY)
+    return _map_session
+
+
+def get_ttt_session():
+    """ Return the shared session used for requests to the TtT server. """
+
+    global _ttt_session
+    if _ttt_session is None:
+        _ttt_session = _new_session(1)
+    return _ttt_session
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Pace requests to the map server, adapting the rate to how it copes.
+
+    Requests are spaced evenly at the current rate.  Until the server first
+    shows overload, the rate doubles about every second (slow start).  After
+    that it grows by ADDITIVE_INCREASE requests per second for each second of
+    successes (additive increase).  The rate is never raised above twice the
+    rate requests are actually being sent at, so it stays meaningful when
+    the workers, not the limiter, are what hold sending back.  It is halved,
+    at most once per DECREASE_INTERVAL, while more than CONGESTION_ERROR_RATE
+    of recent requests were refused, failed, or were much slower than usual
+    (multiplicative decrease), and sending pauses for as long as the
+    server's Retry-After asks.  An occasional error does not slow things
+    down, as retries take care of it.  Safe to share between threads.
+    """
+
+    def __init__(self, rate=None, max_rate=None, min_rate=None):
+        self.max_rate = max_rate if max_rate is not None else MAX_SEND_RATE
+        self.min_rate = min_rate if min_rate is not None else MIN_SEND_RATE
+        self.rate = rate or INITIAL_SEND_RATE
+        if self.max_rate:
+            self.rate = min(self.rate, self.max_rate)
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+        self.last_decrease = 0
+        self.slow_start = True
+        # Requests sent per second, measured over about a second.
+        self.sent_rate = self.rate
+        self.sent = 0
+        self.sent_since = time.time()
+        # Smoothed fraction of requests that showed overload.
+        self.error_rate = 0.0
+        # Smoothed and best latency of successful requests, in seconds.
+        self.latency = None
+        self.best_latency = None
+
+    def acquire(self):
+        """ Wait for this request's turn to be sent. """
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_time, now)
+            self.next_time = slot + 1.0 / self.rate
+            self.sent += 1
+            if now - self.sent_since >= 1.0:
+                self.sent_rate = self.sent / (now - self.sent_since)
+                self.sent = 0
+                self.sent_since = now
+        if slot > now:
+            time.sleep(slot - now)
+
+    def success(self, latency):
+        """ Record a request the server handled, and how long it took. """
+        with self.lock:
+            if self.latency is None:
+                self.latency = self.best_latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+                self.best_latency = min(self.best_latency, latency)
+            slow = (latency > SLOW_RESPONSE_MIN and
+                    latency > SLOW_RESPONSE_FACTOR * self.best_latency)
+        if slow:
+            self.congestion()
+            return
+        with self.lock:
+            self.error_rate *= 0.98
+            if self.rate < 2 * self.sent_rate:
+                if self.slow_start:
+                    self.rate += 1.0
+                else:
+                    self.rate += ADDITIVE_INCREASE / self.rate
+            if self.max_rate:
+                self.rate = min(self.rate, self.max_rate)
+
+    def congestion(self, retry_after=None):
+        """
+        Record a sign that the server is overloaded.
+
+        @param retry_after: the server's Retry-After header, if any; when
+        the rate is cut, sending also pauses for that long
+        """
+        try:
+            pause = min(RETRY_MAX_DELAY, float(retry_after or 0))
+        except ValueError:
+            pause = 0
+        with self.lock:
+            self.error_rate = 0.98 * self.error_rate + 0.02
+            now = time.time()
+            # Requests in flight together tend to fail together, so allow
+            # time for the last decrease to take effect.
+            if (self.error_rate > CONGESTION_ERROR_RATE and
+                    now - self.last_decrease > DECREASE_INTERVAL):
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.next_time = max(self.next_time, now + pause)
+                # Start afresh, so the next cut waits for new signs of
+                # overload rather than the tail of these.
+                self.error_rate = 0.0
+                self.last_decrease = now
+                self.slow_start = False
+
+
+def get_rate_limiter():
+    """ Return the shared rate limiter for the map server. """
+
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = AdaptiveRateLimiter()
+    return _rate_limiter
+
+
+def retry_delay(attempt, retry_after=None):
+    """ Seconds to wait before resending a report.
+        @param attempt: number of retries already made
+        @param retry_after: the server's Retry-After header, if any
+    """
+
+    # Full jitter keeps workers that failed together from retrying together.
+    delay = random.uniform(
+        0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    if retry_after:
+        try:
+            delay = max(delay, min(RETRY_MAX_DELAY, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
 
 
 def upload_report(
@@ -49,7 +451,30 @@ def upload_report(
     """
     Upload one report.
     """
-    
+
+    payload = make_report_payload(title, desc, udate, uhour, umin, ampm, ucat,
+                                  ulat, ulong, uloc, photo, video)
+    return post_report_payload(payload)
+
+
+def make_report_payload(
+        title,
+        desc,
+        udate,
+        uhour,
+        umin,
+        ampm,
+        ucat,
+        ulat,
+        ulong,
+        uloc,
+        photo,
+        video,
+        ):
+    """
+    Construct the Ushahidi API parameters for one report.
+    """
+
     # Set required parameters for report.
     payload = {'task' : 'report',
                'incident_title'       : title,
@@ -69,26 +494,762 @@ def upload_report(
     if video:
         payload['incident_video'] = video
 
+    return payload
+
+
+def post_report_payload(payload, api_url=None, auth=None):
+    """
+    Send one report's parameters to the Ushahidi API.
+
+    The map's api_url and auth default to the command line settings.
+    """
+
+    if api_url is None:
+        (api_url, auth) = (MAP_API_URL, MAP_AUTH)
+
     #Add report to Ushahidi site
-    result = requests.post(MAP_API_URL, data=payload, **MAP_AUTH)
-    
+    result = get_map_session().post(api_url, data=payload, **(auth or {}))
+
     return(result)
 
 
-def upload_csv_file(csv_contents, log_uploaded=False, log_rejected=True):
+def make_edit_payload(payload, incident_id):
+    """
+    Turn report parameters into an edit of a report already on the map,
+    through the admin API.  Needs an account that may edit reports.
+    """
+
+    payload = dict(payload)
+    payload.update({"task": "reports", "action": "edit",
+                    "incident_id": str(incident_id)})
+    return payload
+
+
+def parse_ttt_time(time_in):
+    """
+    Split a TtT time into the date, hour, minute and am/pm Ushahidi wants.
+
+    @param time_in: time as "m/d/y h:m:s" or "m/d/y h:m", 24 hour clock
+    @return: (udate, uhour, umin, ampm), with uhour from 1 to 12
+    @raise ValueError: if time_in is in neither format
+    """
+
+    match = TIME_RE.match(time_in)
+    if not match:
+        raise ValueError("Unrecognized time %r" % time_in)
+    (month, day, year, hour, minute) = match.groups()
+    hour = int(hour)
+    ampm = "pm" if hour >= 12 else "am"
+    return ("%s/%s/%s" % (month, day, year), str(hour % 12 or 12), minute,
+            ampm)
+
+
+class ReportTransform(object):
+    """
+    Convert TtT rows into Ushahidi report parameters.
+
+    This does no I/O and keeps no state apart from a cache of parsed times,
+    so it can be run (or timed) on rows from anywhere.  Filtering rows by
+    event or id is left to the caller.
+    """
+
+    # Most rows in a file share a timestamp with a recent row, so keep the
+    # parsed times, up to this many.
+    TIME_CACHE_SIZE = 10000
+
+    def __init__(self, category, category_no_lat_lon, default_lat,
+                 default_lon, report_title, default_location="Undefined"):
+        """
+        @param category: category id for reports with a location
+        @param category_no_lat_lon: category id for reports without lat lon
+        @param default_lat: lat for reports without lat lon
+        @param default_lon: lon for reports without lat lon
+        @param report_title: title for rows with no report name
+        @param default_location: location name for rows without one
+        """
+
+        self.category = category
+        self.category_no_lat_lon = category_no_lat_lon
+        self.default_lat = default_lat
+        self.default_lon = default_lon
+        self.report_title = report_title
+        self.default_location = default_location
+        self.times = {}
+
+    def parse_time(self, time_in):
+        """ parse_ttt_time, with parsed times cached. """
+
+        parsed = self.times.get(time_in)
+        if parsed is None:
+            start = time.time()
+            parsed = parse_ttt_time(time_in)
+            METRICS.count("stage_seconds_total", time.time() - start,
+                          stage="parse_time")
+            if len(self.times) >= self.TIME_CACHE_SIZE:
+                self.times.clear()
+            self.times[time_in] = parsed
+        return parsed
+
+    def transform(self, row):
+        """
+        Convert one TtT row.
+
+        @param row: list of the 17 TtT column values
+        @return: dict of Ushahidi API parameters
+        @raise ValueError: if the row's time or id can't be read
+        """
+
+        missing = MISSING_VALUES
+        (udate, uhour, umin, ampm) = self.parse_time(row[COL_TIME])
+
+        #Use location and title data if it exists
+        location = row[COL_LOCATION]
+        if location in missing:
+            location = self.default_location
+        title = row[COL_REPORT]
+        if title in missing:
+            title = self.report_title
+        photo = row[COL_PHOTO]
+        if photo == "NA":
+            photo = ""
+        video = row[COL_VIDEO]
+        if video == "NA":
+            video = ""
+
+        #Create description from text etc
+        # @ToDo: Is it ok to upload Contact and Author, or does that
+        # violate privacy? Could these be uploaded but hidden on the
+        # map?
+        parts = [row[COL_TEXT]]
+        if row[COL_TYPE] != "NA":
+            parts.append("Type: " + row[COL_TYPE])
+        if row[COL_DETAILS] != "NA":
+            parts.append("Details: " + row[COL_DETAILS])
+        parts.append("TweakTheTweet ID is %d" % int(row[COL_ID]))
+        description = " ".join(parts)
+
+        category = self.category
+        lat = row[COL_LAT]
+        lon = row[COL_LONG]
+        if lat in missing:
+            lat = self.default_lat
+            category = self.category_no_lat_lon
+        if lon in missing:
+            lon = self.default_lon
+            category = self.category_no_lat_lon
+
+        return make_report_payload(title, description, udate, uhour, umin,
+                                   ampm, category, lat, lon, location, photo,
+                                   video)
+
+    def transform_batch(self, rows):
+        """
+        Convert a list of TtT rows.
+
+        @return: list of Ushahidi parameter dicts, in the same order as rows,
+        with None for rows that can't be converted
+        """
+
+        transform = self.transform
+        payloads = []
+        for row in rows:
+            try:
+                payloads.append(transform(row))
+            except (ValueError, IndexError):
+                payloads.append(None)
+        return payloads
+
+
+def make_report_transform():
+    """ Make a ReportTransform using the command line settings. """
+
+    return ReportTransform(CATEGORY, CATEGORY_NO_LAT_LON, DEFAULT_LAT,
+                           DEFAULT_LON, REPORT_TITLE)
+
+
+class ReportUploader(object):
+    """
+    Upload reports from a bounded pool of worker threads.
+
+    Reports are queued with submit().  Each is sent at the pace set by the
+    map's AdaptiveRateLimiter, and resent after transient failures (see
+    TRANSIENT_STATUSES) with randomized exponential backoff.  A report
+    waiting to be resent is kept aside with the time it is due, rather than
+    holding up a worker, which sends other reports meanwhile.  Once a report's
+    upload succeeds, fails permanently, or runs out of retries, the
+    handle_result callback is called with the submitted row, the HTTP status
+    code (None if the request failed outright) and the reason.  The callback
+    is always called on the thread that calls submit() or close(), so it can
+    write log files without locking.  Results arrive in completion order,
+    which may differ from submission order when concurrency is above one.
+
+    At most two reports per worker are queued, and workers stop taking new
+    reports while DELAYED_PER_WORKER per worker wait to be resent, so a slow
+    or failing map server makes submit() block rather than letting unsent
+    reports pile up in memory.
+    """
+
+    # Seconds to wait on the queues at a time.  A wait without a timeout
+    # can't be interrupted by Ctrl-C in Python 2.
+    QUEUE_POLL = 0.5
+    # Seconds close() waits for reports already being sent when told to
+    # abandon the rest.
+    ABANDON_WAIT = 5.0
+    # Most tasks per worker to keep waiting to be resent.
+    DELAYED_PER_WORKER = 8
+
+    def __init__(self, handle_result, concurrency=None, retries=None,
+                 route=None):
+        """
+        @param route: MapRoute of the map to upload to; if None, the map from
+        the command line
+        """
+        self.handle_result = handle_result
+        self.concurrency = max(1, concurrency or CONCURRENCY)
+        self.retries = MAX_RETRIES if retries is None else retries
+        if route is None:
+            self.limiter = get_rate_limiter()
+            (self.api_url, self.auth) = (None, None)
+            self.name = "default"
+        else:
+            self.limiter = route.limiter
+            (self.api_url, self.auth) = (route.api_url, route.auth)
+            self.name = route.name
+        self.pending = 0
+        # Heap of (due time, sequence, task, attempt) of tasks to resend.
+        self.delayed = []
+        self.max_delayed = self.DELAYED_PER_WORKER * self.concurrency
+        self.sequence = itertools.count()
+        self.abandoned = False
+        self.lock = threading.Lock()
+        self.workers = []
+        if self.concurrency > 1:
+            self.tasks = Queue.Queue(maxsize=2 * self.concurrency)
+            self.results = Queue.Queue()
+            for i in xrange(self.concurrency):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _send(self, payload):
+        """
+        Post one report, once.
+        @return: (status code, reason, the server's Retry-After header)
+        """
+        self.limiter.acquire()
+        start = time.time()
+        retry_after = None
+        try:
+            result = post_report_payload(payload, self.api_url, self.auth)
+            (status_code, reason) = (result.status_code, result.reason)
+            retry_after = result.headers.get("Retry-After")
+        except requests.RequestException, e:
+            (status_code, reason) = (None, str(e))
+        latency = time.time() - start
+        METRICS.observe("upload_seconds", latency, route=self.name)
+        METRICS.count("stage_seconds_total", latency, stage="post")
+        if status_code not in TRANSIENT_STATUSES:
+            self.limiter.success(latency)
+        elif status_code in CONGESTION_STATUSES:
+            self.limiter.congestion(retry_after)
+        return (status_code, reason, retry_after)
+
+    def _retry(self, task, attempt, status_code, retry_after):
+        """
+        Set a task aside to be resent after a transient failure, unless it is
+        out of retries.
+
+        @param attempt: number of retries already made
+        @return: True if the task will be resent
+        """
+        if status_code not in TRANSIENT_STATUSES or attempt >= self.retries:
+            return False
+        due = time.time() + retry_delay(attempt, retry_after)
+        with self.lock:
+            if self.abandoned:
+                return False
+            heapq.heappush(self.delayed,
+                           (due, next(self.sequence), task, attempt + 1))
+        METRICS.count("retries_total", self._rows(task), route=self.name,
+                      status=status_code)
+        return True
+
+    def _process(self, task, attempt=0):
+        """
+        Upload one task.
+        @return: list of (row, status, reason) of the reports done with; the
+        rest have been set aside to be resent
+        """
+        (row, payload) = task
+        (status_code, reason, retry_after) = self._send(payload)
+        if self._retry(task, attempt, status_code, retry_after):
+            return []
+        return [(row, status_code, reason)]
+
+    def _next_task(self):
+        """
+        Wait for a task to work on: a resend that is due, or a new task once
+        there is room to set more aside.
+        @return: (task, attempt), or None to stop
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.delayed and self.delayed[0][0] <= now:
+                    (due, sequence, task, attempt) = heapq.heappop(
+                        self.delayed)
+                    return (task, attempt)
+                wait = self.QUEUE_POLL
+                if self.delayed:
+                    wait = min(wait, self.delayed[0][0] - now)
+                full = len(self.delayed) >= self.max_delayed
+            if full:
+                time.sleep(wait)
+                continue
+            try:
+                task = self.tasks.get(True, wait)
+            except Queue.Empty:
+                continue
+            if task is None:
+                return None
+            return (task, 0)
+
+    def _work(self):
+        while True:
+            item = self._next_task()
+            if item is None:
+                break
+            for result in self._process(*item):
+                self.results.put(result)
+
+    def _resend_due(self, wait=False):
+        """
+        With no workers, resend the set aside tasks that are due, and wait
+        for more to come due while there is no room to set aside another.
+
+        @param wait: if true, wait for all of them
+        """
+        while self.delayed:
+            now = time.time()
+            if self.delayed[0][0] > now:
+                if not wait and len(self.delayed) < self.max_delayed:
+                    return
+                time.sleep(self.delayed[0][0] - now)
+            (due, sequence, task, attempt) = heapq.heappop(self.delayed)
+            for (row, status_code, reason) in self._process(task, attempt):
+                self.handle_result(row, status_code, reason)
+
+    def _deliver(self, block, deadline=None):
+        """
+        Pass finished uploads to the callback.
+
+        @param block: if true, wait for all pending uploads to finish
+        @param deadline: time after which to stop waiting, or None
+        """
+        while self.pending:
+            try:
+                if block and (deadline is None or time.time() < deadline):
+                    (row, status_code, reason) = self.results.get(
+                        True, self.QUEUE_POLL)
+                else:
+                    (row, status_code, reason) = self.results.get(False)
+            except Queue.Empty:
+                if block and (deadline is None or time.time() < deadline):
+                    continue
+                return
+            self.pending -= 1
+            self.handle_result(row, status_code, reason)
+
+    def _queue(self, task, rows):
+        """ Queue a task holding rows reports, or do it now if no workers. """
+        if not self.workers:
+            for (row, status_code, reason) in self._process(task):
+                self.handle_result(row, status_code, reason)
+            self._resend_due()
+            return
+        while True:
+            try:
+                self.tasks.put(task, True, self.QUEUE_POLL)
+                break
+            except Queue.Full:
+                self._deliver(False)
+        # Counted only once queued, so an interrupted put can't leave close()
+        # waiting for a result that will never come.
+        self.pending += rows
+        self._deliver(False)
+
+    @staticmethod
+    def _rows(task):
+        """ Number of reports in a queued task. """
+        return 1
+
+    def submit(self, row, payload):
+        """ Queue one report for upload. Blocks if the queue is full. """
+        self._queue((row, payload), 1)
+
+    def close(self, abandon=False):
+        """
+        Wait for all queued reports to finish, then stop the workers.
+
+        @param abandon: if true, as when stopping on an error or Ctrl-C,
+        drop the reports not yet started or waiting to be resent, which a
+        restart sends again, and wait at most ABANDON_WAIT seconds for those
+        being sent
+        """
+        if not abandon:
+            if not self.workers:
+                self._resend_due(True)
+            self._deliver(True)
+            for worker in self.workers:
+                self.tasks.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+            return
+        with self.lock:
+            # Reports failing from now on aren't set aside to be resent.
+            self.abandoned = True
+            if self.workers:
+                for (due, sequence, task, attempt) in self.delayed:
+                    self.pending -= self._rows(task)
+            self.delayed = []
+        if not self.workers:
+            return
+        try:
+            while True:
+                self.pending -= self._rows(self.tasks.get_nowait())
+        except Queue.Empty:
+            pass
+        deadline = time.time() + self.ABANDON_WAIT
+        self._deliver(True, deadline)
+        for worker in self.workers:
+            self.tasks.put_nowait(None)
+        # The workers are daemon threads, so any still sending don't keep
+        # the script from exiting.
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.time()))
+        self.workers = []
+
+
+class BatchReportUploader(ReportUploader):
+    """
+    Upload reports in batches through the map's csv import page.
+
+    Reports are gathered into csv files of batch_size rows and posted to
+    admin/reports/upload, as an administrator would upload a spreadsheet,
+    so one request carries a few hundred reports.  Results are still passed
+    to handle_result one row at a time.
+
+    Ushahidi imports a file all or nothing: if any row has an error, none
+    are kept, and the errors give the failing rows' line numbers.  Those
+    rows are rejected and the rest are sent again as a new batch.  If a
+    batch fails with no rows to blame, its rows are sent one at a time
+    through the API instead, as are reports with a photo or video, which
+    the import does not carry.  Needs an account that may import reports.
+    """
+
+    IMPORT_HEADERS = ["INCIDENT TITLE", "INCIDENT DATE", "LOCATION",
+                      "DESCRIPTION", "CATEGORY", "LATITUDE", "LONGITUDE",
+                      "APPROVED", "VERIFIED"]
+
+    # Errors name the failing row as its line, counting the first row after
+    # the headers as line 1.
+    IMPORT_ERROR_RE = re.compile(r"([^<>\n]*on line (\d+)[^<>\n]*)", re.I)
+
+    def __init__(self, handle_result, batch_size, concurrency=None,
+                 retries=None, route=None):
+        """
+        @param batch_size: number of reports per import
+        @param route: MapRoute of the map to upload to; if None, the map from
+        the command line
+        """
+        ReportUploader.__init__(self, handle_result, concurrency, retries,
+                                route)
+        self.batch_size = max(1, batch_size)
+        self.batch = []
+        self.route = route
+        api_url = self.api_url or MAP_API_URL
+        self.import_url = urlparse.urljoin(api_url, "admin/reports/upload")
+        self.login_url = urlparse.urljoin(api_url, "login")
+        self.categories_url = api_url + "?task=categories"
+        self.map_auth = (self.auth if self.api_url else MAP_AUTH) or {}
+        self.session = route.import_session if route else None
+        if self.session is None:
+            # Separate from the API session, as it holds a login cookie.
+            self.session = _new_session(self.concurrency)
+            if route:
+                route.import_session = self.session
+
+    def _category_titles(self):
+        """
+        Get the map's category titles by id.  The import names categories by
+        title, and makes a new category for a title it doesn't know.
+        """
+        titles = self.route.category_titles if self.route else None
+        if titles is None:
+            titles = {}
+            try:
+                result = get_map_session().get(
+                    self.categories_url, timeout=FETCH_TIMEOUT,
+                    **self.map_auth)
+                for item in result.json()["payload"]["categories"]:
+                    category = item["category"]
+                    titles[str(category["id"])] = category["title"].encode(
+                        "utf-8")
+            except (requests.RequestException, ValueError, KeyError,
+                    TypeError), e:
+                print >> sys.stderr, "Could not get categories from %s: %s" % (self.categories_url, e)
+            if self.route:
+                self.route.category_titles = titles
+        return titles
+
+    def _login(self):
+        """ Sign in to the map's admin pages, keeping the cookie. """
+        if "auth" not in self.map_auth:
+            return
+        (user, password) = self.map_auth["auth"]
+        try:
+            self.session.post(
+                self.login_url, timeout=FETCH_TIMEOUT,
+                data={"username": user, "password": password,
+                      "action": "signin", "submit": "Sign In"})
+        except requests.RequestException:
+            pass
+
+    @staticmethod
+    def _is_login_page(result):
+        # A signed out request is redirected to the login form.
+        return "/login" in result.url
+
+    def _import_csv(self, batch):
+        """ Make the import file for a batch. """
+        titles = self._category_titles()
+        fout = cStringIO.StringIO()
+        writer = csv.writer(fout)
+        writer.writerow(self.IMPORT_HEADERS)
+        for (row, payload) in batch:
+            writer.writerow([
+                payload["incident_title"],
+                "%s %s:%s %s" % (payload["incident_date"],
+                                 payload["incident_hour"],
+                                 payload["incident_minute"],
+                                 payload["incident_ampm"]),
+                payload["location_name"],
+                payload["incident_description"],
+                titles.get(payload["incident_category"],
+                           payload["incident_category"]),
+                payload["latitude"],
+                payload["longitude"],
+                "NO",
+                "NO"])
+        return fout.getvalue()
+
+    def _send_batch(self, batch):
+        """
+        Import a batch, once, signing in first if need be.
+        @return: (status code, reason, dict from line number to error, the
+        server's Retry-After header); status 200 with no errors means every
+        row was imported
+        """
+        data = self._import_csv(batch)
+        logged_in = False
+        while True:
+            self.limiter.acquire()
+            start = time.time()
+            retry_after = None
+            try:
+                result = self.session.post(
+                    self.import_url, timeout=FETCH_TIMEOUT,
+                    files={"csvfile": ("ttt_batch.csv", data, "text/csv")},
+                    data={"submit": "Upload"})
+                (status_code, reason) = (result.status_code, result.reason)
+                retry_after = result.headers.get("Retry-After")
+                if status_code == 200 and self._is_login_page(result):
+                    # Not signed in, or the session expired.  If signing in
+                    # doesn't help, the account can't import.
+                    if not logged_in:
+                        self._login()
+                        logged_in = True
+                        continue
+                    return (401, "Could not sign in to import reports", {},
+                            None)
+            except requests.RequestException, e:
+                (status_code, reason) = (None, str(e))
+            latency = time.time() - start
+            METRICS.observe("batch_upload_seconds", latency, route=self.name)
+            METRICS.count("stage_seconds_total", latency, stage="post")
+            if status_code not in TRANSIENT_STATUSES:
+                # Compare the time per report with single uploads.
+                self.limiter.success(latency / len(batch))
+                errors = {}
+                if status_code == 200:
+                    for (text, line) in self.IMPORT_ERROR_RE.findall(
+                            result.text):
+                        errors[int(line)] = text.strip().encode("utf-8")
+                return (status_code, reason, errors, retry_after)
+            if status_code in CONGESTION_STATUSES:
+                self.limiter.congestion(retry_after)
+            return (status_code, reason, {}, retry_after)
+
+    def _process(self, batch, attempt=0):
+        """
+        Upload a batch.
+        @return: list of (row, status, reason) of the reports done with; the
+        rest have been set aside to be resent
+        """
+        results = []
+        while batch:
+            if len(batch) == 1:
+                (row, payload) = batch[0]
+                (status_code, reason, retry_after) = self._send(payload)
+                if not self._retry(batch, attempt, status_code, retry_after):
+                    results.append((row, status_code, reason))
+                break
+            (status_code, reason, errors, retry_after) = self._send_batch(
+                batch)
+            if status_code == 200 and not errors:
+                results.extend((row, 200, "Imported") for (row, payload)
+                               in batch)
+                break
+            if status_code in TRANSIENT_STATUSES:
+                if not self._retry(batch, attempt, status_code, retry_after):
+                    # Out of retries; keep the rows to send again later.
+                    results.extend((row, status_code, reason)
+                                   for (row, payload) in batch)
+                break
+            blamed = [(line, batch[line - 1]) for line in sorted(errors)
+                      if 0 < line <= len(batch)]
+            if not blamed:
+                # Nothing to go on, so let the API judge each row.
+                for item in batch:
+                    results.extend(self._process([item]))
+                break
+            # None were imported.  Reject the bad rows and retry the rest.
+            for (line, (row, payload)) in blamed:
+                results.append((row, 400, errors[line]))
+            bad = set(line for (line, item) in blamed)
+            batch = [item for (line, item) in enumerate(batch, 1)
+                     if line not in bad]
+        return results
+
+    @staticmethod
+    def _rows(task):
+        return len(task)
+
+    def flush(self):
+        """ Queue the reports gathered so far as a batch. """
+        if self.batch:
+            (batch, self.batch) = (self.batch, [])
+            self._queue(batch, len(batch))
+
+    def submit(self, row, payload):
+        """ Add one report to the batch, queueing the batch once full. """
+        if ("incident_photo" in payload or "incident_video" in payload or
+                "incident_id" in payload):
+            # Send on its own through the API, which takes media and edits.
+            self._queue([(row, payload)], 1)
+            return
+        self.batch.append((row, payload))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def close(self, abandon=False):
+        """
+        Send the last batch, and wait for all reports to finish.
+
+        @param abandon: if true, drop the last batch and the reports not yet
+        started; see ReportUploader.close
+        """
+        if not abandon:
+            self.flush()
+        ReportUploader.close(self, abandon)
+
+
+def geocode_rows(rows):
+    """
+    Fill in the lat lon of rows that have a location but no GPS fix, using
+    GEOCODER.
+
+    The distinct locations of all the rows are looked up together.  Rows
+    whose location isn't found are left as they are.
+
+    @param rows: list of TtT rows, changed in place
+    @return: list of the rows that were given a lat lon
+    """
+
+    if GEOCODER is None:
+        return []
+    missing = MISSING_VALUES
+    unplaced = [row for row in rows
+                if (row[COL_LAT] in missing or row[COL_LONG] in missing) and
+                row[COL_LOCATION] not in missing]
+    if not unplaced:
+        return []
+    start = time.time()
+    before = dict(GEOCODER.counts)
+    located = GEOCODER.locate_many(row[COL_LOCATION] for row in unplaced)
+    geocoded = []
+    for row in unplaced:
+        location = located.get(row[COL_LOCATION])
+        if location is not None:
+            row[COL_LAT] = "%.5f" % location[0]
+            row[COL_LONG] = "%.5f" % location[1]
+            geocoded.append(row)
+    for (source, value) in GEOCODER.counts.iteritems():
+        if value != before[source]:
+            METRICS.count("geocode_total", value - before[source],
+                          source=source)
+    METRICS.count("rows_geocoded_total", len(geocoded))
+    METRICS.count("stage_seconds_total", time.time() - start,
+                  stage="geocode")
+    return geocoded
+
+
+def wanted_events():
+    """
+    Return the set of events some map wants, or None if a map takes every
+    event.
+    """
+    if [route for route in ROUTES if route.events is None]:
+        return None
+    events = set()
+    for route in ROUTES:
+        events.update(route.events)
+    return events
+
+
+def reader_min_id():
+    """
+    Return the least TtT id to read from a file: START_TTT_ID, or None if
+    some map takes updates, as an updated row comes again with its old id.
+    Maps that don't take updates then pass over the rows below START_TTT_ID
+    themselves.
+    """
+    if [route for route in ROUTES if route.states is not None]:
+        return None
+    return START_TTT_ID
+
+
+def upload_csv_file(csv_contents, log_uploaded=False, log_rejected=True,
+                    name=None):
     """ Upload TweakTheTweet output csv into Ushahidi via Ushahidi API
 
     @param csv_contents: The contents of the csv file, either as an open File
-    object or as a list of strings, suitable for processing with csv.reader().
+    object or as a list of strings, suitable for processing with csv.reader(),
+    or the path of a local file, which is read through a memory map.
+    @param name: The URL or path of the file, used to resume it after a
+    restart.  If not given, progress through the file is not journaled.
     @param: log_uploaded: If true, lines that were successfully uploaded to the
     Ushahidi server are written to file OUTFILE_UPLOADED.
     @param: log_rejected: If true, lines that were rejected by the Ushahidi
     server are written to file OUTFILE_REJECTED.
 
-    The Ushahidi upload function is currently non-functional, so instead,
-    each row of the TtT csv file is submitted separately via the Ushahidi API,
-    described here:
+    By default, each row of the TtT csv file is submitted separately via the
+    Ushahidi API, described here:
     https://wiki.ushahidi.com/display/WIKI/Ushahidi+Public+API#UshahidiPublicAPI-SubmittingaReport
+    If the map's batch_size is set, rows are instead sent in batches through
+    the Ushahidi csv import page (see BatchReportUploader).
 
     @ToDo:
     Eventually, the plan is to have TtT call the Ushahidi API directly rather
@@ -108,139 +1269,730 @@ def upload_csv_file(csv_contents, log_uploaded=False, log_rejected=True):
     #               "COMPLETE", "GPS_Lat", "GPS_Long", "Photo", "Video",
     #               "Author", "ID"]
     
+    # Only rows some map wants are built in full.
+    events = wanted_events()
+    journal = JOURNAL if name is not None else None
+    if isinstance(csv_contents, basestring):
+        # Pick up a local file where it was left, if it was cut short.
+        start_offset = 0
+        if journal is not None and journal.file_name == name:
+            start_offset = journal.offset
+        reader = MappedTweakTheTweetCSVReader(csv_contents, events=events,
+                                              min_id=reader_min_id(),
+                                              ids_ascending=IDS_ASCENDING,
+                                              start_offset=start_offset)
+    else:
+        reader = TweakTheTweetCSVReader(csv_contents, events=events,
+                                        min_id=reader_min_id(),
+                                        ids_ascending=IDS_ASCENDING)
+    # Only a mapped file has offsets to save.
+    checkpoints = journal is not None and hasattr(reader, "offset")
+
+    # Rows are rearranged into the usual TtT column order.
+    headers = reader.headers
+
+    if journal is not None:
+        journal.begin_file(name)
+
+    # Each row is read once, and handed to the maps that want its event.
+    (uploads, uploads_by_event, uploads_for_all) = start_route_uploads(
+        headers, log_uploaded, log_rejected, journal)
+
+    metrics = METRICS
+    # Reader counts already added to the metrics.
+    published = {}
+
+    def publish():
+        for (name, value, labels) in (
+                ("rows_read_total", reader.rows_read, {}),
+                ("rows_filtered_total", reader.filtered_id,
+                 {"reason": "start_id"}),
+                ("rows_filtered_total", reader.filtered_event,
+                 {"reason": "event"}),
+                ("rows_filtered_total", reader.filtered_bad_id,
+                 {"reason": "bad_id"}),
+                ("bytes_skipped_total", reader.bytes_skipped, {})):
+            key = (name, labels.get("reason"))
+            if value != published.get(key, 0):
+                metrics.count(name, value - published.get(key, 0), **labels)
+                published[key] = value
+
+    # Rows sent on and waiting for an outcome, in order, as (offset at or
+    # before the row, [(route name, TtT id)]).
+    pending = collections.deque()
+
+    def dispatch(batch):
+        for (id_in, event_in, row, offset) in batch:
+            sent = []
+            for upload in uploads_by_event.get(event_in, ()):
+                if upload.submit(row, id_in):
+                    sent.append((upload.route.name, id_in))
+            for upload in uploads_for_all:
+                if upload.submit(row, id_in):
+                    sent.append((upload.route.name, id_in))
+            if checkpoints and sent:
+                pending.append((offset, sent))
+
+    def checkpoint():
+        """ Save the offset before which every row has an outcome. """
+        # Rows before it may only be held, not yet sent.
+        for upload in uploads:
+            upload.flush()
+        done = journal.done
+        while pending and all(pair in done for pair in pending[0][1]):
+            pending.popleft()
+        if pending:
+            journal.record_offset(pending[0][0])
+        elif batch:
+            # Not sent on yet, as it waits to be geocoded.
+            journal.record_offset(batch[0][3])
+        else:
+            journal.record_offset(reader.offset)
+
+    # Between blocks, the mapped reader gives None, so the offset is saved
+    # even through a long stretch of rows no map wants.
+    rows = reader.rows(True) if checkpoints else reader.rows()
+    kept = 0
+    if checkpoints:
+        (checkpoint_offset, checkpoint_time) = (reader.offset, time.time())
+    # Rows are held until a batch of them has been geocoded.
+    batch = []
+    batch_size = GEOCODE_BATCH_SIZE if GEOCODER is not None else 1
+    finished = False
+    try:
+        while True:
+            # Time reading, splitting and filtering rows, which for a
+            # streamed file includes waiting for it to download.
+            start = time.time()
+            # The reader's offset is at or before the start of the next row.
+            offset = reader.offset if checkpoints else None
+            try:
+                item = rows.next()
+            except StopIteration:
+                break
+            now = time.time()
+            metrics.count("stage_seconds_total", now - start, stage="csv")
+            if item is not None:
+                batch.append(item + (offset,))
+                kept += 1
+                if kept % 1000 == 0:
+                    publish()
+            if checkpoints and (
+                    reader.offset - checkpoint_offset >= CHECKPOINT_BYTES or
+                    now - checkpoint_time >= CHECKPOINT_SECONDS):
+                checkpoint()
+                (checkpoint_offset, checkpoint_time) = (reader.offset, now)
+            if len(batch) >= batch_size:
+                geocode_rows([row for (id_in, event_in, row, offset)
+                              in batch])
+                dispatch(batch)
+                batch = []
+        geocode_rows([row for (id_in, event_in, row, offset) in batch])
+        dispatch(batch)
+        finished = True
+    finally:
+        publish()
+        for upload in uploads:
+            upload.close(abandon=not finished)
+        reader.close()
+
+    # Last TtT id found in this file.
+    return reader.last_id or 1
+
+
+def start_route_uploads(headers, log_uploaded, log_rejected, journal,
+                        append=False):
+    """
+    Start a RouteUpload for each map.
+
+    @param append: If true, rows are logged after those already in the log
+    files, rather than replacing them.
+    @return: (list of all the RouteUploads, dict from event to the
+    RouteUploads for that event, list of RouteUploads that take every event)
+    """
+    uploads = [RouteUpload(route, headers, log_uploaded, log_rejected,
+                           journal, append)
+               for route in ROUTES]
+    uploads_by_event = {}
+    uploads_for_all = []
+    for upload in uploads:
+        if upload.route.events is None:
+            uploads_for_all.append(upload)
+        else:
+            for event in upload.route.events:
+                uploads_by_event.setdefault(event, []).append(upload)
+    return (uploads, uploads_by_event, uploads_for_all)
+
+
+def release_held_reports(everything=False):
+    """
+    Send the rows held for maps that take updates whose window has passed,
+    e.g. while waiting for the next file.
+
+    @param everything: if true, send all held rows, e.g. before a one-off
+    run exits
+    """
+    now = time.time()
+    for route in ROUTES:
+        if route.states is None:
+            continue
+        due = route.states.next_due()
+        if due is None or (due > now and not everything):
+            continue
+        upload = RouteUpload(route, TweakTheTweetCSVReader.TTT_HEADERS,
+                             False, True, append=True)
+        finished = False
+        try:
+            upload.release(everything)
+            finished = True
+        finally:
+            upload.close(abandon=not finished)
+
+
+def upload_tweet_stream(source, batch_size, max_wait):
+    """
+    Upload tweets from a live stream of JSON lines as they arrive.
+
+    Tweets are gathered into small batches, and each batch is uploaded like
+    a small csv file: begun and ended in the journal, and logged by
+    appending to the uploaded and rejected files.  A batch is sent once it
+    holds batch_size tweets, or max_wait seconds after its first tweet came,
+    so a tweet reaches the map within seconds while the per-batch costs are
+    shared out when tweets come fast.
+
+    Runs until the source ends, which for a socket or a followed file is
+    never, unless the reader is stopped.
+
+    @param source: "tcp://host:port", a file path, or "-" for stdin; see
+    JSONLinesTweetReader
+    @param batch_size: most tweets per batch
+    @param max_wait: most seconds to hold a tweet before sending it
+    """
+
+    global START_TTT_ID
+
+    events = wanted_events()
+    reader = JSONLinesTweetReader(source, events=events,
+                                  min_id=START_TTT_ID)
+    headers = reader.headers
+    read = {}
+    for batch in reader.batches(batch_size, max_wait):
+        start = time.time()
+        JOURNAL.begin_file(source)
+        geocode_rows([tweet.extra["row"] for tweet in batch])
+        (uploads, uploads_by_event, uploads_for_all) = start_route_uploads(
+            headers, False, True, JOURNAL, append=True)
+        finished = False
+        try:
+            for tweet in batch:
+                (id_in, event_in, row) = (tweet.extra["id"],
+                                          tweet.extra["event"],
+                                          tweet.extra["row"])
+                for upload in uploads_by_event.get(event_in, ()):
+                    upload.submit(row, id_in)
+                for upload in uploads_for_all:
+                    upload.submit(row, id_in)
+            finished = True
+        finally:
+            for upload in uploads:
+                upload.close(abandon=not finished)
+        last_id = max(tweet.extra["id"] for tweet in batch)
+        JOURNAL.end_file(last_id)
+        # Where to restart.  The reader itself passes over tweets sent again,
+        # e.g. by a relay after a reconnect, even within a batch.
+        START_TTT_ID = JOURNAL.next_ttt_id
+        for (name, value, labels) in (
+                ("rows_read_total", reader.rows_read, {}),
+                ("rows_filtered_total", reader.filtered_id,
+                 {"reason": "start_id"}),
+                ("rows_filtered_total", reader.filtered_event,
+                 {"reason": "event"}),
+                ("rows_filtered_total", reader.bad_lines,
+                 {"reason": "bad_line"})):
+            key = (name, labels.get("reason"))
+            if value != read.get(key, 0):
+                METRICS.count(name, value - read.get(key, 0), **labels)
+                read[key] = value
+        print >> sys.stderr, "Uploaded %d tweets through id %d in %.1fs" % (
+            len(batch), last_id, time.time() - start)
+
+
+class MapRoute(object):
+    """
+    One map to upload to, the TtT events that go to it, and its settings.
+    """
+
+    def __init__(self, name, events, api_url, auth, transform,
+                 outfile_uploaded, outfile_rejected, outfile_dead_letter,
+                 uploaded_ids=None, clusters=None, limiter=None,
+                 batch_size=0, states=None):
+        """
+        @param name: name of the route, for messages
+        @param events: collection of lowercase event names without "#", or
+        None to take every event
+        @param api_url: URL of the map's API
+        @param auth: dict of auth arguments for requests, may be empty
+        @param transform: ReportTransform with the map's categories, etc.
+        @param outfile_uploaded: path for the log of uploaded rows
+        @param outfile_rejected: path for the log of rejected rows
+        @param outfile_dead_letter: path for rows that could not be sent
+        @param uploaded_ids: UploadedIdIndex of rows already sent to this
+        map, or None
+        @param clusters: NearDuplicateIndex, if only one of a group of
+        retweets should be sent, or None
+        @param limiter: AdaptiveRateLimiter for this map's server
+        @param batch_size: number of reports to send per csv import, or 0 to
+        send each report through the API
+        @param states: ReportStateTable of the version of each row on this
+        map, to merge and update rows seen more than once, or None
+        """
+        self.name = name
+        self.events = frozenset(events) if events is not None else None
+        self.api_url = api_url
+        self.auth = auth
+        self.transform = transform
+        self.outfile_uploaded = outfile_uploaded
+        self.outfile_rejected = outfile_rejected
+        self.outfile_dead_letter = outfile_dead_letter
+        self.uploaded_ids = uploaded_ids
+        self.clusters = clusters
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.batch_size = batch_size
+        self.states = states
+        # Signed in session and category titles for csv imports, kept from
+        # one file to the next.
+        self.import_session = None
+        self.category_titles = None
+
+    def close(self):
+        if self.uploaded_ids is not None:
+            self.uploaded_ids.close()
+        if self.states is not None:
+            self.states.close()
+
+
+class RouteUpload(object):
+    """
+    Upload the rows of one csv file that are routed to one map.
+
+    Owns the map's upload workers and log files for the file.
+    """
+
     ERROR_HEADERS = ["Status", "Reason"]
-    DEFAULT_LOCATION = "Undefined"
-    
-    last_ttt_id = 1  # last TtT id found in this file
-
-    csvReader = csv.reader(csv_contents)
-    if log_uploaded:
-        fout_uploaded = open(OUTFILE_UPLOADED, 'wb')
-        csvWriter_uploaded = csv.writer(fout_uploaded)
-    if log_rejected:
-        fout_rejected = open(OUTFILE_REJECTED, 'wb')
-        csvWriter_rejected = csv.writer(fout_rejected)
-
-    #Pull in TTT file and convert it to Ush format
-    headers = csvReader.next()
-    if log_uploaded:
-        csvWriter_uploaded.writerow(headers)
-    if log_rejected:
-        headers_rejected = headers + ERROR_HEADERS
-        csvWriter_rejected.writerow(headers_rejected)
-
-    for row in csvReader:
-        event_in      = row[0]
-        type_in       = row[1]
-        report_in     = row[2]
-        time_in       = row[3]
-        loc_in        = row[4]
-        text_in       = row[5]
-        #contact_in    = row[6]
-        details_in    = row[7]
-        #datetime_in   = row[8]
-        #source_in     = row[9]
-        #complete_in   = row[10]
-        lat_in        = row[11]
-        long_in       = row[12]
-        photo_in      = row[13]
-        video_in      = row[14]
-        #auth_in       = row[15]
-        id_in         = int(row[16])
-
-        if id_in > last_ttt_id:
-            last_ttt_id = id_in
-
-        event_in = event_in.lstrip("#").lower()
-        if (EVENTNAMES and (event_in in EVENTNAMES) and (id_in >= START_TTT_ID)):
-            #Use location and title data if it exists
-            if loc_in == "NA" or loc_in == "":
-                location = DEFAULT_LOCATION
-            else:
-                location = loc_in
-            if report_in == "NA" or report_in == "":
-                title = REPORT_TITLE
-            else:
-                title = report_in
-            if photo_in =="NA":
-                photo_in = ""
-            if video_in == "NA":
-                video_in = ""
-
-            #Create description from text etc
-            description = text_in
-            #if photo_in != "NA":
-            #    description += "Photo: " + photo_in
-            #if video_in != "NA":
-            #    description += "Video: " + video_in
-            if type_in != "NA":
-                description += " Type: " + type_in
-            if details_in != "NA":
-                description += " Details: " + details_in
-            description += " TweakTheTweet ID is " + id_in
-
-            # @ToDo: Is it ok to upload Contact and Author, or does that
-            # violate privacy? Could these be uploaded but hidden on the
-            # map?
-            
-            # @ToDo: Split datetime_in into udate, uhour, umin, ampm
-            #FIXIT: need to deal with dates in formats
-            #"a/b/c d:e:f" and "a/b/c d:e"
-            #timearr = re.findall("(.+?)/(.+?)/(.+?) (.+?):(.+?)[:(.+?)]?", time_in)
-            timearr = re.findall("(.+?)/(.+?)/(.+?) (.+?):(.+?):(.+?)", time_in)
-            udate = timearr[0][0] + "/" + timearr[0][1] + "/" + timearr[0][2]
-            uhour = timearr[0][3]
-            umin = timearr[0][4]
-            if int(uhour) > 12:
-                ampm = "pm"
-                uhour = str(int(uhour) - 12)
-            else:
-                ampm = "am"
-
-            category = CATEGORY
-            if lat_in == "NA" or lat_in == "":
-                lat_in = DEFAULT_LAT
-                category = CATEGORY_NO_LAT_LON
-            if long_in == "NA" or long_in == "":
-                long_in = DEFAULT_LON
-                category = CATEGORY_NO_LAT_LON
-
-            result = upload_report(
-                title,
-                description,
-                udate,
-                uhour,
-                umin,
-                ampm,
-                category,
-                lat_in,
-                long_in,
-                location,
-                #first,
-                #last,
-                #email,
-                photo_in,
-                video_in,
-                #news
-                )
-            
-            # Well...did it work?
-            if result.status_code == 200:
-                # WooHoo!
-                if log_uploaded:
-                    csvWriter_uploaded.writerow(row)
-            else:
-                if log_rejected:
-                    row.append(result.status_code)
-                    row.append(result.reason)
-                    csvWriter_rejected.writerow(row)
 
-    if log_uploaded:
-        fout_uploaded.close()
-    if log_rejected:
-        fout_rejected.close()
+    def __init__(self, route, headers, log_uploaded, log_rejected,
+                 journal=None, append=False):
+        """
+        @param route: the MapRoute
+        @param headers: the csv file's headers
+        @param log_uploaded: If true, rows that were uploaded are written to
+        the route's uploaded file.
+        @param log_rejected: If true, rows that were rejected are written to
+        the route's rejected file.
+        @param journal: UploadJournal to record each row's outcome in, or None
+        @param append: If true, add to the log files rather than replacing
+        them, writing the headers only to a new file.
+        """
+        self.route = route
+        self.headers = headers
+        self.journal = journal
+        # TtT ids of the rows of the file held so far.
+        self.held_ids = set()
+        self.writer_uploaded = None
+        self.writer_rejected = None
+        if log_uploaded:
+            (self.fout_uploaded, self.writer_uploaded) = self._open_log(
+                route.outfile_uploaded, headers, append)
+        if log_rejected:
+            (self.fout_rejected, self.writer_rejected) = self._open_log(
+                route.outfile_rejected, headers + self.ERROR_HEADERS, append)
+        if route.batch_size:
+            self.uploader = BatchReportUploader(
+                self.handle_result, route.batch_size, route=route)
+        else:
+            self.uploader = ReportUploader(self.handle_result, route=route)
 
-    return last_ttt_id
+    @staticmethod
+    def _open_log(path, headers, append):
+        new_file = not append or not os.path.exists(path) or \
+            os.path.getsize(path) == 0
+        fout = open(path, 'ab' if append else 'wb')
+        writer = csv.writer(fout)
+        if new_file:
+            writer.writerow(headers)
+        return (fout, writer)
+
+    def record(self, row, outcome):
+        METRICS.count("reports_total", route=self.route.name, outcome=outcome)
+        if self.journal is not None:
+            self.journal.record_row(self.route.name, int(row[COL_ID]), outcome)
+        states = self.route.states
+        if states is not None:
+            if outcome == "uploaded":
+                states.record(int(row[COL_ID]), states.digest(row))
+            states.settle(int(row[COL_ID]))
+
+    def reject(self, row, status_code, reason):
+        if self.writer_rejected:
+            self.writer_rejected.writerow(row + [status_code, reason])
+        self.record(row, "rejected")
+
+    def handle_result(self, row, status_code, reason):
+        # Well...did it work?
+        if status_code == 200:
+            # WooHoo!
+            if self.route.uploaded_ids is not None:
+                self.route.uploaded_ids.add(int(row[COL_ID]))
+            if self.writer_uploaded:
+                self.writer_uploaded.writerow(row)
+            self.record(row, "uploaded")
+        elif status_code in TRANSIENT_STATUSES:
+            # Not the report's fault; keep it to send again later.
+            write_dead_letter(self.route.outfile_dead_letter, self.headers,
+                              row, status_code, reason)
+            self.record(row, "dead_letter")
+        else:
+            self.reject(row, status_code, reason)
+
+    def submit(self, row, id_in, prepared=None):
+        """
+        Upload one row, unless it was uploaded before.
+
+        @return: True if the row was queued or rejected, so it will have an
+        outcome in the journal; False if it was skipped
+        @param prepared: (MinHash signature, payload) of the row, worked out
+        elsewhere, e.g. in a backfill process, or None to work them out
+        here.  The signature is only used if the route has clusters.  The
+        payload may be a ValueError from the transform, or None to
+        transform the row here.
+        """
+        route = self.route
+        (signature, payload) = prepared or (None, None)
+        if route.states is not None:
+            return self.hold(row, id_in)
+        if START_TTT_ID is not None and id_in < START_TTT_ID:
+            # Read only for maps that take updates.
+            METRICS.count("rows_skipped_total", route=route.name,
+                          reason="start_id")
+            return False
+        if route.uploaded_ids is not None and id_in in route.uploaded_ids:
+            METRICS.count("rows_skipped_total", route=route.name,
+                          reason="uploaded_ids")
+            return False
+        # Already handled before a restart?
+        if (self.journal is not None and
+                self.journal.is_done(route.name, id_in)):
+            METRICS.count("rows_skipped_total", route=route.name,
+                          reason="journal")
+            return False
+        if payload is None:
+            start = time.time()
+            try:
+                payload = route.transform.transform(row)
+            except ValueError, e:
+                payload = e
+            finally:
+                METRICS.count("stage_seconds_total", time.time() - start,
+                              stage="transform")
+        if isinstance(payload, ValueError):
+            # Not something the map server would accept.  It doesn't claim a
+            # cluster, so a retweet of it that can be sent still is.
+            self.reject(row, None, str(payload))
+            return True
+        # Skip retweets and other near copies of a tweet already sent.
+        if route.clusters is not None:
+            if prepared is None:
+                tweet = TokenizedTweet(row[COL_TEXT], row[COL_AUTHOR])
+                signature = route.clusters.signature(tweet.tokens)
+            (cluster, new_cluster) = route.clusters.add_signature(signature)
+            if not new_cluster:
+                METRICS.count("rows_skipped_total", route=route.name,
+                              reason="duplicate")
+                return False
+        self.uploader.submit(row, payload)
+        return True
+
+    def hold(self, row, id_in):
+        """
+        Hold a row in the route's ReportStateTable, to be sent once later
+        versions have had time to arrive, and send the held rows that are
+        due.
+
+        @return: False, as the row will be sent later, and a restart finds
+        it in the table
+        """
+        route = self.route
+        states = route.states
+        # Only the first row of a record in the file can have been done
+        # before a restart; later ones are later versions.
+        first = id_in not in self.held_ids
+        self.held_ids.add(id_in)
+        if (first and self.journal is not None and
+                self.journal.is_done(route.name, id_in)):
+            METRICS.count("rows_skipped_total", route=route.name,
+                          reason="journal")
+            return False
+        # A record whose first version is still being sent isn't new.
+        if (not states.is_held(id_in) and not states.is_sending(id_in) and
+                states.get(id_in) is None):
+            if route.uploaded_ids is not None and id_in in route.uploaded_ids:
+                # Sent before its state was kept; take this version to be the
+                # one on the map.
+                states.record(id_in, states.digest(row))
+                METRICS.count("rows_skipped_total", route=route.name,
+                              reason="uploaded_ids")
+                return False
+            # Only a new record can be a copy of another.  A version that
+            # can't be sent as it stands doesn't claim a cluster.
+            if route.clusters is not None and self._can_send(row):
+                tweet = TokenizedTweet(row[COL_TEXT], row[COL_AUTHOR])
+                (cluster, new_cluster) = route.clusters.add_signature(
+                    route.clusters.signature(tweet.tokens))
+                if not new_cluster:
+                    METRICS.count("rows_skipped_total", route=route.name,
+                                  reason="duplicate")
+                    return False
+        states.hold(id_in, row)
+        METRICS.count("rows_held_total", route=route.name)
+        self.release()
+        return False
+
+    def _can_send(self, row):
+        """ Whether a row passes the route's transform. """
+        try:
+            self.route.transform.transform(row)
+        except ValueError:
+            return False
+        return True
+
+    def release(self, everything=False):
+        """
+        Send the held rows whose window has passed: as new reports, as edits
+        of reports already on the map, or not at all if unchanged.
+
+        @param everything: if true, send all held rows
+        """
+        route = self.route
+        states = route.states
+        if states is None:
+            return
+        if not everything:
+            due = states.next_due()
+            if due is None or due > time.time():
+                return
+        for (ttt_id, row) in states.release(everything):
+            known = states.get(ttt_id)
+            if known is not None and known[0] == states.digest(row):
+                METRICS.count("rows_skipped_total", route=route.name,
+                              reason="unchanged")
+                states.settle(ttt_id)
+                continue
+            try:
+                payload = route.transform.transform(row)
+            except ValueError, e:
+                self.reject(row, None, str(e))
+                continue
+            if known is not None:
+                incident_id = known[1] or self.find_incident(ttt_id)
+                if incident_id is None:
+                    self.reject(row, None,
+                                "Report for this TtT id not found on the map")
+                    continue
+                payload = make_edit_payload(payload, incident_id)
+                METRICS.count("report_edits_total", route=route.name)
+            self.uploader.submit(row, payload)
+
+    def find_incident(self, ttt_id):
+        """
+        Find the map's incident id for a TtT id already sent.
+
+        Ushahidi doesn't return the id of a new report, so the reports added
+        to the map since the last look are listed, and their ids noted for
+        the TtT ids their descriptions give.
+
+        @return: the incident id, or None if it wasn't found
+        """
+        route = self.route
+        states = route.states
+        api_url = route.api_url or MAP_API_URL
+        auth = (route.auth if route.api_url else MAP_AUTH) or {}
+        incident_ids = {}
+        last_listed = states.last_listed
+        limit = 100
+        while True:
+            try:
+                result = get_map_session().get(
+                    api_url, params={"task": "incidents", "by": "sinceid",
+                                     "id": last_listed, "limit": limit,
+                                     "orderfield": "incidentid", "sort": 0,
+                                     "resp": "json"},
+                    timeout=FETCH_TIMEOUT, **auth)
+                # No reports is given as an error with no payload.
+                incidents = result.json().get("payload", {}).get(
+                    "incidents") or []
+            except (requests.RequestException, ValueError, AttributeError), e:
+                print >> sys.stderr, "Unable to list reports on %s: %s" % (
+                    route.name, e)
+                break
+            for item in incidents:
+                incident = item.get("incident", {})
+                incident_id = int(incident.get("incidentid", 0))
+                match = TTT_ID_RE.search(
+                    incident.get("incidentdescription", ""))
+                if match:
+                    incident_ids[int(match.group(1))] = incident_id
+                last_listed = max(last_listed, incident_id)
+            if len(incidents) < limit:
+                break
+        states.set_incidents(incident_ids, last_listed)
+        return incident_ids.get(ttt_id)
+
+    def flush(self):
+        """
+        Commit the route's held rows, report states and uploaded ids, e.g.
+        before the journal notes that rows of the file are done with.
+        """
+        if self.route.states is not None:
+            self.route.states.flush()
+        if self.route.uploaded_ids is not None:
+            self.route.uploaded_ids.flush()
+
+    def close(self, abandon=False):
+        """
+        Send held rows that are due, wait for uploads to finish, and close
+        the log files.
+
+        @param abandon: if true, as when stopping on an error or Ctrl-C, send
+        nothing more and wait only briefly for uploads in flight
+        """
+        if not abandon:
+            self.release()
+        self.uploader.close(abandon)
+        if abandon and self.route.states is not None:
+            # Hold the dropped rows again, for the next release.
+            self.route.states.restore()
+        self.flush()
+        if self.writer_uploaded:
+            self.fout_uploaded.close()
+        if self.writer_rejected:
+            self.fout_rejected.close()
+
+
+def make_default_route():
+    """ Make a MapRoute for the map and events given on the command line. """
+
+    return MapRoute("default", EVENTNAMES, MAP_API_URL, MAP_AUTH,
+                    make_report_transform(), OUTFILE_UPLOADED,
+                    OUTFILE_REJECTED, OUTFILE_DEAD_LETTER,
+                    uploaded_ids=UPLOADED_IDS, clusters=TWEET_CLUSTERS,
+                    limiter=get_rate_limiter(), batch_size=BATCH_SIZE,
+                    states=REPORT_STATES)
+
+
+def read_routes(path):
+    """ Read a routing table that sends TtT events to maps.
+        @param path: path of the routing file
+        @return: list of MapRoute
+
+        The file has one section per map, named as you like, e.g.:
+
+        [sandy]
+        events = sandy,frankenstorm,njwx,nywx
+        map_url = https://hurricanesandy.crowdmap.com/
+        map_user = joe_mapper
+        map_password = my!really^secure?password
+        category = 11
+        category_no_lat_lon = 12
+
+        events may be * for all events.  Other options are default_lat,
+        default_lon, report_title, uploaded, rejected, dead_letter,
+        uploaded_ids (empty to not track uploaded ids), cluster_retweets
+        (true or false), batch_size, report_states (empty to upload each
+        row once) and update_window.  Options not given come from the
+        command line, except the file paths, which default to the section
+        name followed by _uploaded.csv, _rejected.csv, _dead_letter.csv, and
+        _uploaded_ids.sqlite, and report_states, which defaults to the
+        section name followed by _report_states.sqlite if report_states is
+        given on the command line.
+    """
+
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise IOError("Cannot read routing file %s" % path)
+    routes = []
+    for name in config.sections():
+        def get(option, default):
+            if config.has_option(name, option):
+                return config.get(name, option).strip()
+            return default
+        events = get("events", "")
+        if events == "*":
+            events = None
+        else:
+            events = [event.strip().lstrip("#").lower()
+                      for event in events.split(",") if event.strip()]
+        map_url = get("map_url", MAP_BASE_URL)
+        if not map_url:
+            raise ValueError("No map_url for route %s" % name)
+        if not map_url.endswith("/"):
+            map_url += "/"
+        user = get("map_user", MAP_USER)
+        password = get("map_password", MAP_PASSWORD)
+        auth = {"auth": (user, password)} if user and password else {}
+        transform = ReportTransform(
+            get("category", CATEGORY),
+            get("category_no_lat_lon", CATEGORY_NO_LAT_LON),
+            get("default_lat", DEFAULT_LAT),
+            get("default_lon", DEFAULT_LON),
+            get("report_title", REPORT_TITLE))
+        ids_path = get("uploaded_ids", name + "_uploaded_ids.sqlite")
+        batch_size = int(get("batch_size", BATCH_SIZE))
+        states_path = get("report_states",
+                          name + "_report_states.sqlite"
+                          if REPORT_STATES_FILE else "")
+        states = None
+        if states_path:
+            states = ReportStateTable(
+                states_path, float(get("update_window", UPDATE_WINDOW)),
+                MISSING_VALUES)
+        clusters = None
+        if config.has_option(name, "cluster_retweets"):
+            if config.getboolean(name, "cluster_retweets"):
+                clusters = NearDuplicateIndex()
+        elif TWEET_CLUSTERS is not None:
+            clusters = NearDuplicateIndex()
+        routes.append(MapRoute(
+            name, events, map_url + "api", auth, transform,
+            get("uploaded", name + "_uploaded.csv"),
+            get("rejected", name + "_rejected.csv"),
+            get("dead_letter", name + "_dead_letter.csv"),
+            uploaded_ids=UploadedIdIndex(ids_path) if ids_path else None,
+            clusters=clusters, batch_size=batch_size, states=states))
+    return routes
+
+
+def write_dead_letter(path, headers, row, status_code, reason):
+    """ Append a row whose upload kept failing to a dead letter file.
+        @param path: path of the dead letter file
+        @param headers: the csv file's headers, written if the file is new
+        @param row: the row, to which the status and reason are added
+
+        The dead letter file is appended to across runs, and has the same
+        columns as the rejected file, so it can be uploaded again later with
+        --input_file and --replay_dead_letter.  Its rows are below the
+        restart cache's next TtT id by then, so a plain --input_file would
+        pass over them.
+    """
+
+    new_file = not os.path.exists(path)
+    fout = open(path, "ab")
+    try:
+        writer = csv.writer(fout)
+        if new_file:
+            writer.writerow(headers + ["Status", "Reason"])
+        writer.writerow(row + [status_code, reason])
+    finally:
+        fout.close()
 
 
 def upload_local_csv_file(filepath):
@@ -250,83 +2002,777 @@ def upload_local_csv_file(filepath):
     """
     
     try:
-        fin = open(filepath, 'rb')
-        last_ttt_id = upload_csv_file(fin)
-        fin.close()
-        return last_ttt_id
+        return upload_csv_file(filepath, name=filepath)
     except Exception, e:
         sys.exit("Unable to read csv file %s: %s" % (filepath, e.message))
 
 
-def upload_remote_csv_file(url):
-    """ Read one csv file from the TtT server and upload it.
+def prepare_chunk(task):
+    """
+    Read, filter and transform the rows of one part of a csv file.  Run in a
+    backfill worker process.
+
+    @param task: (path, start offset, end offset, header line, events,
+    min_id, ids_ascending, route specs, permutations), where each route spec
+    is (route name, events or None, ReportTransform, key of the route's
+    cluster permutations or None), and permutations is a dict of key to the
+    permutations of a NearDuplicateIndex
+    @return: (list of (TtT id, event, row, dict of route name to (MinHash
+    signature, payload or ValueError)) in order of id, dict of reader counts
+    and stage times)
+    """
+
+    (path, start, end, header, events, min_id, ids_ascending, specs,
+     permutations) = task
+    fin = open(path, "rb")
+    try:
+        fin.seek(start)
+        text = fin.read(end - start)
+    finally:
+        fin.close()
+    reader = TweakTheTweetCSVReader(cStringIO.StringIO(header + text),
+                                    events=events, min_id=min_id,
+                                    ids_ascending=ids_ascending)
+    parse_time = METRICS.get_count("stage_seconds_total", stage="parse_time")
+    token_hash = NearDuplicateIndex.token_hash
+    transform_seconds = 0.0
+    signature_seconds = 0.0
+    started = time.time()
+    prepared = []
+    for (id_in, event_in, row) in reader.rows():
+        tokens = None
+        signatures = {}
+        routes = {}
+        for (name, route_events, transform, cluster_key) in specs:
+            if route_events is not None and event_in not in route_events:
+                continue
+            signature = None
+            if cluster_key is not None:
+                if cluster_key not in signatures:
+                    if tokens is None:
+                        tokens = TokenizedTweet(row[COL_TEXT],
+                                                row[COL_AUTHOR]).tokens
+                    start_signature = time.time()
+                    signatures[cluster_key] = NearDuplicateIndex.minhash(
+                        [token_hash(token) for token in set(tokens)],
+                        permutations[cluster_key])
+                    signature_seconds += time.time() - start_signature
+                signature = signatures[cluster_key]
+            start_transform = time.time()
+            try:
+                payload = transform.transform(row)
+            except ValueError, e:
+                payload = e
+            transform_seconds += time.time() - start_transform
+            routes[name] = (signature, payload)
+        prepared.append((id_in, event_in, row, routes))
+    prepared.sort(key=lambda item: item[0])
+    counts = {
+        "last_id": reader.last_id,
+        "rows_read": reader.rows_read,
+        "filtered_id": reader.filtered_id,
+        "filtered_event": reader.filtered_event,
+        "filtered_bad_id": reader.filtered_bad_id,
+        "bytes_skipped": reader.bytes_skipped,
+        "csv_seconds": time.time() - started - transform_seconds -
+                       signature_seconds,
+        "transform_seconds": transform_seconds,
+        "parse_time_seconds": METRICS.get_count(
+            "stage_seconds_total", stage="parse_time") - parse_time,
+    }
+    return (prepared, counts)
+
+
+def _ignore_interrupt():
+    # Workers leave Ctrl-C to the main process, which stops them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def backfill_csv_file(filepath, processes):
+    """
+    Upload a large local csv file, reading and transforming its rows in
+    several processes.
+
+    The file is split into parts of whole records, and each part is read,
+    filtered and transformed, and its tweets' MinHash signatures worked
+    out, in a pool of worker processes.  The parts are handed back in file
+    order with their rows in order of id, so a file in order of id (as TtT
+    exports are) is uploaded in that order, and the journal and uploaded
+    ids work as for upload_local_csv_file.  Only a few parts are worked on
+    ahead of the uploads, so memory use does not grow with the file.
+
+    @param filepath: the path of the csv file.
+    @param processes: number of worker processes
+    @return: last TtT id # in file
+    """
+
+    (header, chunks) = TweakTheTweetCSVReader.split_file(filepath,
+                                                         BACKFILL_CHUNK_SIZE)
+    # Check the headers here rather than in every worker.
+    TweakTheTweetCSVReader([header])
+    permutations = {}
+    specs = []
+    for route in ROUTES:
+        cluster_key = None
+        if route.clusters is not None:
+            cluster_key = id(route.clusters)
+            permutations[cluster_key] = route.clusters.permutations
+        specs.append((route.name, route.events, route.transform,
+                      cluster_key))
+    events = wanted_events()
+
+    JOURNAL.begin_file(filepath)
+    (uploads, uploads_by_event, uploads_for_all) = start_route_uploads(
+        list(TweakTheTweetCSVReader.TTT_HEADERS), False, True, JOURNAL)
+    uploads_by_name = dict((upload.route.name, upload) for upload in uploads)
+    state = {"last_id": None}
+
+    def dispatch(result):
+        (prepared, counts) = result
+        state["last_id"] = max(state["last_id"], counts["last_id"])
+        METRICS.count("rows_read_total", counts["rows_read"])
+        for (reason, key) in (("start_id", "filtered_id"),
+                              ("event", "filtered_event"),
+                              ("bad_id", "filtered_bad_id")):
+            if counts[key]:
+                METRICS.count("rows_filtered_total", counts[key],
+                              reason=reason)
+        METRICS.count("bytes_skipped_total", counts["bytes_skipped"])
+        for stage in ("csv", "transform", "parse_time"):
+            METRICS.count("stage_seconds_total",
+                          counts[stage + "_seconds"], stage=stage)
+        # Rows that gain a lat lon are transformed again here.
+        geocoded = set(id(row) for row in geocode_rows(
+            [row for (id_in, event_in, row, routes) in prepared]))
+        for (id_in, event_in, row, routes) in prepared:
+            for (name, (signature, payload)) in routes.iteritems():
+                if id(row) in geocoded:
+                    payload = None
+                uploads_by_name[name].submit(row, id_in, (signature, payload))
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, _ignore_interrupt)
+    pending = collections.deque()
+    finished = False
+    try:
+        for (start, end) in chunks:
+            pending.append(pool.apply_async(prepare_chunk, ((
+                filepath, start, end, header, events, reader_min_id(),
+                IDS_ASCENDING, specs, permutations),)))
+            # Keep the workers busy, but no further ahead of the uploads.
+            if len(pending) > 2 * processes:
+                # A timeout lets Ctrl-C through while waiting.
+                dispatch(pending.popleft().get(86400))
+        while pending:
+            dispatch(pending.popleft().get(86400))
+        pool.close()
+        finished = True
+    finally:
+        pool.terminate()
+        pool.join()
+        for upload in uploads:
+            upload.close(abandon=not finished)
+
+    return state["last_id"] or 1
+
+
+def iter_response_lines(response, chunk_size=STREAM_CHUNK_SIZE):
+    """ Yield the lines of a streamed response as they arrive.
+        @param response: a requests response fetched with stream=True.
+        @param chunk_size: number of bytes to read at a time.
+        @return: generator of utf-8 encoded lines, with line endings kept so
+        csv.reader can rejoin quoted fields that contain newlines.
+
+        The body is decoded incrementally, so a multi-byte character split
+        across chunks is handled, and only one partial line is held at a time.
+    """
+
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(
+        errors="replace")
+    partial = u""
+    for chunk in response.iter_content(chunk_size):
+        partial += decoder.decode(chunk)
+        lines = partial.splitlines(True)
+        # The last piece may be an incomplete line, or a \r whose \n is in
+        # the next chunk, so hold it back.
+        partial = lines.pop() if lines else u""
+        for line in lines:
+            yield line.encode("utf-8")
+    partial += decoder.decode("", final=True)
+    if partial:
+        yield partial.encode("utf-8")
+
+
+def read_fetch_state():
+    """ Get the saved state of recently fetched remote files, if any.
+        @return: dict from url to a dict with the file's "etag" and
+        "last_modified" validators, its local "path", whether the download is
+        "complete" (False if it was cut off and should be resumed), whether it
+        has been "uploaded", and "time" last changed.
+    """
+
+    try:
+        fin = open(CACHE_FILE + FETCH_STATE_SUFFIX, "r")
+        try:
+            states = json.load(fin)
+        finally:
+            fin.close()
+    except (IOError, ValueError):
+        states = {}
+    if not isinstance(states, dict):
+        states = {}
+    return states
+
+
+def write_fetch_state(states):
+    """ Save the state of recently fetched remote files.
+        @param states: dict as returned by read_fetch_state
+    """
+
+    # Forget all but the latest files.
+    if len(states) > FETCH_STATE_SIZE:
+        by_time = sorted(states, key=lambda url: states[url].get("time", 0))
+        for url in by_time[:-FETCH_STATE_SIZE]:
+            del states[url]
+    # Write a new file and rename it over the old one, so a crash while
+    # writing cannot leave a truncated state file.
+    path = CACHE_FILE + FETCH_STATE_SUFFIX
+    cout = open(path + ".tmp", "w")
+    json.dump(states, cout)
+    cout.close()
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".tmp", path)
+
+
+def get_fetch_state(url):
+    """ Get the saved state of one remote file.
+        @return: dict as described in read_fetch_state
+    """
+
+    with _fetch_state_lock:
+        state = {"etag": None, "last_modified": None, "path": None,
+                 "complete": False, "uploaded": False}
+        state.update(read_fetch_state().get(url, {}))
+        return state
+
+
+def update_fetch_state(url, **fields):
+    """ Change and save the state of one remote file. """
+
+    with _fetch_state_lock:
+        states = read_fetch_state()
+        state = states.setdefault(url, {})
+        state.update(fields)
+        state["time"] = time.time()
+        write_fetch_state(states)
+
+
+def conditional_headers(state):
+    """ Get If-None-Match / If-Modified-Since headers for an uploaded file.
+        @param state: dict as returned by get_fetch_state
+        @return: dict of headers, empty if the file was not uploaded before
+    """
+
+    headers = {}
+    if state["uploaded"]:
+        if state["etag"]:
+            headers["If-None-Match"] = state["etag"]
+        if state["last_modified"]:
+            headers["If-Modified-Since"] = state["last_modified"]
+    return headers
+
+
+def fetch_remote_csv_file(url, path):
+    """ Download one csv file from the TtT server to a local file.
         @param url: URL with full path of the csv file.
-        @return: (status_code, last TtT id # in file)
+        @param path: local path to save the file as.
+        @return: (status_code, path of the downloaded file)
+
+        If this url was uploaded before, the request is conditional, and an
+        unchanged file returns status 304 with no body.  If the file was
+        downloaded but not uploaded, say if the script was stopped, the local
+        copy is used.  If the last download of this url was cut off, only the
+        remaining bytes are requested, provided the server's file has not
+        changed.  A status of 200 means the file is complete, whether it came
+        in one piece or was resumed.  If the download is interrupted, the
+        status is None and the partial file is kept for the next attempt.
     """
 
-    last_ttt_id = START_TTT_ID - 1  # In case we can't fetch the file...
-    csv_data = requests.get(url)
+    state = get_fetch_state(url)
+    if (state["complete"] and not state["uploaded"] and state["path"] and
+            os.path.exists(state["path"])):
+        return (200, state["path"])
+
+    partial_path = path + PARTIAL_FILE_SUFFIX
+    headers = conditional_headers(state)
+    offset = 0
+    if (not state["complete"] and state["path"] == path and
+            os.path.exists(partial_path)):
+        offset = os.path.getsize(partial_path)
+    if offset:
+        headers["Range"] = "bytes=%d-" % offset
+        # Only resume if the file hasn't changed; else the server sends it all.
+        validator = state["etag"] or state["last_modified"]
+        if validator:
+            headers["If-Range"] = validator
+
+    start = time.time()
+    try:
+        response = get_ttt_session().get(
+            url, headers=headers, stream=True, timeout=FETCH_TIMEOUT)
+    except requests.RequestException, e:
+        print >> sys.stderr, "Could not fetch %s: %s" % (url, e)
+        return (None, None)
+    finally:
+        METRICS.count("stage_seconds_total", time.time() - start,
+                      stage="fetch")
+
+    if response.status_code == 416:
+        # Our partial file doesn't match the server's; start over.
+        response.close()
+        os.remove(partial_path)
+        update_fetch_state(url, path=None, complete=False)
+        return fetch_remote_csv_file(url, path)
+    if response.status_code not in (200, 206):
+        response.close()
+        return (response.status_code, None)
+    if response.status_code == 206:
+        # The range must begin where our partial file ends, else appending it
+        # would garble the file; start over as for 416.
+        match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != offset:
+            response.close()
+            if not offset:
+                print >> sys.stderr, "Could not fetch %s: unrequested partial content" % url
+                return (None, None)
+            print >> sys.stderr, "Resumed download of %s does not start at byte %d; fetching it again" % (url, offset)
+            os.remove(partial_path)
+            update_fetch_state(url, path=None, complete=False)
+            return fetch_remote_csv_file(url, path)
+
+    if response.status_code == 200:
+        # A new file, or the server would not resume the old one.
+        offset = 0
+        update_fetch_state(
+            url, path=path, complete=False, uploaded=False,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"))
+    fout = open(partial_path, "r+b" if offset else "wb")
+    fout.seek(offset)
+    fout.truncate()
+    received = 0
+    download_start = time.time()
+    try:
+        try:
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                fout.write(chunk)
+                received += len(chunk)
+        finally:
+            fout.close()
+            response.close()
+            now = time.time()
+            METRICS.count("stage_seconds_total", now - download_start,
+                          stage="fetch")
+            METRICS.count("fetch_bytes_total", received)
+            METRICS.observe("fetch_seconds", now - start)
+    except requests.RequestException, e:
+        print >> sys.stderr, "Download of %s was interrupted: %s" % (url, e)
+        return (None, None)
+    # A dropped connection can look like the end of the body, so check that
+    # we got as much as the server said it would send.
+    expected = response.headers.get("Content-Length")
+    if expected is not None and received < int(expected):
+        print >> sys.stderr, "Download of %s was cut off after %d of %s bytes" % (url, received, expected)
+        return (None, None)
+
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(partial_path, path)
+    update_fetch_state(url, complete=True)
+    return (200, path)
+
+
+def upload_fetched_csv_file(url, path):
+    """ Upload a csv file downloaded by fetch_remote_csv_file.
+        @param url: URL the file was fetched from.
+        @param path: local path of the file; it is deleted once uploaded.
+        @return: last TtT id # in file
+    """
+
+    fin = open(path, "rb")
+    try:
+        last_ttt_id = upload_csv_file(fin, name=url)
+    finally:
+        fin.close()
+    update_fetch_state(url, uploaded=True)
+    os.remove(path)
+    return last_ttt_id
+
+
+def report_fetch_status(url, status_code):
+    """ Print why a remote file wasn't read, unless it's expected. """
+
     # @ToDo: are there other status codes that indicate we got a file?
-    if csv_data.status_code == 200:
-        csv_lines = csv_data.text.splitlines()
-        last_ttt_id = upload_csv_file(csv_lines)
-    else:
+    if status_code not in (200, 304, None):
         # Failure to get a file is normal, as the files are produced at
         # intervals.  Print the status for debugging.
         # @ToDo: Are there any status codes that imply there's no chance we'll
         # get a file later?
-        print >> sys.stderr, "Could not fetch %s, got status %d" % (url, csv_data.status_code)
-    return (csv_data.status_code, last_ttt_id)
+        print >> sys.stderr, "Could not fetch %s, got status %d" % (url, status_code)
+
+
+def upload_remote_csv_file(url):
+    """ Read one csv file from the TtT server and upload it.
+        @param url: URL with full path of the csv file.
+        @return: (status_code, last TtT id # in file)
+
+        A status of 304 means the file has not changed since it was last
+        uploaded, and None means it could not be fetched in full.
+    """
+
+    last_ttt_id = START_TTT_ID - 1  # In case we can't fetch the file...
+    if STREAM_FETCH:
+        # Rows are uploaded while the rest of the file is downloading, so an
+        # interrupted download can't be resumed.  Only ask for changed files.
+        try:
+            csv_data = get_ttt_session().get(
+                url, headers=conditional_headers(get_fetch_state(url)),
+                stream=True, timeout=FETCH_TIMEOUT)
+        except requests.RequestException, e:
+            print >> sys.stderr, "Could not fetch %s: %s" % (url, e)
+            return (None, last_ttt_id)
+        status_code = csv_data.status_code
+        if status_code == 200:
+            try:
+                last_ttt_id = upload_csv_file(iter_response_lines(csv_data),
+                                              name=url)
+            except requests.RequestException, e:
+                print >> sys.stderr, "Download of %s was interrupted: %s" % (url, e)
+                return (None, last_ttt_id)
+            finally:
+                csv_data.close()
+            update_fetch_state(
+                url, path=None, complete=True, uploaded=True,
+                etag=csv_data.headers.get("ETag"),
+                last_modified=csv_data.headers.get("Last-Modified"))
+    else:
+        (status_code, csv_path) = fetch_remote_csv_file(url, CACHE_FILE + ".csv")
+        if status_code == 200:
+            last_ttt_id = upload_fetched_csv_file(url, csv_path)
+
+    METRICS.count("fetches_total", status=status_code)
+    report_fetch_status(url, status_code)
+    return (status_code, last_ttt_id)
+
+
+class SequentialFilePrefetcher(threading.Thread):
+    """
+    Download sequential files from the TtT server ahead of the uploader.
+
+    Downloaded files are put on the ready queue as (file number, url, path).
+    The queue holds PREFETCH_DEPTH files, so if the map server falls behind,
+    the fetcher waits rather than filling the disk.  A file that was already
+    uploaded (the server returns 304) is skipped.
+    """
+
+    def __init__(self, first_file_num, depth=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.file_num = first_file_num
+        self.ready = Queue.Queue(maxsize=max(1, depth or PREFETCH_DEPTH))
+        self.stopping = threading.Event()
+
+    def run(self):
+        retries = 0
+        while not self.stopping.is_set():
+            # Construct URL for next file.
+            ttt_url = "%s%d.csv" % (TTT_URL, self.file_num)
+            path = "%s.%d.csv" % (CACHE_FILE, self.file_num)
+            (status_code, path) = fetch_remote_csv_file(ttt_url, path)
+            METRICS.count("fetches_total", status=status_code)
+            if status_code == 200:
+                # Blocks until the uploader is ready for it.
+                self.ready.put((self.file_num, ttt_url, path))
+            if status_code in (200, 304):
+                # Try the next file without waiting, in case we've fallen
+                # behind.
+                retries = 0
+                self.file_num += 1
+            elif status_code is None and retries < FETCH_RETRIES:
+                # The download was cut off; resume it now.
+                retries += 1
+            else:
+                # No file yet, pause.
+                report_fetch_status(ttt_url, status_code)
+                retries = 0
+                self.stopping.wait(FETCH_INTERVAL * 60)
+
+    def stop(self):
+        self.stopping.set()
 
 
 def upload_sequential_remote_csv_files():
-    """ Read sequential files from TtT server and upload them. """
+    """ Read sequential files from TtT server and upload them.
+
+        Unless streaming, the next file is fetched on a separate thread while
+        the current one is uploaded.
+    """
+
+    global START_TTT_ID, START_FILE_NUM
+
+    if STREAM_FETCH:
+        retries = 0
+        while True:
+            # Construct URL for next file.
+            ttt_url = "%s%d.csv" % (TTT_URL, START_FILE_NUM)
+            # Attempt to upload it.
+            (status_code, last_ttt_id) = upload_remote_csv_file(ttt_url)
+            # Did we get it?
+            if status_code in (200, 304):
+                # Yes, go on to the next file without waiting, in case we've
+                # fallen behind.
+                retries = 0
+                JOURNAL.end_file(last_ttt_id, START_FILE_NUM + 1)
+                START_TTT_ID = max(START_TTT_ID, last_ttt_id + 1)
+                START_FILE_NUM += 1
+            elif status_code is None and retries < FETCH_RETRIES:
+                # The download was cut off; resume it now.
+                retries += 1
+            else:
+                # No, pause.
+                retries = 0
+                release_held_reports()
+                time.sleep(FETCH_INTERVAL * 60)
+
+    prefetcher = SequentialFilePrefetcher(START_FILE_NUM)
+    prefetcher.start()
+    try:
+        while True:
+            # Wait with a timeout, so Ctrl-C is not blocked.
+            try:
+                (file_num, ttt_url, path) = prefetcher.ready.get(timeout=1)
+            except Queue.Empty:
+                release_held_reports()
+                continue
+            last_ttt_id = upload_fetched_csv_file(ttt_url, path)
+            JOURNAL.end_file(last_ttt_id, file_num + 1)
+            START_TTT_ID = max(START_TTT_ID, last_ttt_id + 1)
+            START_FILE_NUM = file_num + 1
+    finally:
+        prefetcher.stop()
+
+
+def upload_one_file(path=None, url=None):
+    """
+    Upload one local or remote csv file, and record it as done in the
+    journal.
+
+    @param path: path of a local file, or None
+    @param url: URL of a remote file, if path is None
+    @return: HTTP status of the fetch (200 for a local file), or None if it
+    failed
+    """
+
+    if path and PROCESSES > 1:
+        try:
+            last_ttt_id = backfill_csv_file(path, PROCESSES)
+        except (IOError, ValueError), e:
+            sys.exit("Unable to read csv file %s: %s" % (path, e))
+        JOURNAL.end_file(last_ttt_id)
+        return 200
+    elif path:
+        last_ttt_id = upload_local_csv_file(path)
+        JOURNAL.end_file(last_ttt_id)
+        return 200
+    (status_code, last_ttt_id) = upload_remote_csv_file(url)
+    # The single file case doesn't need the starting file # incremented.
+    if status_code == 200:
+        JOURNAL.end_file(last_ttt_id)
+    return status_code
+
+
+class _ClientStream(object):
+    """
+    Stand-in for sys.stderr while the daemon runs a job: each line is sent
+    to the client as a log message, and also written to the daemon's own
+    stderr.  If the client goes away, the job carries on.
+    """
+
+    def __init__(self, conn, stream):
+        self.conn = conn
+        self.stream = stream
+        self.partial = ""
+        self.lock = threading.Lock()
 
-    while True:
-        # Construct URL for next file.
-        ttt_url = "%s%d.csv" % (TTT_URL, START_FILE_NUM)
-        # Attempt to upload it.
-        (status_code, last_ttt_id) = upload_remote_csv_file(ttt_url)
-        # Did we get it?
-        if status_code != 200:
-            # No, pause.
-            time.sleep(FETCH_INTERVAL * 60)
-        # Next file.
-        START_TTT_ID = last_ttt_id + 1
-        START_FILE_NUM += 1
-        write_cache(START_TTT_ID, START_FILE_NUM)
+    def send(self, message):
+        if self.conn is None:
+            return
+        try:
+            self.conn.sendall(json.dumps(message) + "\n")
+        except socket.error:
+            self.conn = None
 
+    def write(self, text):
+        self.stream.write(text)
+        with self.lock:
+            lines = (self.partial + text).split("\n")
+            self.partial = lines.pop()
+            for line in lines:
+                self.send({"log": line})
 
-def read_cache():
-    """ Get saved next TtT id # and next file sequence number, if any
-        @return: (nest TtT id #, next file sequence number)
+    def flush(self):
+        self.stream.flush()
+
+
+def run_daemon_job(conn):
+    """
+    Read one job from a client connection, run it, and send back its log
+    and result.
+
+    A job is one line of JSON, with input_file (an absolute path) or
+    input_url.  Log lines are sent back as {"log": line}, and then the
+    result, as {"status_code": status, "next_ttt_id": id}, or as
+    {"error": message} if the job could not be run.
     """
 
-    next_nums = {NEXT_TTT_ID_KEY:1, NEXT_FILE_NUM_KEY:1}
+    global START_TTT_ID
+
+    fin = conn.makefile("rb")
     try:
-        cin = open(CACHE_FILE, "r")
-        for line in cin:
-            key_val = line.split()
-            if len(key_val) == 2:
-                next_nums[key_val[1]] = int(key_val[2])
-        cin.close()
-    except:
-        pass
-    return next_nums
-
-
-def write_cache(last_ttt_id, last_file_num):
-    """ Save next TtT id # and next file sequence number for restart
-        @param last_ttt_id: Last TtT id encountered in processed files
-        @param last_file_num: Sequence number of last processed file
-    """
-
-    next_ttt_id = last_ttt_id + 1 if last_ttt_id >= START_TTT_ID else START_TTT_ID
-    next_file_num = last_file_num + 1 if last_file_num >= START_FILE_NUM else START_FILE_NUM
-    cout = open(CACHE_FILE, "w")
-    cout.write("%s %d\n" % (NEXT_TTT_ID_KEY, next_ttt_id))
-    cout.write("%s %d\n" % (NEXT_FILE_NUM_KEY, next_file_num))
-    cout.close()
+        job = json.loads(fin.readline())
+        (path, url) = (job.get("input_file"), job.get("input_url"))
+    except (ValueError, AttributeError):
+        (path, url) = (None, None)
+    finally:
+        fin.close()
+    stream = sys.stderr
+    client = _ClientStream(conn, stream)
+    if bool(path) == bool(url):
+        client.send({"error": "Specify either input_file or input_url."})
+        return
+    sys.stderr = client
+    try:
+        print >> sys.stderr, "Uploading %s" % (path or url)
+        status_code = upload_one_file(path, url)
+        result = {"status_code": status_code,
+                  "next_ttt_id": JOURNAL.next_ttt_id}
+    except SystemExit, e:
+        result = {"error": str(e.code)}
+    except Exception, e:
+        traceback.print_exc(file=stream)
+        result = {"error": "%s: %s" % (e.__class__.__name__, e)}
+    finally:
+        sys.stderr = stream
+    if client.partial:
+        client.send({"log": client.partial})
+    # The next job starts where this one left off.
+    START_TTT_ID = JOURNAL.next_ttt_id
+    client.send(result)
+
+
+def serve_daemon(path):
+    """
+    Take upload jobs from clients on a Unix socket, one at a time, until
+    stopped.
+
+    Between jobs, the HTTP sessions, restart journal, uploaded ids, retweet
+    clusters and geocoding cache stay loaded, so a job from a cron run of
+    importttt_client.py costs only its own upload.  Rows held for updates
+    are sent as they come due, between jobs as well.
+
+    @param path: path of the socket; only the daemon's user may connect
+    """
+
+    if not hasattr(socket, "AF_UNIX"):
+        sys.exit("--daemon needs Unix sockets, which this system lacks.")
+    if os.path.exists(path):
+        # Left by a daemon that was killed, unless one is listening.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)
+        else:
+            sys.exit("A daemon is already listening on %s." % path)
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(5)
+    # Wake up now and then to send rows held for updates, and to see if
+    # we've been told to stop.
+    listener.settimeout(1)
+    # Let a plain kill remove the socket, once the job or uploads in hand
+    # are done; stopping in the middle of them could leave the uploader
+    # waiting for a report that was never queued.
+    stopping = []
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: stopping.append(signum))
+    print >> sys.stderr, "Waiting for jobs on %s" % path
+    try:
+        while not stopping:
+            try:
+                (conn, address) = listener.accept()
+            except socket.timeout:
+                release_held_reports()
+                continue
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            conn.settimeout(None)
+            try:
+                run_daemon_job(conn)
+            except socket.error, e:
+                print >> sys.stderr, "Lost client: %s" % e
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def metrics_summary(metrics, elapsed, last):
+    """ Make the periodic summary line for MetricsLogger.
+        @param metrics: UploadMetrics
+        @param elapsed: seconds since the last summary
+        @param last: dict of counts at the last summary, updated here
+        @return: the line
+    """
+
+    rows = metrics.get_count("rows_read_total")
+    uploaded = metrics.get_count("reports_total", outcome="uploaded")
+    rate = (rows - last.get("rows", 0)) / elapsed if elapsed else 0.0
+    upload_rate = ((uploaded - last.get("uploaded", 0)) / elapsed
+                   if elapsed else 0.0)
+    last["rows"] = rows
+    last["uploaded"] = uploaded
+
+    def ms(fraction):
+        value = metrics.quantile("upload_seconds", fraction)
+        return "-" if value is None else "%.0fms" % (1000 * value)
+
+    stages = " ".join(
+        "%s %.1fs" % (stage, metrics.get_count("stage_seconds_total",
+                                               stage=stage))
+        for stage in ("fetch", "csv", "parse_time", "transform", "post"))
+    return ("%s rows read %d (%.1f/s), filtered %d, skipped %d; reports "
+            "uploaded %d (%.1f/s), rejected %d, dead letter %d, retries %d; "
+            "upload p50 %s p99 %s; time in %s" % (
+                time.strftime("%Y-%m-%d %H:%M:%S"), rows, rate,
+                metrics.get_count("rows_filtered_total"),
+                metrics.get_count("rows_skipped_total"),
+                uploaded, upload_rate,
+                metrics.get_count("reports_total", outcome="rejected"),
+                metrics.get_count("reports_total", outcome="dead_letter"),
+                metrics.get_count("retries_total"), ms(0.5), ms(0.99),
+                stages))
 
 
 # Sample command line:
@@ -355,6 +2801,10 @@ if __name__ == '__main__':
         python importttt.py
             --input_file [input csv file path, for a local file]
             --input_url [input csv URL file or prefix, for remote file(s)]
+            --input_stream [tcp://host:port, file or - of live tweets as JSON lines]
+            --stream_batch_size [most tweets from input_stream to upload together]
+            --stream_batch_wait [most seconds to hold a tweet from input_stream]
+            --daemon [path of a socket on which to wait for files from importttt_client.py]
             --sequential_files [whether input_url is a prefix & needs <number>.csv postpended]
             --fetch_interval [minutes to wait between fetch requests]
             --start_file_number [first number to postpend to URL if sequential_files is True]
@@ -371,8 +2821,29 @@ if __name__ == '__main__':
             --uploaded [path for file of successful uploads]
             --rejected [path for file of rejected records]
             --cache_file [path of file script can use to store info for restart]
+            --routes [path of file that sends TtT events to different maps]
+            --uploaded_ids [path of file of TtT ids already uploaded]
+            --cluster_retweets [whether to upload only one of each group of retweets]
+            --report_states [path of file of the version of each TtT record on the map, to send updates as edits]
+            --update_window [seconds to hold a TtT record to merge its later versions]
+            --gazetteer [path of GeoNames or csv file of places, to locate records without lat lon]
+            --geocode_cache [path of file of places already located]
+            --dead_letter [path for file of records that failed with server or network errors]
+            --replay_dead_letter [whether input_file is a dead letter file to upload again, whatever its TtT ids]
+            --retries [number of times to resend after a server or network error]
+            --max_rate [most reports per second to send to the map site]
+            --batch_size [number of reports to send per csv import, 0 to send each through the API]
+            --concurrency [number of reports to upload at the same time]
+            --processes [number of processes to read and transform a local input_file]
+            --stream [whether to upload rows of remote files as they download]
+            --ids_ascending [whether TtT files list rows in order of increasing TtT id]
+            --metrics_port [local port to serve upload metrics on for Prometheus]
+            --metrics_interval [seconds between summary lines of upload metrics]
+            --profile [path for cProfile stats of the main thread]
+            --profile_sample [path for sampled stacks of all threads]
         Most incident-specific arguments are required and not defaulted,
-        with the exception that input_file is mutually exclusive with input_url,
+        with the exception that input_file, input_url and input_stream are
+        mutually exclusive, and are not given with daemon,
         and postpend_number and fetch_interval are only relevant with input_url.
         """)
     parser.add_argument(
@@ -380,6 +2851,18 @@ if __name__ == '__main__':
     parser.add_argument(
         "--input_url", dest="input_url",
         help="URL of remote csv file or URL prefix for sequential files.")
+    parser.add_argument(
+        "--input_stream", dest="input_stream",
+        help="Source of live tweets, one JSON object per line, uploaded as they arrive: tcp://host:port to read from a socket (e.g. a relay of the Twitter streaming API), a file path to follow a file as it grows, or - for stdin. Each line may be a Twitter status, whose event is its first hashtag, or an object with the TtT columns as keys. Tweet ids are not TtT ids, so give this its own cache_file.")
+    parser.add_argument(
+        "--stream_batch_size", dest="stream_batch_size", type=int, default=50,
+        help="Most tweets from input_stream to upload together.")
+    parser.add_argument(
+        "--stream_batch_wait", dest="stream_batch_wait", type=float, default=2,
+        help="Most seconds to hold a tweet from input_stream while its batch fills.")
+    parser.add_argument(
+        "--daemon", dest="daemon",
+        help="Path of a Unix socket on which to wait for files to upload, sent by importttt_client.py, e.g. from cron. Files are uploaded one at a time, with the map sessions, restart cache, uploaded ids, retweet clusters and geocoding cache kept loaded between them. Stop it with kill; a file being uploaded is finished first.")
     parser.add_argument(
         "--fetch_interval", dest="fetch_interval", type=int, default=10,
         help="Time in minutes to wait between fetch requests to TtT site. Note if request succeeds and we're reading numbered files, the next file will be tried before waiting, in case this script has fallen behind.")
@@ -415,12 +2898,74 @@ if __name__ == '__main__':
     parser.add_argument(
         "--start_ttt_id", dest="start_ttt_id", type=int, default=1,
         help="TtT id number to begin upload at; only rows with this TtT id or higher will be used. If cache file present, greater of this or value from cache file will be used.")
+    parser.add_argument(
+        "--routes", dest="routes",
+        help="Path of a routing file that sends TtT events to several maps, each with its own account, categories and log files. Each file is read once for all maps. If given, map_url and ttt_events are not needed, and other map options are defaults for the routes.")
+    parser.add_argument(
+        "--uploaded_ids", dest="uploaded_ids", default="ttt_uploaded_ids.sqlite",
+        help="Path of a file in which to record the TtT ids of all rows uploaded, so they are not uploaded again. Use an empty string to upload rows regardless.")
+    parser.add_argument(
+        "--cluster_retweets", dest="cluster_retweets", action="store_true", default=False,
+        help="Include to upload only the first of a group of tweets with nearly the same text, such as retweets.")
+    parser.add_argument(
+        "--report_states", dest="report_states", default="",
+        help="Path of a file in which to keep the version of each TtT record on the map. Records that come again, e.g. in later sequential files as volunteers fill in COMPLETE, Details or the GPS fields, are then held for update_window seconds to merge their versions, and versions that come after are sent as edits of the report on the map, or not at all if nothing changed. Edits need an account that may edit reports. Rows below start_ttt_id are read again for updates. Empty to upload each record once.")
+    parser.add_argument(
+        "--update_window", dest="update_window", type=float, default=60,
+        help="Seconds to hold a TtT record for its later versions, if report_states is given. Held records are kept in report_states, so with sequential_files or daemon they may be held from one file to the next; make this longer than fetch_interval to merge the versions in successive files. A run of one file sends all held records before it exits.")
+    parser.add_argument(
+        "--gazetteer", dest="gazetteer",
+        help="Path of a file of place names and their lat lon, used to locate records that have a Location but no GPS_Lat and GPS_Long. Either a GeoNames dump (e.g. US.txt or cities1000.txt from download.geonames.org/export/dump), or a csv file with columns name, lat, lon and optionally alternate_names and population. Records that are located are given category rather than category_no_lat_lon.")
+    parser.add_argument(
+        "--geocode_cache", dest="geocode_cache", default="ttt_geocode_cache.sqlite",
+        help="Path of a file in which to keep the places located with the gazetteer, so each is looked up once per event. Use an empty string to keep them only in memory.")
+    parser.add_argument(
+        "--stream", dest="stream", action="store_true", default=False,
+        help="Include to upload rows from remote csv files as they download, rather than fetching each whole file first. Keeps memory use bounded for large files.")
+    parser.add_argument(
+        "--ids_ascending", dest="ids_ascending", action="store_true", default=False,
+        help="Include if TtT files list rows in order of increasing TtT id, as the TtT exports do. Then the part of a file below start_ttt_id, e.g. rows already uploaded from a file that grows, is passed over in blocks without being parsed.")
+    parser.add_argument(
+        "--dead_letter", dest="dead_letter", default="ttt_dead_letter.csv",
+        help="Path for file of records that could not be uploaded because of server or network errors. Records are added to the end, and can be uploaded later with --input_file and --replay_dead_letter.")
+    parser.add_argument(
+        "--replay_dead_letter", dest="replay_dead_letter", action="store_true", default=False,
+        help="Include if input_file is a dead letter file to upload again. Its rows are uploaded whatever their TtT ids, rather than only those at or above start_ttt_id and the restart cache's next id, which they are below. Rows that fail again go to dead_letter, so it must be another path.")
+    parser.add_argument(
+        "--retries", dest="retries", type=int, default=5,
+        help="Number of times to resend a report after a server or network error.")
+    parser.add_argument(
+        "--max_rate", dest="max_rate", type=float, default=0,
+        help="Most reports per second to send to the map site. The rate adapts to the site's errors and response time below this. 0 for no limit.")
+    parser.add_argument(
+        "--batch_size", dest="batch_size", type=int, default=0,
+        help="Number of reports to send together through the map site's csv import page (admin/reports/upload), e.g. 200, rather than one request per report through the API. Needs an account that may import reports. Reports with a photo or video are still sent through the API. 0 to send every report through the API.")
+    parser.add_argument(
+        "--concurrency", dest="concurrency", type=int, default=1,
+        help="Number of reports to upload to the map site at the same time.")
+    parser.add_argument(
+        "--processes", dest="processes", type=int, default=1,
+        help="Number of processes that read and transform the rows of input_file, e.g. the number of CPU cores, for backfilling a large file. The file is split into parts that are read in parallel, and rows are uploaded in order of TtT id within each part. 1 to read it in one process.")
+    parser.add_argument(
+        "--metrics_port", dest="metrics_port", type=int, default=0,
+        help="Port on which to serve counts and timings of each upload stage, at /metrics in the Prometheus text format. Only local clients can connect. 0 for none.")
+    parser.add_argument(
+        "--metrics_interval", dest="metrics_interval", type=float, default=0,
+        help="Seconds between summary lines of upload counts and timings, written to stderr. A last summary is written on exit. 0 for none.")
+    parser.add_argument(
+        "--profile", dest="profile",
+        help="Path for cProfile stats of the main thread (reading, filtering and transforming rows), written on exit. Read them with python -m pstats.")
+    parser.add_argument(
+        "--profile_sample", dest="profile_sample",
+        help="Path for stacks of all threads, including upload workers, sampled every 5 ms and written on exit in the collapsed format read by flamegraph.pl.")
     parser.add_argument(
         "--cache_file", dest="cache_file", default="ttt_upload_cache",
-        help="Path of a file that the upload script can use to record the file number and ttt id it last processed. Used if the script is halted and restarted.")
+        help="Path of a file that the upload script can use to record the file number and ttt id it last processed, and which rows of the current file are done. Used if the script is halted and restarted. A journal is kept next to it, with .journal appended.")
     args = vars(parser.parse_args())
     INFILE = args["input_file"]
     TTT_URL = args["input_url"]
+    TWEET_STREAM = args["input_stream"]
+    DAEMON_SOCKET = args["daemon"]
     SEQUENTIAL = args["sequential_files"]
     FETCH_INTERVAL = args["fetch_interval"]
     START_FILE_NUM = args["start_file_number"]
@@ -437,41 +2982,141 @@ if __name__ == '__main__':
     MAP_PASSWORD = args["map_password"]
     # Support no auth for older maps. Ushahidi 2.6 and later require it.
     if MAP_USER and MAP_PASSWORD:
-        MAP_AUTH = {"auth" : "%s@%s" % (MAP_USER, MAP_PASSWORD)}
+        MAP_AUTH = {"auth" : (MAP_USER, MAP_PASSWORD)}
     else:
         MAP_AUTH = {}
     START_TTT_ID = args["start_ttt_id"]
     CACHE_FILE = args["cache_file"]
-    if not MAP_BASE_URL.endswith("/"):
+    CONCURRENCY = args["concurrency"]
+    PROCESSES = args["processes"]
+    OUTFILE_DEAD_LETTER = args["dead_letter"]
+    MAX_RETRIES = args["retries"]
+    MAX_SEND_RATE = args["max_rate"] or None
+    BATCH_SIZE = args["batch_size"]
+    STREAM_FETCH = args["stream"]
+    IDS_ASCENDING = args["ids_ascending"]
+    REPORT_STATES_FILE = args["report_states"]
+    UPDATE_WINDOW = args["update_window"]
+    if args["cluster_retweets"]:
+        TWEET_CLUSTERS = NearDuplicateIndex()
+    if args["gazetteer"]:
+        try:
+            GEOCODER = Geocoder(Gazetteer(args["gazetteer"]),
+                                GeocodeCache(args["geocode_cache"] or None))
+        except (IOError, ValueError), e:
+            sys.exit("Unable to read gazetteer %s: %s" % (args["gazetteer"], e))
+    if MAP_BASE_URL and not MAP_BASE_URL.endswith("/"):
         MAP_BASE_URL += "/"
-    MAP_API_URL = MAP_BASE_URL + "api"
+    MAP_API_URL = MAP_BASE_URL + "api" if MAP_BASE_URL else None
 
-    if (INFILE and TTT_URL) or (not INFILE and not TTT_URL):
-        print >> sys.stderr, "Specify either input_file or ttt_url."
+    sources = len([source for source in (INFILE, TTT_URL, TWEET_STREAM)
+                   if source])
+    if DAEMON_SOCKET and sources:
+        print >> sys.stderr, "With daemon, inputs are given by importttt_client.py."
+        sys.exit()
+    if not DAEMON_SOCKET and sources != 1:
+        print >> sys.stderr, "Specify one of input_file, ttt_url or input_stream."
+        sys.exit()
+    if args["replay_dead_letter"] and not INFILE:
+        print >> sys.stderr, "replay_dead_letter is given with input_file."
         sys.exit()
 
-    # Get cached next values if any.
-    next_nums = read_cache()
-    next_ttt_id = next_nums[NEXT_TTT_ID_KEY]
-    next_file_num = next_nums[NEXT_FILE_NUM_KEY]
-    if next_ttt_id > START_TTT_ID:
-        START_TTT_ID = next_ttt_id
-    if next_file_num > START_FILE_NUM:
-        START_FILE_NUM = next_file_num
-
-    # @ToDo: Should we pass in the above parameters?
-    if INFILE:
-        last_ttt_id = upload_local_csv_file(INFILE)
-    elif SEQUENTIAL:
-        upload_sequential_remote_csv_files()
-        # This will not return.
-        # @ToDo: Unless we decide there are cases when it should...
-        # If so, it should return both the last TtT id and the last file #.
-        # Since we'd likely only have it exit on a failure, we don't want to
-        # increment START_FILE_NUM as the next file to read.
+    if args["routes"]:
+        try:
+            ROUTES = read_routes(args["routes"])
+        except (IOError, ValueError, ConfigParser.Error), e:
+            sys.exit("Unable to read routing file %s: %s" % (args["routes"], e))
+    elif MAP_BASE_URL:
+        if args["uploaded_ids"]:
+            UPLOADED_IDS = UploadedIdIndex(args["uploaded_ids"])
+        if REPORT_STATES_FILE:
+            REPORT_STATES = ReportStateTable(
+                REPORT_STATES_FILE, UPDATE_WINDOW, MISSING_VALUES)
+        ROUTES = [make_default_route()]
     else:
-        (status_code, last_ttt_id) = upload_remote_csv_file(TTT_URL)
+        print >> sys.stderr, "Specify either map_url or routes."
+        sys.exit()
+
+    if args["replay_dead_letter"] and [
+            route for route in ROUTES if os.path.abspath(INFILE) ==
+            os.path.abspath(route.outfile_dead_letter)]:
+        print >> sys.stderr, "With replay_dead_letter, give another dead_letter path."
+        sys.exit()
 
-    # The cases that fall out here (single file, or possible failure of the
-    # sequential file load, don't need the starting file # incremented.
-    write_cache(last_ttt_id + 1, START_FILE_NUM)
+    # Get saved next values if any.
+    JOURNAL = UploadJournal(CACHE_FILE, START_TTT_ID, START_FILE_NUM)
+    START_TTT_ID = JOURNAL.next_ttt_id
+    START_FILE_NUM = JOURNAL.next_file_num
+    if args["replay_dead_letter"]:
+        # Dead letter rows are below the next id, as their file was finished.
+        START_TTT_ID = None
+
+    for route in ROUTES:
+        METRICS.gauge("send_rate", lambda limiter=route.limiter: limiter.rate,
+                      route=route.name)
+    METRICS.gauge("next_ttt_id", lambda: JOURNAL.next_ttt_id)
+    metrics_server = None
+    if args["metrics_port"]:
+        try:
+            metrics_server = MetricsServer(METRICS, args["metrics_port"])
+        except Exception, e:
+            sys.exit("Unable to serve metrics on port %d: %s" %
+                     (args["metrics_port"], e))
+        metrics_server.start()
+    metrics_logger = None
+    if args["metrics_interval"]:
+        metrics_logger = MetricsLogger(METRICS, args["metrics_interval"],
+                                       metrics_summary)
+        metrics_logger.start()
+    profiler = None
+    sampler = None
+    if args["profile"] or args["profile_sample"]:
+        # Let a plain kill stop the script by way of the finally clause
+        # below, so the profile is written.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        if args["profile"]:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if args["profile_sample"]:
+            sampler = SamplingProfiler(args["profile_sample"])
+            sampler.start()
+
+    try:
+        # @ToDo: Should we pass in the above parameters?
+        if DAEMON_SOCKET:
+            serve_daemon(DAEMON_SOCKET)
+        elif INFILE:
+            upload_one_file(path=INFILE)
+            release_held_reports(True)
+        elif TWEET_STREAM:
+            upload_tweet_stream(TWEET_STREAM, args["stream_batch_size"],
+                                args["stream_batch_wait"])
+        elif SEQUENTIAL:
+            upload_sequential_remote_csv_files()
+            # This will not return.
+            # @ToDo: Unless we decide there are cases when it should...
+            # If so, it should return both the last TtT id and the last file #.
+            # Since we'd likely only have it exit on a failure, we don't want to
+            # increment START_FILE_NUM as the next file to read.
+        else:
+            upload_one_file(url=TTT_URL)
+            release_held_reports(True)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args["profile"])
+        if sampler is not None:
+            sampler.stop()
+        if metrics_logger is not None:
+            metrics_logger.stop()
+            metrics_logger.write()
+        if metrics_server is not None:
+            metrics_server.stop()
+        # Also on Ctrl-C or an error, so what was done isn't done again
+        # after a restart.
+        JOURNAL.close()
+        for route in ROUTES:
+            route.close()
+        if GEOCODER is not None:
+            GEOCODER.close()
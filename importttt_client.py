@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Hand one file to a running importttt.py daemon to upload, e.g. from cron.
+
+Example use:
+python importttt.py --daemon /var/run/ttt/upload.sock [map options]
+python importttt_client.py /var/run/ttt/upload.sock \\
+    --input_url http://example.org/TtT_records-12.csv
+
+The daemon keeps its map sessions, restart cache, uploaded ids, retweet
+clusters and geocoding cache loaded between files, and this script imports
+only a few standard modules, so a cron run costs little more than the upload
+itself.  The upload's log is written to stderr.
+
+If no daemon is listening, importttt.py is run here instead, with the input
+and any options given after --, unless --no_fallback is given.  Once the
+daemon has the file, it is not run here, even if the daemon goes away, as
+part of the file may have been uploaded already.
+
+Exit status is 0 if the file was uploaded, 1 if the upload failed or the
+daemon could not be told of it, and 2 if there was no daemon to send it to.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+
+
+class NoDaemon(socket.error):
+    """ Nothing is listening on the daemon's socket. """
+
+
+def send_job(socket_path, job, stream=None):
+    """
+    Send a job to the daemon and copy its log to stream until it's done.
+
+    @param job: dict with input_file or input_url
+    @return: the daemon's result, a dict with status_code and next_ttt_id,
+    or with error
+    @raise NoDaemon: if there is no socket or no daemon listening on it
+    @raise socket.error: if the daemon can't be reached otherwise, or goes
+    away
+    """
+
+    stream = stream or sys.stderr
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(socket_path)
+        except socket.error, e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                raise NoDaemon(e.errno, e.strerror)
+            raise
+        conn.sendall(json.dumps(job) + "\n")
+        fin = conn.makefile("rb")
+        for line in fin:
+            message = json.loads(line)
+            if "log" in message:
+                print >> stream, message["log"].encode("utf-8")
+            else:
+                return message
+        raise socket.error("The daemon closed the connection.")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Send a file to importttt.py --daemon to upload.",
+        usage="""
+        python importttt_client.py socket
+            --input_file [input csv file path, for a local file]
+            --input_url [input csv URL, for a remote file]
+            --no_fallback [whether to fail rather than run importttt.py if no daemon is listening]
+            -- [importttt.py options, for the fallback]
+        """)
+    parser.add_argument(
+        "socket", help="Path of the socket given to importttt.py --daemon.")
+    parser.add_argument(
+        "--input_file", dest="input_file", help="Input csv file path.")
+    parser.add_argument(
+        "--input_url", dest="input_url", help="URL of remote csv file.")
+    parser.add_argument(
+        "--no_fallback", dest="no_fallback", action="store_true", default=False,
+        help="Include to exit with status 2 if no daemon is listening, rather than running importttt.py.")
+    # Options after -- are for importttt.py, if it's run here, e.g.
+    # -- --map_url https://example.org/
+    argv = sys.argv[1:]
+    fallback_args = []
+    if "--" in argv:
+        fallback_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    if bool(args.input_file) == bool(args.input_url):
+        parser.error("Specify either input_file or input_url.")
+
+    if args.input_file:
+        job = {"input_file": os.path.abspath(args.input_file)}
+    else:
+        job = {"input_url": args.input_url}
+    try:
+        result = send_job(args.socket, job)
+    except NoDaemon, e:
+        if args.no_fallback:
+            print >> sys.stderr, "No daemon is listening on %s: %s" % (
+                args.socket, e)
+            sys.exit(2)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "importttt.py")
+        input_args = (["--input_file", args.input_file] if args.input_file
+                      else ["--input_url", args.input_url])
+        os.execv(sys.executable, [sys.executable, script] + input_args +
+                 fallback_args)
+    except socket.error, e:
+        print >> sys.stderr, "Could not upload through the daemon on %s: %s" % (
+            args.socket, e)
+        sys.exit(1)
+    if "error" in result:
+        print >> sys.stderr, result["error"]
+        sys.exit(1)
+    sys.exit(0 if result.get("status_code") in (200, 304) else 1)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Run importttt.py with cooperative network I/O, using gevent.
+
+This takes the same options as importttt.py and uses the same restart cache.
+The difference is that the upload workers are greenlets rather than threads,
+and every socket is non-blocking, so --concurrency can be set in the
+hundreds or thousands without a thread per connection.
+
+Example use:
+python importttt_gevent.py --concurrency 500 [importttt.py options]
+
+One process can also poll several TtT feeds, e.g. one per event, each
+pushing to its own map(s), in place of an importer process per feed:
+python importttt_gevent.py --feeds feeds.txt [importttt.py options]
+
+The feeds file has one line of importttt.py options per feed, added to the
+options on the command line, which all feeds share.  Blank lines and lines
+starting with # are skipped.  Each feed needs its own cache_file, and its
+own uploaded, rejected and dead_letter files, e.g.:
+
+--input_url http://ttt.example.org/sandy_ --sequential_files --ttt_events sandy --map_url https://sandy.crowdmap.com/ --cache_file sandy_cache --uploaded sandy_uploaded.csv --rejected sandy_rejected.csv --dead_letter sandy_dead_letter.csv
+--input_url http://ttt.example.org/njwx_ --sequential_files --ttt_events njwx --map_url https://njwx.crowdmap.com/ --cache_file njwx_cache --uploaded njwx_uploaded.csv --rejected njwx_rejected.csv --dead_letter njwx_dead_letter.csv
+
+Each feed runs importttt.py in its own greenlet, with its own copy of the
+script's state, so feeds don't share restart state, rate limiters or map
+sessions.  If a feed stops on an error, the others carry on, and the
+process exits with status 1 once they are done.
+
+importttt.py is written for Python 2, which has no asyncio, so gevent stands
+in for it.  gevent must be installed (pip install gevent).
+"""
+
+import sys
+
+try:
+    from gevent import monkey
+except ImportError:
+    sys.exit("importttt_gevent.py needs gevent: pip install gevent")
+
+# This must be done before requests, socket, threading, etc. are imported.
+monkey.patch_all()
+
+import os
+import runpy
+import shlex
+import traceback
+
+import gevent
+
+IMPORTTT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "importttt.py")
+
+
+def read_feeds(path):
+    """ Read a feeds file.
+        @param path: path of the file
+        @return: list of the importttt.py options of each feed, as lists
+    """
+
+    feeds = []
+    fin = open(path, "r")
+    try:
+        for line in fin:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                feeds.append(shlex.split(line))
+    finally:
+        fin.close()
+    return feeds
+
+
+def run_feed(argv):
+    """ Run importttt.py for one feed.
+        @param argv: its options
+        @return: 0 if it finished, or 1 if it stopped on an error
+    """
+
+    # importttt.py reads its options from sys.argv before it does any I/O,
+    # so no other greenlet runs in between.
+    sys.argv = [IMPORTTT] + argv
+    try:
+        runpy.run_path(IMPORTTT, run_name="__main__")
+    except SystemExit, e:
+        if e.code:
+            if not isinstance(e.code, int):
+                print >> sys.stderr, e.code
+            return 1
+    except gevent.GreenletExit:
+        raise
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def run_feeds(path, common):
+    """ Run importttt.py for each feed in a feeds file, all at once.
+        @param path: path of the feeds file
+        @param common: importttt.py options shared by all feeds
+        @return: exit status, 1 if any feed stopped on an error
+    """
+
+    try:
+        feeds = read_feeds(path)
+    except IOError, e:
+        sys.exit("Unable to read feeds file %s: %s" % (path, e))
+    if not feeds:
+        sys.exit("No feeds in %s" % path)
+    greenlets = [gevent.spawn(run_feed, common + feed) for feed in feeds]
+    try:
+        gevent.joinall(greenlets)
+    finally:
+        # On Ctrl-C, let each feed finish up as importttt.py would.
+        gevent.killall(greenlets)
+    return max(greenlet.value or 0 for greenlet in greenlets)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    feeds_path = None
+    for (i, arg) in enumerate(args):
+        if arg == "--feeds" and i + 1 < len(args):
+            feeds_path = args[i + 1]
+            del args[i:i + 2]
+            break
+        if arg.startswith("--feeds="):
+            feeds_path = arg[len("--feeds="):]
+            del args[i]
+            break
+    if feeds_path:
+        sys.exit(run_feeds(feeds_path, args))
+    runpy.run_module("importttt", run_name="__main__", alter_sys=True)
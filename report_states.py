@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Provide a table of the state of each TtT record's report on a map.
+
+Sequential TtT exports repeat a record each time volunteers fill in more of
+it, e.g. COMPLETE, Details or the GPS fields.  Rather than post each version
+as a new report, the uploader holds a record for a short window, merging in
+the versions that arrive meanwhile, and then sends one report.  Versions
+that arrive after that are sent as edits of the report already on the map,
+and versions that change nothing are not sent at all.
+
+For each TtT id the table keeps a digest of the version on the map and, once
+known, the map's incident id.  Held versions are kept too, so a restart
+doesn't lose them.  A record whose last version is still being sent stays
+held until that is settled, so a later version isn't sent as a second new
+report.  Everything is in a sqlite file, with the held versions
+also in memory.  Changes are written in one transaction per batch, like
+UploadedIdIndex.
+"""
+
+__all__ = ["ReportStateTable"]
+
+import collections
+import hashlib
+import json
+import sqlite3
+import time
+
+
+class ReportStateTable(object):
+    """
+    The version of each TtT record on a map, and versions not yet sent.
+
+    Not thread safe: use from one thread (the uploader calls its result
+    handler on the main thread).
+    """
+
+    # Seconds to hold a record's first version for later ones to merge into.
+    WINDOW = 60.0
+    # Commit changes once this many are waiting...
+    BATCH_SIZE = 500
+    # ...or once this many seconds have passed since the last commit.
+    BATCH_SECONDS = 5.0
+
+    def __init__(self, path, window=None, missing=("", "NA")):
+        """
+        Open or create the table file, and load any held versions.
+
+        @param path: path of the sqlite file
+        @param window: seconds to hold a record before sending it
+        @param missing: values that mean a field is empty; a later version
+        doesn't overwrite a field with one of them
+        """
+
+        self.path = path
+        self.window = self.WINDOW if window is None else window
+        self.missing = frozenset(missing)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS reports (id INTEGER PRIMARY KEY, "
+            "digest TEXT, incident_id INTEGER)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS held (id INTEGER PRIMARY KEY, "
+            "since REAL, row TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS listed (incident_id INTEGER)")
+        self.db.commit()
+        # TtT id -> [time first held, row], oldest first.
+        self.held = collections.OrderedDict()
+        for (ttt_id, since, row) in self.db.execute(
+                "SELECT id, since, row FROM held ORDER BY since"):
+            self.held[ttt_id] = [since, [field.encode("utf-8")
+                                         for field in json.loads(row)]]
+        # TtT id -> [time first held, row] of released versions not yet
+        # settled.
+        self.sending = {}
+        row = self.db.execute("SELECT incident_id FROM listed").fetchone()
+        # Highest incident id read from the map's list of reports.
+        self.last_listed = row[0] if row else 0
+        self.changes = 0
+        self.last_commit = time.time()
+
+    @staticmethod
+    def digest(row):
+        """ Return a short hash of a row's fields. """
+        return hashlib.md5("\x1f".join(row)).hexdigest()
+
+    def _changed(self, count=1):
+        self.changes += count
+        if (self.changes >= self.BATCH_SIZE or
+                time.time() - self.last_commit >= self.BATCH_SECONDS):
+            self.flush()
+
+    def get(self, ttt_id):
+        """
+        @return: (digest, incident id or None) of the version of a record on
+        the map, or None if it has not been sent
+        """
+        return self.db.execute(
+            "SELECT digest, incident_id FROM reports WHERE id = ?",
+            (ttt_id,)).fetchone()
+
+    def record(self, ttt_id, digest, incident_id=None):
+        """
+        Note that a version of a record is on the map.
+
+        @param incident_id: the map's id for the report, or None to keep the
+        one already known
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO reports (id, digest, incident_id) VALUES "
+            "(?, ?, COALESCE(?, (SELECT incident_id FROM reports "
+            "WHERE id = ?)))", (ttt_id, digest, incident_id, ttt_id))
+        self._changed()
+
+    def set_incidents(self, incident_ids, last_listed):
+        """
+        Note the map's incident ids of records already sent.  Records the
+        table didn't know of, e.g. sent by hand, are added with no digest,
+        so any version of them is sent as an edit.
+
+        @param incident_ids: dict of TtT id to incident id
+        @param last_listed: highest incident id read from the map's list
+        """
+        self.db.executemany(
+            "INSERT OR IGNORE INTO reports (id) VALUES (?)",
+            ((ttt_id,) for ttt_id in incident_ids))
+        self.db.executemany(
+            "UPDATE reports SET incident_id = ? WHERE id = ?",
+            ((incident_id, ttt_id)
+             for (ttt_id, incident_id) in incident_ids.iteritems()))
+        if last_listed > self.last_listed:
+            self.last_listed = last_listed
+            self.db.execute("DELETE FROM listed")
+            self.db.execute("INSERT INTO listed (incident_id) VALUES (?)",
+                            (last_listed,))
+        self._changed(len(incident_ids) + 1)
+
+    def is_held(self, ttt_id):
+        return ttt_id in self.held
+
+    def is_sending(self, ttt_id):
+        """ Whether a released version of a record is not yet settled. """
+        return ttt_id in self.sending
+
+    def hold(self, ttt_id, row, now=None):
+        """
+        Hold a version of a record.  If a version is already held, fields
+        this one fills in replace its fields, and it is sent at the time the
+        first version would have been.
+        """
+        held = self.held.get(ttt_id)
+        if held is None:
+            held = self.held[ttt_id] = [now or time.time(), list(row)]
+        else:
+            held[1] = self._merge(held[1], row)
+        self._save(ttt_id, held)
+
+    def _merge(self, old_row, new_row):
+        missing = self.missing
+        return [old if new in missing else new
+                for (old, new) in zip(old_row, new_row)]
+
+    def _save(self, ttt_id, held):
+        self.db.execute(
+            "INSERT OR REPLACE INTO held (id, since, row) VALUES (?, ?, ?)",
+            (ttt_id, held[0], json.dumps([field.decode("utf-8", "replace")
+                                          for field in held[1]])))
+        self._changed()
+
+    def next_due(self):
+        """ Return the time the oldest held version is due, or None. """
+        for (since, row) in self.held.itervalues():
+            return since + self.window
+        return None
+
+    def release(self, everything=False, now=None):
+        """
+        Stop holding the versions whose window has passed.  They stay in the
+        file until settled, so a restart sends them again if need be.  A
+        record with a version still being sent stays held, to be released
+        once that is settled.
+
+        @param everything: if true, release all held versions
+        @return: list of (TtT id, merged row), oldest first
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        held = self.held
+        sending = self.sending
+        for (ttt_id, (since, row)) in held.iteritems():
+            if not everything and since + self.window > now:
+                break
+            if ttt_id not in sending:
+                due.append((ttt_id, row))
+        for (ttt_id, row) in due:
+            sending[ttt_id] = held.pop(ttt_id)
+        return due
+
+    def restore(self):
+        """
+        Hold again the released versions that were never settled, e.g.
+        because their uploads were dropped when stopping.
+        """
+        held = self.held
+        for (ttt_id, (since, row)) in self.sending.iteritems():
+            if ttt_id in held:
+                # Versions that came since go on top.
+                row = self._merge(row, held[ttt_id][1])
+            held[ttt_id] = [since, row]
+            self._save(ttt_id, held[ttt_id])
+        self.sending.clear()
+        self.held = collections.OrderedDict(
+            sorted(held.iteritems(), key=lambda item: item[1][0]))
+
+    def settle(self, ttt_id):
+        """
+        Note that a released version has been dealt with: sent, rejected,
+        or found to need no sending.
+        """
+        self.sending.pop(ttt_id, None)
+        # A newer version may be held by now.
+        if ttt_id not in self.held:
+            self.db.execute("DELETE FROM held WHERE id = ?", (ttt_id,))
+            self._changed()
+
+    def flush(self):
+        """ Commit the changes made so far. """
+        if self.changes:
+            self.db.commit()
+            self.changes = 0
+        self.last_commit = time.time()
+
+    def close(self):
+        """ Commit any changes and close the file. """
+        self.flush()
+        self.db.close()
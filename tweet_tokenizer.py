@@ -12,11 +12,36 @@ format.
 @author: Pat Tressel
 """
 
-__all__ = ["Tweet", "TtTCSVTweets"]
+__all__ = ["TokenizedTweet", "TweetStore", "NearDuplicateIndex",
+           "TweetReader", "TweakTheTweetCSVReader",
+           "MappedTweakTheTweetCSVReader", "JSONLinesTweetReader"]
+
+import re
+import select
+import zlib
+import random
+import csv
+import cStringIO
+import itertools
+from array import array
+import calendar
+import json
+import mmap
+import os
+import socket
+import sys
+import time
+
+def intern_str(text):
+    """ Share one copy of a string that recurs, such as a sender or token. """
+    if type(text) is str:
+        return intern(text)
+    return text
+
 
 # @ToDo: This returns source-specific data in an "extra" field (expected to be
 # a dict). As an alternative, sources could subclass this class.
-class TokenizedTweet:
+class TokenizedTweet(object):
     """
     Represents one tokenized tweet.
     
@@ -26,13 +51,28 @@ class TokenizedTweet:
     Has fields for the tweet's sender, its original author (if a retweet),
     the retweet type (RT, MT), length apart from the retweet header,
     and a field for extra data specific to a source.
+    
+    Slotted, so a tweet has no __dict__.  To hold a whole event's tweets in
+    memory, use a TweetStore.
     """
     
+    __slots__ = ("tweet", "sender", "extra", "tokens", "length", "author",
+                 "retweet")
+    
     # Characters that separate tokens
-    SEPARATOR_CHARS = ""
+    SEPARATOR_CHARS = " \t\r\n,;!?()[]{}<>\"|"
     
     # Characters to strip from tokens
-    STRIP_CHARS = ""
+    STRIP_CHARS = ".:'-_*~`"
+    
+    # Tokens that carry no content of their own.
+    STOP_TOKENS = frozenset(["rt", "mt", "via", "&amp", "&"])
+    
+    SEPARATOR_RE = re.compile("[%s]+" % re.escape(SEPARATOR_CHARS))
+    
+    # Retweet header, e.g. "RT @someone: ".  Retweets of retweets repeat it.
+    RETWEET_RE = re.compile(r"^\s*(RT|MT)\b\s*:?\s*@(\w+)\s*:?\s*",
+                            re.IGNORECASE)
     
     def __init__(self, tweet, sender, extra=None):
         """
@@ -42,31 +82,488 @@ class TokenizedTweet:
         the Twitter API or from TtT, etc., split up the tweet into tokens
         """
         self.tweet = tweet
-        self.sender = sender
+        self.sender = intern_str(sender)
         self.extra = extra
+        (self.tokens, self.length, author, self.retweet) = \
+            TokenizedTweet.parse(tweet)
+        self.author = intern_str(author) if author else self.sender
+    
+    @staticmethod
+    def parse(tweet):
+        """
+        Peel off retweet headers and tokenize the rest.
+        
+        @return: (tokens, length of the body, innermost retweeted author or
+        None, "RT" or "MT" or None)
+        """
+        author = None
+        retweet = None
+        body = tweet
+        match = TokenizedTweet.RETWEET_RE.match(body)
+        while match:
+            retweet = retweet or match.group(1).upper()
+            author = match.group(2)
+            body = body[match.end():]
+            match = TokenizedTweet.RETWEET_RE.match(body)
+        return (TokenizedTweet.tokenize(body), len(body), author, retweet)
+    
+    @staticmethod
+    def tokenize(text):
+        """
+        Split text into lowercase tokens.
+        
+        Links are dropped, as each retweet may shorten the same link to a
+        different URL.
+        """
+        tokens = []
+        for token in TokenizedTweet.SEPARATOR_RE.split(text.lower()):
+            if token.startswith("http") or token.startswith("www."):
+                continue
+            token = token.strip(TokenizedTweet.STRIP_CHARS)
+            if token and token not in TokenizedTweet.STOP_TOKENS:
+                tokens.append(intern_str(token))
+        return tokens
+
+
+class TweetStore(object):
+    """
+    Hold many tokenized tweets compactly, as parallel arrays.
+    
+    Each distinct token and sender is stored once and referred to by an
+    integer id, and each tweet's token ids are kept end to end in one array,
+    so a tweet takes a few tens of bytes rather than the kilobyte or so of a
+    TokenizedTweet with its lists and strings.  Tweets are referred to by
+    their index in the store.  Text is only kept if asked for.
+    
+    Iterating over a store, or over token_hashes_of each tweet, touches only
+    arrays of ints, which suits bulk passes such as clustering a whole event
+    with NearDuplicateIndex.add_hashes.
+    """
+    
+    # Codes for the retweet type in the retweets array.
+    RETWEET_CODES = {None: 0, "RT": 1, "MT": 2}
+    RETWEET_TYPES = [None, "RT", "MT"]
+    
+    def __init__(self, keep_text=False):
+        """
+        @param keep_text: if True, keep each tweet's text, so that get() can
+        rebuild the TokenizedTweet
+        """
+        # token -> token id, and token id -> token and its hash
+        self.token_ids = {}
+        self.token_names = []
+        self.token_hashes = array('I')
+        # sender or author name -> name id, and name id -> name
+        self.name_ids = {}
+        self.names = []
+        # Per tweet: source id (e.g. TtT id, or -1), sender and author name
+        # ids, body length, retweet code, and where its tokens start.
+        self.ids = array('l')
+        self.senders = array('i')
+        self.authors = array('i')
+        self.lengths = array('i')
+        self.retweets = array('b')
+        self.offsets = array('i', [0])
+        # Token ids of all tweets, end to end.
+        self.tokens = array('i')
+        self.texts = [] if keep_text else None
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+    
+    def _token_id(self, token):
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = self.token_ids[token] = len(self.token_names)
+            self.token_names.append(token)
+            self.token_hashes.append(NearDuplicateIndex.token_hash(token))
+        return token_id
+    
+    def add(self, tweet, sender, tweet_id=-1):
+        """
+        Tokenize a tweet and add it, without making a TokenizedTweet.
+        
+        @param tweet: the tweet text
+        @param sender: the tweet's sender
+        @param tweet_id: an integer id from the source, e.g. the TtT id
+        @return: the tweet's index in the store
+        """
+        (tokens, length, author, retweet) = TokenizedTweet.parse(tweet)
+        return self._append(tweet, sender, author or sender, tokens, length,
+                            retweet, tweet_id)
+    
+    def add_tweet(self, tweet, tweet_id=-1):
+        """ Add a TokenizedTweet; return its index in the store. """
+        return self._append(tweet.tweet, tweet.sender, tweet.author,
+                            tweet.tokens, tweet.length, tweet.retweet,
+                            tweet_id)
+    
+    def _append(self, text, sender, author, tokens, length, retweet,
+                tweet_id):
+        index = len(self.ids)
+        self.ids.append(tweet_id)
+        sender_id = self._name_id(sender)
+        self.senders.append(sender_id)
+        self.authors.append(sender_id if author == sender
+                            else self._name_id(author))
+        self.lengths.append(length)
+        self.retweets.append(TweetStore.RETWEET_CODES[retweet])
+        token_id = self._token_id
+        self.tokens.extend([token_id(token) for token in tokens])
+        self.offsets.append(len(self.tokens))
+        if self.texts is not None:
+            self.texts.append(text)
+        return index
+    
+    def token_ids_of(self, index):
+        """ The token ids of one tweet, as an array. """
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+    
+    def tokens_of(self, index):
+        """ The tokens of one tweet, as a list of strings. """
+        names = self.token_names
+        return [names[token_id] for token_id in self.token_ids_of(index)]
+    
+    def token_hashes_of(self, index):
+        """ Hashes of the distinct tokens of one tweet, for clustering. """
+        hashes = self.token_hashes
+        return [hashes[token_id]
+                for token_id in set(self.token_ids_of(index))]
+    
+    def sender(self, index):
+        return self.names[self.senders[index]]
+    
+    def author(self, index):
+        return self.names[self.authors[index]]
+    
+    def retweet(self, index):
+        return TweetStore.RETWEET_TYPES[self.retweets[index]]
+    
+    def get(self, index, extra=None):
+        """
+        Rebuild one tweet as a TokenizedTweet.
+        
+        @raise ValueError: if the store does not keep text
+        """
+        if self.texts is None:
+            raise ValueError("TweetStore was made without keep_text.")
+        return TokenizedTweet(self.texts[index], self.sender(index), extra)
+    
+    def __iter__(self):
+        """
+        Generate (index, source id, token id array) for every tweet.
+        """
+        ids = self.ids
+        offsets = self.offsets
+        tokens = self.tokens
+        for index in xrange(len(ids)):
+            yield (index, ids[index],
+                   tokens[offsets[index]:offsets[index + 1]])
+    
+    def memory_size(self):
+        """ Approximate bytes used by the per-tweet arrays. """
+        return sum(a.itemsize * len(a) for a in (
+            self.ids, self.senders, self.authors, self.lengths,
+            self.retweets, self.offsets, self.tokens))
+
+
+class NearDuplicateIndex(object):
+    """
+    Group tweets whose token sets are nearly the same.
+    
+    Each tweet's token set is reduced to a MinHash signature, and signatures
+    are split into bands that are looked up in hash tables (locality
+    sensitive hashing).  A new tweet is only compared with clusters that
+    share at least one band with it, so assigning a tweet takes time
+    independent of the number of tweets already seen.
+    
+    With the default 16 bands of 4 rows, tweets that are 80% similar are
+    found almost always, and tweets under 30% similar are rarely compared.
+    
+    Signatures are kept in one flat array and bands are keyed by a hash, so
+    a cluster takes a few hundred bytes rather than a few kilobytes.  A hash
+    collision only costs an extra comparison.
+    """
+    
+    # Largest 32-bit prime, used for the hash permutations.
+    PRIME = 4294967291
+    
+    def __init__(self, bands=16, rows=4, threshold=0.7, seed=1):
+        """
+        Create an empty index.
         
-        # Fields we'll construct.
-        #self.tokens = tokens
-        #self.length = length
-        #self.author = author if author else sender
-        #self.retweet = retweet
+        @param bands: number of bands the signature is split into
+        @param rows: number of hash values per band
+        @param threshold: least estimated Jaccard similarity between a tweet
+        and a cluster's first tweet for the tweet to join the cluster
+        @param seed: seed for the hash permutations; indexes can only be
+        compared if they use the same seed
+        """
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        rand = random.Random(seed)
+        self.permutations = [
+            (rand.randint(1, self.PRIME - 1), rand.randint(0, self.PRIME - 1))
+            for i in xrange(bands * rows)]
+        self.length = bands * rows
+        # hash of (band number, band values) -> cluster id
+        self.buckets = {}
+        # Signatures of each cluster's first tweet, one after another.  A
+        # cluster of tweets with no tokens has a signature of zeros.
+        self.signatures = array('I')
+        # cluster id -> number of tweets in the cluster
+        self.sizes = array('i')
+    
+    def __len__(self):
+        """ Number of clusters. """
+        return len(self.sizes)
+    
+    @staticmethod
+    def token_hash(token):
+        """ Hash one token, as used for signatures. """
+        return zlib.crc32(token.encode("utf-8") if isinstance(token, unicode)
+                          else token) & 0xffffffff
+    
+    def signature(self, tokens):
+        """
+        Compute the MinHash signature of a collection of tokens.
+        
+        @return: tuple of bands * rows ints, or None if there are no tokens
+        """
+        token_hash = NearDuplicateIndex.token_hash
+        return self.hash_signature([token_hash(token) for token in set(tokens)])
+    
+    def hash_signature(self, hashes):
+        """
+        Compute the MinHash signature from token hashes, e.g. as kept by a
+        TweetStore.
+        
+        @return: tuple of bands * rows ints, or None if there are no hashes
+        """
+        return NearDuplicateIndex.minhash(hashes, self.permutations)
+    
+    @staticmethod
+    def minhash(hashes, permutations):
+        """
+        Compute a MinHash signature given an index's permutations, so that
+        signatures can be worked out away from the index, e.g. in another
+        process, and added with add_signature.
+        
+        @return: tuple of ints, one per permutation, or None if there are no
+        hashes
+        """
+        if not hashes:
+            return None
+        prime = NearDuplicateIndex.PRIME
+        return tuple(min((a * h + b) % prime for h in hashes)
+                     for (a, b) in permutations)
+    
+    def cluster_signature(self, cluster):
+        """ The signature of a cluster's first tweet. """
+        return self.signatures[cluster * self.length:
+                               (cluster + 1) * self.length]
+    
+    def similarity(self, sig1, sig2):
+        """ Estimate Jaccard similarity from two signatures. """
+        same = 0
+        for (v1, v2) in zip(sig1, sig2):
+            if v1 == v2:
+                same += 1
+        return float(same) / len(sig1)
+    
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [hash((band, signature[band * rows:(band + 1) * rows]))
+                for band in xrange(self.bands)]
+    
+    def find(self, tokens):
+        """
+        Find the cluster a tweet belongs to without adding it.
+        
+        @param tokens: the tweet's tokens, e.g. TokenizedTweet.tokens
+        @return: cluster id, or None if no cluster is similar enough
+        """
+        signature = self.signature(tokens)
+        if signature is None:
+            return None
+        return self._find(signature, self._band_keys(signature))
+    
+    def _find(self, signature, keys):
+        best = None
+        best_similarity = self.threshold
+        checked = set()
+        for key in keys:
+            cluster = self.buckets.get(key)
+            if cluster is None or cluster in checked:
+                continue
+            checked.add(cluster)
+            similarity = self.similarity(signature,
+                                         self.cluster_signature(cluster))
+            if similarity >= best_similarity:
+                best = cluster
+                best_similarity = similarity
+        return best
+    
+    def add(self, tokens):
+        """
+        Assign a tweet to a cluster, making a new cluster if needed.
+        
+        @param tokens: the tweet's tokens, e.g. TokenizedTweet.tokens
+        @return: (cluster id, True if the cluster is new).  A tweet with no
+        tokens always gets a new cluster.
+        """
+        return self.add_signature(self.signature(tokens))
+    
+    def add_hashes(self, hashes):
+        """
+        As add, but given the hashes of the tweet's distinct tokens, e.g.
+        from TweetStore.token_hashes_of.
+        """
+        return self.add_signature(self.hash_signature(hashes))
+    
+    def add_signature(self, signature):
+        """ As add, but given the tweet's signature, or None. """
+        if signature is None:
+            cluster = len(self.sizes)
+            self.signatures.extend([0] * self.length)
+            self.sizes.append(1)
+            return (cluster, True)
+        keys = self._band_keys(signature)
+        cluster = self._find(signature, keys)
+        new = cluster is None
+        if new:
+            cluster = len(self.sizes)
+            self.signatures.extend(signature)
+            self.sizes.append(0)
+        self.sizes[cluster] += 1
+        # Let later tweets find the cluster through this tweet's bands too,
+        # unless a band already points at another cluster.
+        for key in keys:
+            self.buckets.setdefault(key, cluster)
+        return (cluster, new)
 
 class TweetReader(object):
     """
     Parent class for readers from assorted tweet sources.
+    
+    A reader can be pulled from or can push to a callback:
+    
+    for tweet in reader: ...            one TokenizedTweet at a time
+    for batch in reader.batches(100, 2.0): ...
+                                        lists of up to 100 tweets, handed
+                                        over at most 2 seconds after the
+                                        first tweet in each arrives
+    reader.run(callback, 100, 2.0)      calls callback with each batch (or
+                                        with each tweet, if no batch size)
+                                        until the source ends or stop()
+    
+    Subclasses implement _tweets(), a generator of TokenizedTweets.  A live
+    source should also yield None now and then while no tweets arrive, so
+    that batches are handed over on time and stop() is noticed.  Source
+    specific data, such as the TtT id, event and row, goes in extra.
     """
     
     def __init__(self):
-        pass
+        self.stopping = False
+    
+    def _tweets(self):
+        return iter(())
+    
+    def __iter__(self):
+        for tweet in self._tweets():
+            if self.stopping:
+                break
+            if tweet is not None:
+                yield tweet
+    
+    def batches(self, size=100, max_wait=None):
+        """
+        Generate lists of tweets.
+        
+        @param size: most tweets per batch
+        @param max_wait: most seconds to hold a tweet while the batch fills,
+        or None to wait for a full batch
+        """
+        batch = []
+        deadline = None
+        for tweet in self._tweets():
+            if self.stopping:
+                break
+            if tweet is not None:
+                if not batch and max_wait is not None:
+                    deadline = time.time() + max_wait
+                batch.append(tweet)
+            if batch and (len(batch) >= size or
+                          (deadline is not None and time.time() >= deadline)):
+                yield batch
+                batch = []
+        if batch:
+            yield batch
     
-# @ToDo: Are there other TtT CSV formats? Are header names stable, so we could
-# handle other formats by finding the headers we need? For now, check the
-# actual headers against the expected headers.
+    def run(self, callback, batch_size=None, max_wait=None):
+        """
+        Push tweets to callback until the source ends or stop() is called.
+        
+        @param callback: called with each tweet, or with each list of tweets
+        if batch_size is given
+        """
+        if batch_size:
+            for batch in self.batches(batch_size, max_wait):
+                callback(batch)
+        else:
+            for tweet in self:
+                callback(tweet)
+    
+    def stop(self):
+        """ Make iteration end at the next tweet or idle tick. """
+        self.stopping = True
+    
+    def read_into(self, store=None):
+        """
+        Add every tweet to a TweetStore.
+        
+        Subclasses can override this to fill the store without making a
+        TokenizedTweet for each tweet.
+        
+        @param store: the TweetStore, or None for a new one
+        @return: the store
+        """
+        if store is None:
+            store = TweetStore()
+        for tweet in self:
+            tweet_id = -1
+            if isinstance(tweet.extra, dict):
+                tweet_id = tweet.extra.get("id", -1)
+            store.add_tweet(tweet, tweet_id)
+        return store
+    
+# TtT exports from different events have named some columns differently, so
+# columns are found by header name rather than position.
 class TweakTheTweetCSVReader(TweetReader):
     """
     Read tweets from a Tweak the Tweet CSV file.
-        
-    Expects column headings in first row.  Expects 17 columns (see TTT_HEADERS).
+    
+    Expects column headings in the first row.  Columns are found by name
+    (see TTT_HEADERS and HEADER_ALIASES), once per file, and each row is
+    rearranged into the order of TTT_HEADERS, with "NA" for columns the file
+    lacks.  Only EVENT, ID and Text are required.
+    
+    The event and id filters are applied to the raw csv fields, before a row
+    is rearranged or tokenized, so unwanted rows cost little more than the
+    csv split.  If the rows are known to be in order of increasing id, whole
+    blocks of the file below the id watermark are skipped without being
+    parsed at all.
+    
+    Iterating gives TokenizedTweets, with the TtT id, event and row in extra.
+    rows() gives the rows themselves, for the uploader.
     """
     
     # The TtT columns are:
@@ -75,16 +572,741 @@ class TweakTheTweetCSVReader(TweetReader):
                    "COMPLETE", "GPS_Lat", "GPS_Long", "Photo", "Video",
                    "Author", "ID"]
     
-    def __init__(self, csv_file_path):
+    # Other names seen for some columns.  Names are matched without regard to
+    # case or surrounding spaces.
+    HEADER_ALIASES = {
+        "Time - EDT": ["Time - EST", "Time - CDT", "Time - PDT", "Time"],
+        "GPS_Lat": ["Latitude", "Lat"],
+        "GPS_Long": ["Longitude", "Lon", "Long"],
+    }
+    
+    REQUIRED_HEADERS = ["EVENT", "ID", "Text"]
+    
+    MISSING = "NA"
+    
+    # Bytes to read at a time when skipping rows below the id watermark.
+    SKIP_BLOCK_SIZE = 256 * 1024
+    
+    # The id at the end of a record, possibly quoted.
+    LAST_ID_RE = re.compile(r',"?(\d+)"?[ \t]*$')
+    
+    def __init__(self, csv_file, events=None, min_id=None,
+                 ids_ascending=False):
+        """
+        Prepare to read tweets from a Tweak the Tweet csv file.
+        
+        @param csv_file: path of the file, an open file, or an iterable of
+        lines such as a streamed download
+        @param events: collection of lowercase event names without "#" to
+        keep, or None to keep every event
+        @param min_id: least TtT id to keep, or None to keep every id
+        @param ids_ascending: True if the file lists rows in order of
+        increasing id, so blocks of rows below min_id can be skipped unread.
+        Only used for files, not other iterables.
+        @raise ValueError: if the headers lack a required column
+        """
+        
+        TweetReader.__init__(self)
+        # Close the file when done only if we opened it.
+        self.own_file = isinstance(csv_file, basestring)
+        if self.own_file:
+            csv_file = open(csv_file, 'rb')
+        self.csv_in = csv_file
+        self.events = frozenset(events) if events is not None else None
+        self.min_id = min_id
+        self.ids_ascending = ids_ascending
+        
+        # Highest id seen in the file, including rows filtered or skipped.
+        self.last_id = None
+        # Counts of rows read, and of rows not kept, by reason.
+        self.rows_read = 0
+        self.filtered_event = 0
+        self.filtered_id = 0
+        self.filtered_bad_id = 0
+        # Bytes passed over by block skipping.
+        self.bytes_skipped = 0
+        
+        if hasattr(csv_file, "readline"):
+            # Read the headers by line, so the position in the file is known
+            # when skipping blocks.
+            header_line = csv_file.readline()
+            headers = csv.reader([header_line]).next() if header_line else []
+            self.lines = csv_file
+        else:
+            self.lines = iter(csv_file)
+            headers = csv.reader(self.lines).next()
+        self.file_headers = headers
+        self.headers = list(TweakTheTweetCSVReader.TTT_HEADERS)
+        self._map_columns(headers)
+    
+    def _map_columns(self, headers):
+        """ Find each TtT column in the file's headers, once per file. """
+        
+        positions = {}
+        for (i, header) in enumerate(headers):
+            positions.setdefault(header.strip().lower(), i)
+        columns = []
+        for name in TweakTheTweetCSVReader.TTT_HEADERS:
+            names = [name] + TweakTheTweetCSVReader.HEADER_ALIASES.get(name, [])
+            index = None
+            for alias in names:
+                index = positions.get(alias.lower())
+                if index is not None:
+                    break
+            if index is None and name in TweakTheTweetCSVReader.REQUIRED_HEADERS:
+                raise ValueError("CSV headings have no %s column." % name)
+            columns.append(index)
+        self.columns = columns
+        self.event_col = columns[TweakTheTweetCSVReader.TTT_HEADERS.index("EVENT")]
+        self.id_col = columns[TweakTheTweetCSVReader.TTT_HEADERS.index("ID")]
+        # If the file is in the usual layout, rows can be used as they are.
+        self.identity = columns == range(len(columns))
+        # Blocks can be skipped only if the id is the last field of a record.
+        self.id_is_last = self.id_col == len(headers) - 1
+    
+    @staticmethod
+    def split_file(path, chunk_size):
+        """
+        Divide a csv file into parts that each hold whole records, so the
+        parts can be read separately, e.g. by several processes.
+        
+        Records are told apart by counting quotes, as in block skipping, so
+        a quoted field with a newline is not split.
+        
+        @param path: path of the file
+        @param chunk_size: bytes per part, not counting the rest of the
+        record the part ends in
+        @return: (header line, list of (start offset, end offset) of the
+        parts, in file order)
+        """
+        
+        fin = open(path, "rb")
+        try:
+            header = fin.readline()
+            chunks = []
+            start = fin.tell()
+            while True:
+                # Reading the whole file to count quotes is much faster than
+                # parsing it, so this is a small part of the work.
+                quotes = fin.read(chunk_size).count('"')
+                line = fin.readline()
+                quotes += line.count('"')
+                # An odd number of quotes means we stopped inside a quoted
+                # field.
+                while quotes % 2:
+                    line = fin.readline()
+                    if not line:
+                        break
+                    quotes += line.count('"')
+                end = fin.tell()
+                if end <= start:
+                    break
+                chunks.append((start, end))
+                start = end
+        finally:
+            fin.close()
+        return (header, chunks)
+    
+    def _skip_below_min_id(self):
+        """
+        Pass over whole blocks of the file whose rows are all below min_id.
+        
+        Each block is extended to the end of a record, found by counting
+        quotes, as quoted fields may contain newlines.  If the block's last
+        id is below min_id, so are all of its ids, and the block is dropped.
+        
+        @return: the unparsed text of the first block that was kept
+        """
+        
+        fin = self.csv_in
+        while True:
+            block = fin.read(TweakTheTweetCSVReader.SKIP_BLOCK_SIZE)
+            if not block:
+                return ""
+            block += fin.readline()
+            # An odd number of quotes means we stopped inside a quoted field.
+            quotes = block.count('"')
+            while quotes % 2:
+                line = fin.readline()
+                if not line:
+                    break
+                block += line
+                quotes += line.count('"')
+            end = block.rstrip("\r\n")
+            match = TweakTheTweetCSVReader.LAST_ID_RE.search(
+                end, max(0, len(end) - 64))
+            if quotes % 2 or not match or int(match.group(1)) >= self.min_id:
+                return block
+            self.last_id = max(self.last_id, int(match.group(1)))
+            # Counting lines rather than parsing the block overcounts records
+            # with quoted newlines, which are rare.
+            lines = end.count("\n") + 1
+            self.rows_read += lines
+            self.filtered_id += lines
+            self.bytes_skipped += len(block)
+    
+    def rows(self):
+        """
+        Generate the rows that pass the event and id filters.
+        
+        @return: generator of (TtT id, lowercase event without "#", row),
+        with row a list in the order of TTT_HEADERS
+        """
+        
+        lines = self.lines
+        if (self.ids_ascending and self.min_id is not None and
+                self.id_is_last and hasattr(self.csv_in, "read")):
+            kept = self._skip_below_min_id()
+            if kept:
+                lines = itertools.chain(cStringIO.StringIO(kept), lines)
+        return self._filter_rows(lines)
+    
+    def _filter_rows(self, lines):
+        """ Parse lines and generate the rows that pass the filters. """
+        
+        events = self.events
+        min_id = self.min_id
+        event_col = self.event_col
+        id_col = self.id_col
+        columns = self.columns
+        identity = self.identity
+        width = len(columns)
+        missing = TweakTheTweetCSVReader.MISSING
+        # Raw EVENT field -> normalized event, or None if not wanted.
+        wanted = {}
+        last_id = self.last_id
+        
+        try:
+            for row in csv.reader(lines):
+                # Skip blank lines.
+                if not row:
+                    continue
+                self.rows_read += 1
+                try:
+                    ttt_id = int(row[id_col])
+                except (IndexError, ValueError):
+                    self.filtered_bad_id += 1
+                    continue
+                if ttt_id > last_id:
+                    last_id = ttt_id
+                if min_id is not None and ttt_id < min_id:
+                    self.filtered_id += 1
+                    continue
+                raw_event = row[event_col] if event_col < len(row) else ""
+                try:
+                    event = wanted[raw_event]
+                except KeyError:
+                    event = raw_event.lstrip("#").lower()
+                    if events is not None and event not in events:
+                        event = None
+                    wanted[raw_event] = event
+                if event is None:
+                    self.filtered_event += 1
+                    continue
+                # Only now build the full row.
+                if identity and len(row) == width:
+                    pass
+                elif identity:
+                    row = (row + [missing] * width)[:width]
+                else:
+                    row = [row[i] if i is not None and i < len(row) else
+                           missing for i in columns]
+                yield (ttt_id, event, row)
+        finally:
+            self.last_id = last_id
+    
+    def _tweets(self):
+        """ Generate TokenizedTweets for the rows that pass the filters. """
+        
+        text_col = TweakTheTweetCSVReader.TTT_HEADERS.index("Text")
+        author_col = TweakTheTweetCSVReader.TTT_HEADERS.index("Author")
+        for (ttt_id, event, row) in self.rows():
+            yield TokenizedTweet(row[text_col], row[author_col],
+                                 {"id": ttt_id, "event": event, "row": row})
+    
+    def read_into(self, store=None):
         """
-        Prepare to read tweets from the specified Tweak the Tweet csv file.
+        Add the tweets that pass the filters to a TweetStore, with their TtT
+        ids, without making TokenizedTweets.
+        """
+        if store is None:
+            store = TweetStore()
+        text_col = TweakTheTweetCSVReader.TTT_HEADERS.index("Text")
+        author_col = TweakTheTweetCSVReader.TTT_HEADERS.index("Author")
+        add = store.add
+        for (ttt_id, event, row) in self.rows():
+            add(row[text_col], row[author_col], ttt_id)
+        return store
+    
+    def close(self):
+        if self.own_file:
+            self.csv_in.close()
+
+
+class MappedTweakTheTweetCSVReader(TweakTheTweetCSVReader):
+    """
+    Read a local Tweak the Tweet csv file through a memory map.
+    
+    The file is read a block of whole records at a time.  When only some
+    events are wanted, the records for them are found with a regular
+    expression run over the block, and only those records are parsed, so
+    no field of a row for another event is ever copied out of the block.
+    Otherwise each block is parsed as csv.
+    
+    Reading can start at a saved byte offset rather than at the top.  While
+    rows are being read, offset is at or before the start of the next row
+    to be generated.
+    
+    Where records are found by expression, rows_read and filtered_event
+    count lines, as block skipping does, and last_id is the highest id of
+    the records parsed and of the last record of each block.  For a file in
+    order of id, that is the highest id in the file; otherwise it may be
+    lower, which only means rows are looked at again later.
+    """
+    
+    # Bytes to read at a time, not counting the rest of the last record.
+    BLOCK_SIZE = 256 * 1024
+    
+    def __init__(self, path, events=None, min_id=None, ids_ascending=False,
+                 start_offset=0):
         """
+        @param path: path of the file
+        @param start_offset: offset of a record to start reading at, as
+        saved from offset; 0, or an offset that isn't just after a newline,
+        starts at the first record
+        @raise ValueError: if the headers lack a required column
+        @raise EnvironmentError: if the file can't be read or mapped
+        """
+        
+        fin = open(path, "rb")
+        try:
+            size = os.fstat(fin.fileno()).st_size
+            # An empty file can't be mapped.
+            mm = (mmap.mmap(fin.fileno(), size, access=mmap.ACCESS_READ)
+                  if size else None)
+        finally:
+            fin.close()
+        TweakTheTweetCSVReader.__init__(self, mm or cStringIO.StringIO(""),
+                                        events, min_id, ids_ascending)
+        self.map = mm
+        self.size = size
+        data_start = mm.tell() if mm else 0
+        if (data_start < start_offset <= size and
+                mm[start_offset - 1] == "\n"):
+            self.offset = start_offset
+            self.bytes_skipped = start_offset - data_start
+        else:
+            self.offset = data_start
+        self.event_re = None
+        if self.events is not None and self.event_col == 0:
+            # A record for a wanted event starts with it, perhaps quoted.
+            # Matching from a newline, with the case of each letter spelled
+            # out, is much faster than ^ with re.M and re.I, which try a
+            # match at every position.
+            event_pattern = r'"?#*(?:%s)"?,' % "|".join(
+                "".join("[%s%s]" % (char, char.upper()) if char.isalpha()
+                        else re.escape(char) for char in event)
+                for event in sorted(self.events))
+            self.event_re = re.compile("\n" + event_pattern)
+            self.first_event_re = re.compile(event_pattern)
+    
+    def _next_block(self):
+        """ Read whole records from offset; return "" at the end. """
+        mm = self.map
+        mm.seek(self.offset)
+        block = mm.read(MappedTweakTheTweetCSVReader.BLOCK_SIZE)
+        if not block:
+            return ""
+        block += mm.readline()
+        quotes = block.count('"')
+        # An odd number of quotes means we stopped inside a quoted field.
+        while quotes % 2:
+            line = mm.readline()
+            if not line:
+                break
+            block += line
+            quotes += line.count('"')
+        return block
+    
+    def rows(self, ticks=False):
+        """
+        Generate the rows that pass the event and id filters, from offset
+        on.
+        
+        @param ticks: if true, also generate None after each block, so the
+        caller can note progress through a stretch with no wanted rows
+        @return: generator of (TtT id, lowercase event without "#", row),
+        with row a list in the order of TTT_HEADERS
+        """
+        
+        if self.map is None:
+            return
+        if (self.ids_ascending and self.min_id is not None and
+                self.id_is_last):
+            self.map.seek(self.offset)
+            kept = self._skip_below_min_id()
+            self.offset = self.map.tell() - len(kept)
+        while True:
+            block = self._next_block()
+            if not block:
+                break
+            block_start = self.offset
+            if self.event_re is None:
+                for item in self._filter_rows(cStringIO.StringIO(block)):
+                    yield item
+            else:
+                for item in self._scan_block(block, block_start):
+                    yield item
+            self.offset = block_start + len(block)
+            if ticks:
+                yield None
+    
+    def _scan_block(self, block, block_start):
+        """ Generate the wanted rows of a block found by event_re. """
         
-        # Make sure we can read the csv file by reading the headings.
-        import csv
-        self.csv_in  = open(csv_file_path, 'rb')
-        self.csv_reader = csv.reader(self.csv_in)
-        headers = self.csv_reader.next()
-        # Is this the format we know about?
-        if headers != TweakTheTweetCSVReader.TTT_HEADERS:
-            raise ValueError("CSV headings do not match supported format.")
\ No newline at end of file
+        min_id = self.min_id
+        id_col = self.id_col
+        columns = self.columns
+        identity = self.identity
+        width = len(columns)
+        missing = TweakTheTweetCSVReader.MISSING
+        events = self.events
+        last_id = self.last_id
+        
+        lines = block.count("\n") + (not block.endswith("\n"))
+        # Find the wanted records first, then parse them all with one
+        # reader.
+        records = []
+        ends = []
+        # End of the last record found, where the quote count is even.
+        record_end = 0
+        size = len(block)
+        starts = (match.start() + 1
+                  for match in self.event_re.finditer(block))
+        # The block starts with a record, which has no newline before it.
+        if self.first_event_re.match(block):
+            starts = itertools.chain([0], starts)
+        for start in starts:
+            # A match inside a quoted field, or inside a record already
+            # found, isn't the start of a record.
+            if start < record_end or block.count('"', record_end, start) % 2:
+                continue
+            end = block.find("\n", start) + 1 or size
+            quotes = block.count('"', start, end)
+            while quotes % 2 and end < size:
+                next_end = block.find("\n", end) + 1 or size
+                quotes += block.count('"', end, next_end)
+                end = next_end
+            record_end = end
+            records.append(block[start:end])
+            ends.append(block_start + end)
+        try:
+            for (end, row) in itertools.izip(ends, csv.reader(records)):
+                try:
+                    ttt_id = int(row[id_col])
+                except (IndexError, ValueError):
+                    self.filtered_bad_id += 1
+                    continue
+                if ttt_id > last_id:
+                    last_id = ttt_id
+                if min_id is not None and ttt_id < min_id:
+                    self.filtered_id += 1
+                    continue
+                event = row[0].lstrip("#").lower()
+                if event not in events:
+                    self.filtered_event += 1
+                    continue
+                if identity and len(row) == width:
+                    pass
+                elif identity:
+                    row = (row + [missing] * width)[:width]
+                else:
+                    row = [row[i] if i is not None and i < len(row) else
+                           missing for i in columns]
+                self.offset = end
+                yield (ttt_id, event, row)
+            if self.id_is_last:
+                match = TweakTheTweetCSVReader.LAST_ID_RE.search(
+                    block.rstrip("\r\n"), max(0, size - 66))
+                if match and int(match.group(1)) > last_id:
+                    last_id = int(match.group(1))
+        finally:
+            self.last_id = last_id
+            self.rows_read += lines
+            self.filtered_event += lines - len(records)
+    
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class JSONLinesTweetReader(TweetReader):
+    """
+    Read tweets as they arrive from a stream of JSON objects, one per line.
+    
+    The stream can be a TCP socket ("tcp://host:port", as from a relay of
+    the Twitter streaming API), a file that is being appended to (read like
+    tail -f), or "-" for stdin.  A dropped connection is reopened, and a file
+    that is truncated or replaced is read again from the start.
+    
+    Each line may be a Twitter status, or an object with the TtT columns as
+    keys (see TweakTheTweetCSVReader.TTT_HEADERS).  Statuses are put into
+    TtT rows: the event is the first hashtag of the text that is a wanted
+    event, and the location and contact are taken from #loc and #contact
+    tags.  Other lines, such as delete notices, are skipped.
+    
+    extra holds the tweet's id, event and TtT row, as for
+    TweakTheTweetCSVReader, and the decoded object as "json".
+    """
+    
+    HASHTAG_RE = re.compile(r"#(\w+)", re.UNICODE)
+    TAG_RE = {"Location": re.compile(r"#loc\b[:\s]*([^#]+)", re.I),
+              "Contact": re.compile(r"#contact\b[:\s]*([^#]+)", re.I)}
+    TWITTER_TIME = "%a %b %d %H:%M:%S +0000 %Y"
+    
+    # Bytes to read from a socket at a time.
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__(self, source, events=None, min_id=None, follow=True,
+                 poll_interval=1.0):
+        """
+        @param source: "tcp://host:port", "-" for stdin, or a file path
+        @param events: collection of lowercase event names without "#" to
+        keep, or None to keep every event
+        @param min_id: least tweet id to keep, or None to keep every id.
+        It is raised past each tweet kept, so a tweet sent again, as by a
+        relay after a reconnect, is passed over.
+        @param follow: if True, wait for more at the end of a file, and
+        reconnect when a socket closes; if False, stop there
+        @param poll_interval: seconds between checks for more data, and
+        between idle ticks (None yielded by _tweets)
+        """
+        TweetReader.__init__(self)
+        self.source = source
+        self.events = frozenset(events) if events is not None else None
+        self.min_id = min_id
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.headers = list(TweakTheTweetCSVReader.TTT_HEADERS)
+        self.last_id = None
+        self.rows_read = 0
+        self.filtered_event = 0
+        self.filtered_id = 0
+        self.bad_lines = 0
+    
+    def _lines(self):
+        """ Generate lines from the source, and None while none arrive. """
+        if self.source.startswith("tcp://"):
+            return self._socket_lines()
+        if self.source == "-":
+            return self._stdin_lines()
+        return self._file_lines()
+    
+    def _socket_lines(self):
+        (host, port) = self.source[len("tcp://"):].rsplit(":", 1)
+        delay = self.poll_interval
+        while not self.stopping:
+            try:
+                sock = socket.create_connection((host, int(port)),
+                                                self.poll_interval * 10)
+            except socket.error:
+                if not self.follow:
+                    return
+                yield None
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+            delay = self.poll_interval
+            sock.settimeout(self.poll_interval)
+            partial = ""
+            try:
+                while not self.stopping:
+                    try:
+                        data = sock.recv(JSONLinesTweetReader.CHUNK_SIZE)
+                    except socket.timeout:
+                        yield None
+                        continue
+                    except socket.error:
+                        break
+                    if not data:
+                        break
+                    lines = (partial + data).split("\n")
+                    partial = lines.pop()
+                    for line in lines:
+                        yield line
+            finally:
+                sock.close()
+            if partial:
+                yield partial
+            if not self.follow:
+                return
+    
+    def _stdin_lines(self):
+        # Read the descriptor, not sys.stdin, whose buffer select can't see.
+        fd = sys.stdin.fileno()
+        partial = ""
+        while not self.stopping:
+            (ready, unused, unused) = select.select([fd], [], [],
+                                                   self.poll_interval)
+            if not ready:
+                yield None
+                continue
+            data = os.read(fd, JSONLinesTweetReader.CHUNK_SIZE)
+            if not data:
+                break
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                yield line
+        if partial:
+            yield partial
+    
+    def _file_lines(self):
+        fin = None
+        while not self.stopping:
+            if fin is None:
+                try:
+                    fin = open(self.source, "rb")
+                except IOError:
+                    if not self.follow:
+                        return
+                    yield None
+                    time.sleep(self.poll_interval)
+                    continue
+                partial = ""
+            line = fin.readline()
+            if line.endswith("\n"):
+                yield partial + line
+                partial = ""
+                continue
+            # At the end of the file, maybe partway through a line that is
+            # still being written.
+            partial += line
+            if not self.follow:
+                if partial:
+                    yield partial
+                break
+            yield None
+            time.sleep(self.poll_interval)
+            try:
+                replaced = (os.stat(self.source).st_ino !=
+                            os.fstat(fin.fileno()).st_ino or
+                            os.path.getsize(self.source) < fin.tell())
+            except OSError:
+                replaced = True
+            if replaced:
+                # Rotated or truncated; start on the new file.
+                fin.close()
+                fin = None
+        if fin is not None:
+            fin.close()
+    
+    def _event(self, text):
+        """ The first hashtag in text that is a wanted event, or None. """
+        for tag in JSONLinesTweetReader.HASHTAG_RE.findall(text):
+            tag = tag.lower()
+            if self.events is None or tag in self.events:
+                return tag
+        return None
+    
+    def status_row(self, status, text, sender, tweet_id, event):
+        """ Put a Twitter status into a TtT row. """
+        row = dict.fromkeys(TweakTheTweetCSVReader.TTT_HEADERS, "NA")
+        row["EVENT"] = "#" + event
+        row["Text"] = text
+        row["Author"] = sender
+        row["ID"] = str(tweet_id)
+        created_at = status.get("created_at")
+        try:
+            stamp = calendar.timegm(time.strptime(
+                created_at, JSONLinesTweetReader.TWITTER_TIME))
+        except (TypeError, ValueError):
+            stamp = time.time()
+        row["Time - EDT"] = time.strftime("%m/%d/%Y %H:%M:%S",
+                                          time.localtime(stamp))
+        if created_at:
+            row["Date_Time"] = encode_utf8(created_at)
+        row["Source"] = "http://twitter.com/%s/status/%s" % (sender, tweet_id)
+        for (column, tag_re) in JSONLinesTweetReader.TAG_RE.iteritems():
+            match = tag_re.search(text)
+            if match and match.group(1).strip():
+                row[column] = match.group(1).strip()
+        coordinates = (status.get("coordinates") or {}).get("coordinates")
+        if coordinates and len(coordinates) == 2:
+            row["GPS_Long"] = str(coordinates[0])
+            row["GPS_Lat"] = str(coordinates[1])
+        media = (status.get("entities") or {}).get("media") or []
+        if media:
+            row["Photo"] = (media[0].get("media_url_https") or
+                            media[0].get("media_url") or "NA")
+        return [row[header] for header in TweakTheTweetCSVReader.TTT_HEADERS]
+    
+    def _parse(self, obj):
+        """
+        Get (tweet id, event, text, sender, row) from one decoded line.
+        
+        @raise ValueError, KeyError or TypeError: if it isn't a tweet
+        """
+        if "ID" in obj and "EVENT" in obj:
+            # A TtT row.
+            row = [encode_utf8(obj.get(header, "NA"))
+                   for header in TweakTheTweetCSVReader.TTT_HEADERS]
+            tweet_id = int(obj["ID"])
+            event = obj["EVENT"].lstrip("#").lower()
+            if self.events is not None and event not in self.events:
+                event = None
+            return (tweet_id, event, row[5], row[15], row)
+        text = ((obj.get("extended_tweet") or {}).get("full_text") or
+                obj.get("full_text") or obj["text"])
+        sender = encode_utf8(obj["user"]["screen_name"])
+        tweet_id = int(obj["id"])
+        event = self._event(text)
+        text = encode_utf8(text)
+        row = None
+        if event is not None:
+            event = encode_utf8(event)
+            row = self.status_row(obj, text, sender, tweet_id, event)
+        return (tweet_id, event, text, sender, row)
+    
+    def _tweets(self):
+        for line in self._lines():
+            if line is None:
+                yield None
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+                (tweet_id, event, text, sender, row) = self._parse(obj)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # Not JSON, or not a tweet, e.g. a delete notice.
+                self.bad_lines += 1
+                yield None
+                continue
+            self.rows_read += 1
+            self.last_id = max(self.last_id, tweet_id)
+            # Lines that are passed over still count as ticks, so a batch
+            # isn't held up by a run of them.
+            if self.min_id is not None and tweet_id < self.min_id:
+                self.filtered_id += 1
+                yield None
+                continue
+            if event is None:
+                self.filtered_event += 1
+                yield None
+                continue
+            self.min_id = tweet_id + 1
+            yield TokenizedTweet(text, sender, {"id": tweet_id,
+                                                "event": event, "row": row,
+                                                "json": obj})
+
+
+def encode_utf8(value):
+    """ Make a JSON value a utf-8 str, as csv rows are. """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if not isinstance(value, str):
+        return str(value)
+    return value
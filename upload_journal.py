@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Provide a write-ahead journal of upload progress, for restarting the uploader.
+
+The journal records where the uploader is (the next TtT id to accept and the
+next sequential file to fetch) and, for the file being uploaded, the outcome
+of each row.  After a crash, the uploader picks up at the rows of that file
+that have no outcome yet, rather than sending the whole file again.  For a
+local file, the byte offset before which every row has an outcome is kept
+too, so the rows above it need not even be read again.
+
+Two files are kept: a snapshot of the state, rewritten whole at compaction,
+and an append-only journal of changes since the snapshot.  Recovery reads the
+snapshot and replays the journal, so it takes time in proportion to the
+journal's tail, not to the history of the event.
+
+Row records are buffered and written with one fsync per group (group
+commit), so the cost per row is a list append.  A crash loses at most the
+unwritten group, whose rows are then sent again.
+
+For compatibility, a snapshot in the old two line restart cache format
+("next_ttt_id <n>" and "next_file_num <n>") is also accepted.
+"""
+
+__all__ = ["UploadJournal"]
+
+import json
+import os
+import time
+
+
+class UploadJournal(object):
+    """
+    Restart state of the uploader, kept durable with a journal.
+
+    State, available as attributes:
+    next_ttt_id: least TtT id not yet covered by a finished file
+    next_file_num: number of the next sequential file to fetch
+    file_name: name (URL or path) of the file being uploaded, or None
+    done: set of (route name, TtT id) with an outcome in file_name
+    offset: byte offset in file_name before which every row has an outcome,
+    or 0 if unknown
+    """
+
+    # Write buffered records once this many are waiting...
+    GROUP_SIZE = 256
+    # ...or once this many seconds have passed since the last write.
+    GROUP_SECONDS = 0.25
+    # Compact once the journal holds this many records, and at the end of
+    # each file.
+    COMPACT_RECORDS = 100000
+
+    JOURNAL_SUFFIX = ".journal"
+
+    def __init__(self, path, next_ttt_id=1, next_file_num=1):
+        """
+        Open the journal at path, recovering any saved state.
+
+        @param path: path of the snapshot; the journal is path + ".journal"
+        @param next_ttt_id: next TtT id, if there is no saved state
+        @param next_file_num: next file number, if there is no saved state
+        """
+
+        self.path = path
+        self.journal_path = path + self.JOURNAL_SUFFIX
+        self.next_ttt_id = next_ttt_id
+        self.next_file_num = next_file_num
+        self.file_name = None
+        self.done = set()
+        self.offset = 0
+        self.buffer = []
+        self.last_write = time.time()
+        self.records = 0
+
+        self._read_snapshot()
+        self._replay()
+        # Start a fresh journal from the recovered state.
+        self.compact()
+
+    def _read_snapshot(self):
+        try:
+            fin = open(self.path, "r")
+            try:
+                text = fin.read()
+            finally:
+                fin.close()
+        except IOError:
+            return
+        try:
+            snapshot = json.loads(text)
+        except ValueError:
+            # The old restart cache: "key value" lines.
+            snapshot = {}
+            for line in text.splitlines():
+                key_val = line.split()
+                if len(key_val) == 2 and key_val[1].isdigit():
+                    snapshot[key_val[0]] = int(key_val[1])
+        if not isinstance(snapshot, dict):
+            return
+        self.next_ttt_id = max(self.next_ttt_id,
+                               snapshot.get("next_ttt_id", 1))
+        self.next_file_num = max(self.next_file_num,
+                                 snapshot.get("next_file_num", 1))
+        self.file_name = snapshot.get("file_name")
+        self.offset = snapshot.get("offset", 0)
+        self.done = set((route, ttt_id)
+                        for (route, ttt_id) in snapshot.get("done", []))
+
+    def _replay(self):
+        try:
+            fin = open(self.journal_path, "r")
+        except IOError:
+            return
+        try:
+            for line in fin:
+                # A crash can leave a partly written last line.
+                if not line.endswith("\n"):
+                    break
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    self._apply(fields)
+                except (IndexError, ValueError):
+                    break
+        finally:
+            fin.close()
+
+    def _apply(self, fields):
+        """ Update the state from one journal record. """
+
+        kind = fields[0]
+        if kind == "B":
+            if fields[1] != self.file_name:
+                self.file_name = fields[1]
+                self.done = set()
+                self.offset = 0
+        elif kind == "R":
+            self.done.add((fields[1], int(fields[2])))
+        elif kind == "O":
+            self.offset = max(self.offset, int(fields[1]))
+        elif kind == "E":
+            self.next_ttt_id = max(self.next_ttt_id, int(fields[2]))
+            self.next_file_num = max(self.next_file_num, int(fields[3]))
+            self.file_name = None
+            self.done = set()
+            self.offset = 0
+        else:
+            raise ValueError("Unknown journal record %r" % kind)
+
+    def _append(self, fields, force=False):
+        self._apply(fields)
+        self.buffer.append("\t".join(fields) + "\n")
+        if (force or len(self.buffer) >= self.GROUP_SIZE or
+                time.time() - self.last_write >= self.GROUP_SECONDS):
+            self.flush()
+            if self.records >= self.COMPACT_RECORDS:
+                self.compact()
+
+    def begin_file(self, name):
+        """
+        Note that a file is about to be uploaded.
+
+        If it is the file that was being uploaded when the script stopped,
+        its rows with outcomes stay in done, so they can be skipped.
+        """
+
+        if name != self.file_name:
+            self._append(["B", name], force=True)
+
+    def is_done(self, route, ttt_id):
+        """ Whether a row of the current file already has an outcome. """
+
+        return (route, ttt_id) in self.done
+
+    def record_row(self, route, ttt_id, outcome):
+        """
+        Record the outcome of one row of the current file.
+
+        @param route: name of the map route
+        @param ttt_id: the row's TtT id
+        @param outcome: short string, e.g. "uploaded" or "rejected"
+        """
+
+        self._append(["R", route, str(ttt_id), outcome])
+
+    def record_offset(self, offset):
+        """
+        Record that every row of the current file before a byte offset has
+        an outcome, so a restart can start reading there.
+        """
+
+        if offset > self.offset:
+            self._append(["O", str(offset)])
+
+    def end_file(self, last_ttt_id, next_file_num=None):
+        """
+        Record that the current file is finished.
+
+        @param last_ttt_id: highest TtT id in the file
+        @param next_file_num: number of the next sequential file to fetch, or
+        None to leave it as is
+        """
+
+        if next_file_num is None:
+            next_file_num = self.next_file_num
+        self._append(["E", self.file_name or "", str(last_ttt_id + 1),
+                      str(next_file_num)], force=True)
+        # With no rows done, the snapshot is small, so this is cheap.
+        self.compact()
+
+    def flush(self):
+        """ Write buffered records, and make sure they're on disk. """
+
+        if self.buffer:
+            fout = open(self.journal_path, "a")
+            try:
+                fout.writelines(self.buffer)
+                fout.flush()
+                os.fsync(fout.fileno())
+            finally:
+                fout.close()
+            self.records += len(self.buffer)
+            self.buffer = []
+        self.last_write = time.time()
+
+    def compact(self):
+        """ Write the state as a new snapshot and empty the journal. """
+
+        self.flush()
+        snapshot = {"next_ttt_id": self.next_ttt_id,
+                    "next_file_num": self.next_file_num,
+                    "file_name": self.file_name,
+                    "offset": self.offset,
+                    "done": sorted(self.done)}
+        # Write a new file and rename it over the old one, so a crash cannot
+        # leave a truncated snapshot.  Replaying the old journal over the new
+        # snapshot does no harm if we stop before emptying it.
+        fout = open(self.path + ".tmp", "w")
+        try:
+            json.dump(snapshot, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        finally:
+            fout.close()
+        if os.name == "nt" and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path + ".tmp", self.path)
+        open(self.journal_path, "w").close()
+        self.records = 0
+
+    def close(self):
+        """ Write any buffered records. """
+
+        self.flush()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Provide counters, gauges and latency histograms for the uploader.
+
+When uploads lag, these show where the time goes: fetching files, reading
+csv rows, parsing timestamps, or posting reports.  Metrics can be scraped in
+the Prometheus text format from a small local HTTP server, and summarized in
+a periodic log line.  A sampling profiler is also provided, which, unlike
+cProfile, sees the upload worker threads as well as the main thread.
+
+Recording a metric is a dict update under a lock, so it is cheap enough to
+do for every row.
+"""
+
+__all__ = ["UploadMetrics", "MetricsServer", "MetricsLogger",
+           "SamplingProfiler"]
+
+import BaseHTTPServer
+import bisect
+import sys
+import threading
+import time
+import traceback
+
+
+class UploadMetrics(object):
+    """
+    Named counters and histograms, each optionally split by labels.
+
+    Metric names follow Prometheus conventions: counters end in _total, and
+    times are in seconds.  Safe to share between threads.
+    """
+
+    # Upper bounds in seconds of the histogram buckets, covering a fast
+    # local parse up to a map server that is timing out.
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    PREFIX = "importttt_"
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        # (name, labels) -> value, where labels is a sorted tuple of pairs.
+        self.counters = {}
+        # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.histograms = {}
+        # (name, labels) -> function returning the current value
+        self.gauges = {}
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.iteritems())) if labels else ())
+
+    def describe(self, name, text):
+        """ Set the help text shown for a metric. """
+        self.help[name] = text
+
+    def count(self, name, value=1, **labels):
+        """ Add value to a counter. """
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Add one value, usually a time in seconds, to a histogram. """
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (
+                    len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def gauge(self, name, function, **labels):
+        """ Report the value function() returns as a gauge. """
+        with self.lock:
+            self.gauges[self._key(name, labels)] = function
+
+    def get_count(self, name, **labels):
+        """
+        Return a counter's value, added up over the labels not given.
+        """
+        wanted = set(labels.iteritems())
+        with self.lock:
+            return sum(value for ((key_name, key_labels), value)
+                       in self.counters.iteritems()
+                       if key_name == name and wanted.issubset(key_labels))
+
+    def get_histogram(self, name):
+        """
+        Return a histogram's bucket counts (last is +Inf), count and sum,
+        added up over all labels.
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        with self.lock:
+            for ((key_name, key_labels), histogram) in \
+                    self.histograms.iteritems():
+                if key_name == name:
+                    for i in xrange(len(counts)):
+                        counts[i] += histogram[i]
+                    total += histogram[-1]
+        return (counts, sum(counts), total)
+
+    def quantile(self, name, fraction):
+        """
+        Estimate a quantile of a histogram, interpolating within the bucket
+        it falls in.  Returns None if the histogram is empty.
+        """
+        (counts, number, total) = self.get_histogram(name)
+        if not number:
+            return None
+        rank = fraction * number
+        seen = 0
+        lower = 0.0
+        for (i, bucket_count) in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    # Past the last bound; the best we can say.
+                    return self.buckets[-1]
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            if i < len(self.buckets):
+                lower = self.buckets[i]
+        return self.buckets[-1]
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+            for (key, value) in pairs)
+
+    def render(self):
+        """ Return all metrics in the Prometheus text exposition format. """
+
+        with self.lock:
+            counters = sorted(self.counters.iteritems())
+            histograms = sorted((key, list(histogram)) for (key, histogram)
+                                in self.histograms.iteritems())
+            gauges = sorted(self.gauges.iteritems())
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append("# HELP %s%s %s" % (self.PREFIX, name,
+                                                     self.help[name]))
+                lines.append("# TYPE %s%s %s" % (self.PREFIX, name, kind))
+
+        for ((name, labels), value) in counters:
+            header(name, "counter")
+            lines.append("%s%s%s %s" % (self.PREFIX, name,
+                                        self._format_labels(labels), value))
+        for ((name, labels), function) in gauges:
+            try:
+                value = function()
+            except Exception:
+                continue
+            header(name, "gauge")
+            lines.append("%s%s%s %s" % (self.PREFIX, name,
+                                        self._format_labels(labels), value))
+        for ((name, labels), histogram) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for (i, bound) in enumerate(self.buckets + ("+Inf",)):
+                cumulative += histogram[i]
+                lines.append("%s%s_bucket%s %d" % (
+                    self.PREFIX, name,
+                    self._format_labels(labels, [("le", bound)]), cumulative))
+            lines.append("%s%s_sum%s %f" % (self.PREFIX, name,
+                                            self._format_labels(labels),
+                                            histogram[-1]))
+            lines.append("%s%s_count%s %d" % (self.PREFIX, name,
+                                              self._format_labels(labels),
+                                              cumulative))
+        lines.append("%sprocess_start_time_seconds %f" % (self.PREFIX,
+                                                          self.start_time))
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to stderr.
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serve metrics for Prometheus at http://<host>:<port>/metrics.
+
+    Runs on a daemon thread, so it stops with the script.
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        """
+        @param metrics: UploadMetrics to serve
+        @param port: port to listen on; 0 for any free port
+        @param host: address to listen on; by default only local clients
+        can connect
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+        self.server.metrics = metrics
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsLogger(threading.Thread):
+    """
+    Write a summary of the metrics to a stream every so often.
+
+    The summary function is called with the metrics, the seconds since the
+    last summary, and a dict it may keep values in between calls, and
+    returns the line to write.
+    """
+
+    def __init__(self, metrics, interval, summary, stream=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.interval = interval
+        self.summary = summary
+        self.stream = stream or sys.stderr
+        self.stopping = threading.Event()
+        self.last_time = time.time()
+        # For the summary function to keep values in from one call to the
+        # next, e.g. to report rates.
+        self.last = {}
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """ Write a summary now. """
+        now = time.time()
+        print >> self.stream, self.summary(self.metrics, now - self.last_time,
+                                           self.last)
+        self.last_time = now
+
+    def stop(self):
+        self.stopping.set()
+        # Wait for it, so it isn't still in wait() as the interpreter shuts
+        # down.
+        if self.is_alive():
+            self.join()
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Sample the stacks of all threads at intervals.
+
+    Stacks are written in the "collapsed" format read by flamegraph.pl and
+    speedscope: one line per distinct stack, outermost frame first, frames
+    separated by ";", followed by the number of samples.  The overhead
+    depends on the interval, not on how busy the profiled threads are.
+    """
+
+    def __init__(self, path, interval=0.005):
+        """
+        @param path: file to write the collapsed stacks to when stopped
+        @param interval: seconds between samples
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopping = threading.Event()
+
+    def run(self):
+        me = threading.current_thread().ident
+        while not self.stopping.is_set():
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = ";".join(
+                    "%s (%s:%d)" % (name, filename, line)
+                    for (filename, line, name, text)
+                    in traceback.extract_stack(frame, 64))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        """ Stop sampling and write the stacks. """
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        fout = open(self.path, "w")
+        try:
+            for (stack, count) in sorted(self.stacks.iteritems()):
+                fout.write("%s %d\n" % (stack, count))
+        finally:
+            fout.close()
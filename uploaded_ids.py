@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 encoding=utf-8
+
+"""
+Provide an on-disk index of the TtT ids that have already been uploaded.
+
+The restart cache only remembers the highest TtT id seen, so files that
+overlap or arrive out of order can cause reports to be posted twice.  This
+keeps every id the map server accepted in a sqlite table, so the uploader can
+skip a row without asking the server.
+
+New ids are buffered and written in one transaction per batch.  If the script
+dies, at most the unwritten batch is lost, and the committed ids are intact.
+"""
+
+__all__ = ["UploadedIdIndex"]
+
+import sqlite3
+import time
+
+
+class UploadedIdIndex(object):
+    """
+    Set of TtT ids, kept in a sqlite file.
+
+    Membership tests are an indexed lookup, O(log n) in the number of ids.
+    Not thread safe: use from one thread (the uploader calls its result
+    handler on the main thread).
+    """
+
+    # Write buffered ids once this many have been added...
+    BATCH_SIZE = 500
+    # ...or once this many seconds have passed since the last write.
+    BATCH_SECONDS = 5.0
+
+    def __init__(self, path):
+        """
+        Open or create the index file.
+
+        @param path: path of the sqlite file
+        """
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # WAL lets a batch commit without rewriting the main file, and with
+        # synchronous=NORMAL a commit survives a crash of this process.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS uploaded (id INTEGER PRIMARY KEY)")
+        self.db.commit()
+        self.pending = set()
+        self.last_flush = time.time()
+
+    def __contains__(self, ttt_id):
+        if ttt_id in self.pending:
+            return True
+        cursor = self.db.execute(
+            "SELECT 1 FROM uploaded WHERE id = ?", (ttt_id,))
+        return cursor.fetchone() is not None
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute("SELECT COUNT(*) FROM uploaded").fetchone()[0]
+
+    def add(self, ttt_id):
+        """ Record one uploaded id.  It is written with the next batch. """
+
+        self.pending.add(ttt_id)
+        if (len(self.pending) >= self.BATCH_SIZE or
+                time.time() - self.last_flush >= self.BATCH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered ids in one transaction. """
+
+        if self.pending:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO uploaded (id) VALUES (?)",
+                    ((ttt_id,) for ttt_id in self.pending))
+            self.pending = set()
+        self.last_flush = time.time()
+
+    def close(self):
+        """ Write any buffered ids and close the file. """
+
+        self.flush()
+        self.db.close()